@@ -8,10 +8,10 @@ from modules.uploads import router as uploads_router
 from modules.rooms import router as rooms_router
 from modules.admin import router as admin_router
 from modules.edit import router as edit_router
-from modules.config import UPLOAD_DIR
+from modules.config import UPLOAD_DIR, SERVE_PUBLIC_UPLOADS
 from modules.database import init_db, init_upload_queue_db, upgrade_main_db, upgrade_queue_db, add_date_taken_column  # ✅ import
 from modules.albums import router as albums_router
-from modules.uploads import backfill_normalize_uploads
+from modules.resumable import router as resumable_router, start_session_gc
 import threading
 from modules.queue import run_loop  # ⬅️ Import this
 from modules.queue import router as queue_router
@@ -52,7 +52,8 @@ app.add_middleware(
 
 
 # Serve uploaded files (videos)
-app.mount("/uploads", StaticFiles(directory=UPLOAD_DIR), name="uploads")
+if SERVE_PUBLIC_UPLOADS:
+	app.mount("/uploads", StaticFiles(directory=UPLOAD_DIR), name="uploads")
 
 # Register routers
 app.include_router(auth_router)
@@ -63,12 +64,18 @@ app.include_router(admin_router)
 app.include_router(edit_router)
 app.include_router(albums_router)
 app.include_router(queue_router)
+app.include_router(resumable_router)
 
-backfill_normalize_uploads()
+# Startup only does schema work. The web tier only enqueues: uploads, HLS and
+# maintenance jobs (normalize, backfills) run in `python -m modules.queue worker`.
+# Job process pools spawn children that re-import this file as __mp_main__;
+# they must not start background work of their own.
+if __name__ != "__mp_main__":
+	start_session_gc()
 
-# Start queue processor in background
-if os.getenv("RUN_MAIN") == "true":
-	threading.Thread(target=run_loop, daemon=True).start()
+	# RUN_MAIN=true also runs the workers in this process (single-container setups)
+	if os.getenv("RUN_MAIN") == "true":
+		threading.Thread(target=run_loop, daemon=True).start()
 
 
 if __name__ == "__main__":
@@ -1,43 +1,79 @@
 from fastapi import APIRouter, Depends, Form, HTTPException
-from fastapi.security import OAuth2PasswordBearer
 from modules.database import (
-	list_users, delete_user, user_exists
+	list_users, delete_user, user_exists, queue_conn, audit_query_plans, QUEUE_HOT_QUERIES
 )
-from modules.config import get_config, save_config
-from modules.auth import decode_token, get_user
-from modules.uploads import backfill_missing_previews, backfill_date_taken  # ✅ new
-from modules.queue import QUEUE_DB_PATH
-import sqlite3
+from modules.config import QUEUE_DB_PATH
+from modules.config import get_config, update_config
+from modules.auth import require_admin
+from modules.jobs import JOB_KINDS, cancel_job, get_job, list_jobs, request_job
 
 router = APIRouter()
-oauth2_scheme = OAuth2PasswordBearer(tokenUrl="login")
-
-def require_admin(token: str = Depends(oauth2_scheme)):
-	username = decode_token(token)
-	user = get_user(username)
-	if not user or not user["is_admin"]:
-		raise HTTPException(status_code=403, detail="Admin only")
-	return username
 
 @router.get("/admin/queue")
 def get_queue_status():
-	conn = sqlite3.connect(QUEUE_DB_PATH)
-	c = conn.cursor()
-	c.execute("SELECT id, username, final_name, status, retry_count FROM upload_queue")
-	rows = c.fetchall()
-	conn.close()
-	return [dict(zip(["id", "username", "final_name", "status", "retry_count"], r)) for r in rows]
+	with queue_conn() as conn:
+		rows = conn.execute("""
+			SELECT id, username, final_name, status, retry_count, job_type, priority, worker_id, lease_expires_at
+			FROM upload_queue
+		""").fetchall()
+	return [dict(zip([
+		"id", "username", "final_name", "status", "retry_count", "job_type", "priority", "worker_id", "lease_expires_at"
+	], r)) for r in rows]
+
 
+# Backfills run as background jobs in the queue worker; poll /admin/jobs/{job_id} for progress
+def start_backfill(kind: str) -> dict:
+	job_id = request_job(kind)
+	if job_id is None:
+		return {"status": "Backfill already running", "job_id": None}
+	return {"status": "Backfill queued", "job_id": job_id}
 
 @router.post("/admin/backfill_previews")
 def run_preview_backfill(_: str = Depends(require_admin)):
-	backfill_missing_previews()
-	return {"status": "Backfill complete"}
+	return start_backfill("previews")
 
 @router.post("/admin/backfill_dates")  # ✅ new route
 def run_date_backfill(_: str = Depends(require_admin)):
-	backfill_date_taken()
-	return {"status": "Date taken backfill complete"}
+	return start_backfill("dates")
+
+@router.post("/admin/backfill_hashes")
+def run_hash_backfill(_: str = Depends(require_admin)):
+	return start_backfill("hashes")
+
+@router.get("/admin/jobs")
+def admin_list_jobs(_: str = Depends(require_admin)):
+	return list_jobs()
+
+@router.get("/admin/jobs/{job_id}")
+def admin_get_job(job_id: int, _: str = Depends(require_admin)):
+	job = get_job(job_id)
+	if not job:
+		raise HTTPException(status_code=404, detail="Job not found")
+	return job
+
+@router.post("/admin/jobs/{job_id}/cancel")
+def admin_cancel_job(job_id: int, _: str = Depends(require_admin)):
+	if not get_job(job_id):
+		raise HTTPException(status_code=404, detail="Job not found")
+	if not cancel_job(job_id):
+		raise HTTPException(status_code=409, detail="Job is not running")
+	return {"status": "cancelling", "job_id": job_id}
+
+@router.post("/admin/jobs/{kind}")
+def admin_start_job(kind: str, _: str = Depends(require_admin)):
+	if kind not in JOB_KINDS:
+		raise HTTPException(status_code=404, detail="Unknown job kind")
+	job_id = request_job(kind)
+	return {"job_id": job_id, "queued": job_id is not None}
+
+@router.get("/admin/db/query_plans")
+def get_query_plans(_: str = Depends(require_admin)):
+	report = audit_query_plans()
+	report.update({f"queue.{name}": entry for name, entry in audit_query_plans(QUEUE_HOT_QUERIES, QUEUE_DB_PATH).items()})
+	return {
+		"ok": all(entry["ok"] for entry in report.values()),
+		"queries": report,
+	}
 
 @router.get("/admin/signup_status")
 def get_signup_status(_: str = Depends(require_admin)):
@@ -45,16 +81,12 @@ def get_signup_status(_: str = Depends(require_admin)):
 
 @router.post("/admin/lock_signup")
 def lock_signup(_: str = Depends(require_admin)):
-	config = get_config()
-	config["signup_locked"] = True
-	save_config(config)
+	update_config(signup_locked=True)
 	return {"status": "locked"}
 
 @router.post("/admin/unlock_signup")
 def unlock_signup(_: str = Depends(require_admin)):
-	config = get_config()
-	config["signup_locked"] = False
-	save_config(config)
+	update_config(signup_locked=False)
 	return {"status": "unlocked"}
 
 @router.get("/admin/list_users")
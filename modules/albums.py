@@ -1,35 +1,23 @@
 from fastapi import APIRouter, Depends, HTTPException, Form
-from fastapi.security import OAuth2PasswordBearer
-import sqlite3
 from uuid import uuid4
 from datetime import datetime
-from modules.auth import decode_token
-from modules.database import user_exists
-from modules.config import DB_PATH
+from modules.auth import get_current_user
+from modules.database import db_conn, hot_query
+from modules.thumbnails import thumbnail_variants
+from modules.media import media_links
 
 router = APIRouter()
-oauth2_scheme = OAuth2PasswordBearer(tokenUrl="login")
-
-
-def get_current_user(token: str = Depends(oauth2_scheme)):
-	username = decode_token(token)
-	if not username or not user_exists(username):
-		raise HTTPException(status_code=401, detail="Invalid token")
-	return username
 
 
 @router.get("/albums")
 def list_albums(username: str = Depends(get_current_user)):
-	conn = sqlite3.connect(DB_PATH)
-	c = conn.cursor()
-	c.execute("""
-		SELECT albums.id, albums.name, albums.description, albums.cover_filename,
-		albums.creator_username,
-		(SELECT COUNT(*) FROM album_items WHERE album_id = albums.id) as media_count
-		FROM albums
-	""")
-	albums = c.fetchall()
-	conn.close()
+	with db_conn() as conn:
+		albums = conn.execute("""
+			SELECT albums.id, albums.name, albums.description, albums.cover_filename,
+			albums.creator_username,
+			(SELECT COUNT(*) FROM album_items WHERE album_id = albums.id) as media_count
+			FROM albums
+		""").fetchall()
 
 	return [
 		{
@@ -51,29 +39,23 @@ def create_album(
 	username: str = Depends(get_current_user)
 ):
 	album_id = str(uuid4())
-	conn = sqlite3.connect(DB_PATH)
-	c = conn.cursor()
-	c.execute("""
-		INSERT INTO albums (id, name, description, creator_username)
-		VALUES (?, ?, ?, ?)
-	""", (album_id, name.strip(), description.strip(), username))
-	conn.commit()
-	conn.close()
+	with db_conn() as conn:
+		conn.execute("""
+			INSERT INTO albums (id, name, description, creator_username)
+			VALUES (?, ?, ?, ?)
+		""", (album_id, name.strip(), description.strip(), username))
 
 	return {"status": "created", "id": album_id}
 
 
 @router.get("/album/{album_id}")
 def get_album_info(album_id: str, username: str = Depends(get_current_user)):
-	conn = sqlite3.connect(DB_PATH)
-	c = conn.cursor()
-	c.execute("""
-		SELECT id, name, description, cover_filename, creator_username
-		FROM albums
-		WHERE id = ?
-	""", (album_id,))
-	row = c.fetchone()
-	conn.close()
+	with db_conn() as conn:
+		row = conn.execute("""
+			SELECT id, name, description, cover_filename, creator_username
+			FROM albums
+			WHERE id = ?
+		""", (album_id,)).fetchone()
 
 	if not row:
 		raise HTTPException(status_code=404, detail="Album not found")
@@ -87,19 +69,19 @@ def get_album_info(album_id: str, username: str = Depends(get_current_user)):
 	}
 
 
+ALBUM_MEDIA_SQL = hot_query("album_media", """
+			SELECT videos.username, videos.filename, videos.caption, videos.timestamp, videos.date_taken, users.avatar,
+			videos.width, videos.height, videos.duration, videos.thumb_widths, videos.hls_renditions
+			FROM album_items
+			JOIN videos ON album_items.filename = videos.filename
+			JOIN users ON videos.username = users.username
+			WHERE album_items.album_id = ?
+		""")
+
 @router.get("/album/{album_id}/media")
 def get_album_media(album_id: str, username: str = Depends(get_current_user)):
-	conn = sqlite3.connect(DB_PATH)
-	c = conn.cursor()
-	c.execute("""
-		SELECT videos.username, videos.filename, videos.caption, videos.timestamp, videos.date_taken, users.avatar
-		FROM album_items
-		JOIN videos ON album_items.filename = videos.filename
-		JOIN users ON videos.username = users.username
-		WHERE album_items.album_id = ?
-	""", (album_id,))
-	rows = c.fetchall()
-	conn.close()
+	with db_conn() as conn:
+		rows = conn.execute(ALBUM_MEDIA_SQL, (album_id,)).fetchall()
 
 	grouped = {}
 	for row in rows:
@@ -114,6 +96,11 @@ def get_album_media(album_id: str, username: str = Depends(get_current_user)):
 				"timestamp": row[3],
 				"date_taken": row[4],
 				"avatar": row[5],
+				"width": row[6],
+				"height": row[7],
+				"duration": row[8],
+				"thumbnails": thumbnail_variants(row[1], row[9]),
+				**media_links(row[1], row[10]),
 			})
 		except Exception as e:
 			print("[Album Gallery Debug] Skipped invalid:", row, e)
@@ -130,18 +117,12 @@ def add_to_album(
 	filenames: list[str] = Form(...),
 	username: str = Depends(get_current_user)
 ):
-	conn = sqlite3.connect(DB_PATH)
-	c = conn.cursor()
-
-	for filename in filenames:
-		c.execute(
+	with db_conn() as conn:
+		conn.executemany(
 			"INSERT OR IGNORE INTO album_items (album_id, filename) VALUES (?, ?)",
-			(album_id, filename)
+			[(album_id, filename) for filename in filenames]
 		)
 
-	conn.commit()
-	conn.close()
-
 	return {"status": "added", "count": len(filenames)}
 
 
@@ -151,14 +132,11 @@ def remove_from_album(
 	filenames: list[str] = Form(...),
 	username: str = Depends(get_current_user)
 ):
-	conn = sqlite3.connect(DB_PATH)
-	c = conn.cursor()
-
-	for filename in filenames:
-		c.execute("DELETE FROM album_items WHERE album_id=? AND filename=?", (album_id, filename))
-
-	conn.commit()
-	conn.close()
+	with db_conn() as conn:
+		conn.executemany(
+			"DELETE FROM album_items WHERE album_id=? AND filename=?",
+			[(album_id, filename) for filename in filenames]
+		)
 
 	return {"status": "removed", "count": len(filenames)}
 
@@ -169,27 +147,22 @@ def delete_album(
 	confirm_name: str = Form(...),
 	username: str = Depends(get_current_user)
 ):
-	conn = sqlite3.connect(DB_PATH)
-	c = conn.cursor()
-	c.execute("SELECT name, creator_username FROM albums WHERE id=?", (album_id,))
-	row = c.fetchone()
-	if not row:
-		conn.close()
-		raise HTTPException(status_code=404, detail="Album not found")
+	with db_conn() as conn:
+		c = conn.cursor()
+		c.execute("SELECT name, creator_username FROM albums WHERE id=?", (album_id,))
+		row = c.fetchone()
+		if not row:
+			raise HTTPException(status_code=404, detail="Album not found")
 
-	name, creator = row
-	if creator.lower() != username.lower():
-		conn.close()
-		raise HTTPException(status_code=403, detail="Only the creator can delete this album")
+		name, creator = row
+		if creator.lower() != username.lower():
+			raise HTTPException(status_code=403, detail="Only the creator can delete this album")
 
-	if confirm_name != name:
-		conn.close()
-		raise HTTPException(status_code=400, detail="Album name mismatch")
+		if confirm_name != name:
+			raise HTTPException(status_code=400, detail="Album name mismatch")
 
-	c.execute("DELETE FROM albums WHERE id=?", (album_id,))
-	c.execute("DELETE FROM album_items WHERE album_id=?", (album_id,))
-	conn.commit()
-	conn.close()
+		c.execute("DELETE FROM albums WHERE id=?", (album_id,))
+		c.execute("DELETE FROM album_items WHERE album_id=?", (album_id,))
 
 	return {"status": "deleted"}
 @router.post("/album/{album_id}/update")
@@ -200,44 +173,39 @@ def update_album(
 	new_cover_filename: str = Form(None),
 	username: str = Depends(get_current_user)
 ):
-	conn = sqlite3.connect(DB_PATH)
-	c = conn.cursor()
+	with db_conn() as conn:
+		c = conn.cursor()
 
-	c.execute("SELECT creator_username FROM albums WHERE id=?", (album_id,))
-	row = c.fetchone()
-	if not row:
-		conn.close()
-		raise HTTPException(status_code=404, detail="Album not found")
+		c.execute("SELECT creator_username FROM albums WHERE id=?", (album_id,))
+		row = c.fetchone()
+		if not row:
+			raise HTTPException(status_code=404, detail="Album not found")
 
-	creator = row[0]
-	if creator.lower() != username.lower():
-		conn.close()
-		raise HTTPException(status_code=403, detail="Only the creator can edit the album")
+		creator = row[0]
+		if creator.lower() != username.lower():
+			raise HTTPException(status_code=403, detail="Only the creator can edit the album")
 
-	updates = []
-	params = []
+		updates = []
+		params = []
 
-	if new_name is not None:
-		updates.append("name = ?")
-		params.append(new_name.strip())
+		if new_name is not None:
+			updates.append("name = ?")
+			params.append(new_name.strip())
 
-	if new_description is not None:
-		updates.append("description = ?")
-		params.append(new_description.strip())
+		if new_description is not None:
+			updates.append("description = ?")
+			params.append(new_description.strip())
 
-	if new_cover_filename is not None:
-		updates.append("cover_filename = ?")
-		params.append(new_cover_filename.strip())
+		if new_cover_filename is not None:
+			updates.append("cover_filename = ?")
+			params.append(new_cover_filename.strip())
 
-	if not updates:
-		conn.close()
-		raise HTTPException(status_code=400, detail="No changes submitted")
+		if not updates:
+			raise HTTPException(status_code=400, detail="No changes submitted")
 
-	params.append(album_id)
-	query = f"UPDATE albums SET {', '.join(updates)} WHERE id = ?"
-	c.execute(query, tuple(params))
-	conn.commit()
-	conn.close()
+		params.append(album_id)
+		query = f"UPDATE albums SET {', '.join(updates)} WHERE id = ?"
+		c.execute(query, tuple(params))
 
 	return {"status": "updated"}
 
@@ -249,37 +217,32 @@ def auto_pick_cover(
 ):
 	require_album_owner(album_id, username)
 
-	conn = sqlite3.connect(DB_PATH)
-	c = conn.cursor()
-
-	# Get current cover
-	c.execute("SELECT cover_filename FROM albums WHERE id=?", (album_id,))
-	row = c.fetchone()
-	if not row:
-		conn.close()
-		raise HTTPException(status_code=404, detail="Album not found")
-
-	current_cover = row[0]
-	if current_cover:
-		conn.close()
-		return {"status": "skipped", "reason": "Cover already set"}
-
-	# Find first media file in album
-	c.execute("""
-		SELECT filename FROM album_items
-		WHERE album_id=?
-		ORDER BY rowid ASC
-		LIMIT 1
-	""", (album_id,))
-	row = c.fetchone()
-
-	if not row:
-		conn.close()
-		return {"status": "skipped", "reason": "Album has no media"}
-
-	first_filename = row[0]
-	c.execute("UPDATE albums SET cover_filename=? WHERE id=?", (first_filename, album_id))
-	conn.commit()
-	conn.close()
+	with db_conn() as conn:
+		c = conn.cursor()
+
+		# Get current cover
+		c.execute("SELECT cover_filename FROM albums WHERE id=?", (album_id,))
+		row = c.fetchone()
+		if not row:
+			raise HTTPException(status_code=404, detail="Album not found")
+
+		current_cover = row[0]
+		if current_cover:
+			return {"status": "skipped", "reason": "Cover already set"}
+
+		# Find first media file in album
+		c.execute("""
+			SELECT filename FROM album_items
+			WHERE album_id=?
+			ORDER BY rowid ASC
+			LIMIT 1
+		""", (album_id,))
+		row = c.fetchone()
+
+		if not row:
+			return {"status": "skipped", "reason": "Album has no media"}
+
+		first_filename = row[0]
+		c.execute("UPDATE albums SET cover_filename=? WHERE id=?", (first_filename, album_id))
 
 	return {"status": "updated", "cover_filename": first_filename}
@@ -1,11 +1,13 @@
-from fastapi import APIRouter, Form, Depends, HTTPException
+from fastapi import APIRouter, Form, Depends, HTTPException, Request
 from fastapi.security import OAuth2PasswordRequestForm
+from starlette.concurrency import run_in_threadpool
+from concurrent.futures import ThreadPoolExecutor
 from passlib.context import CryptContext
 from jose import jwt, JWTError
-import time
-from modules.database import add_user, get_user, user_count, user_exists
+import asyncio, math, time
+from modules.database import add_user, get_user, get_user_flags, update_password, user_count, user_exists
+from modules.cache import TTLCache, MISSING
 from modules.config import SECRET_KEY, ALGORITHM, ACCESS_TOKEN_EXPIRE_SECONDS, get_config
-from modules.config import save_config
 
 router = APIRouter()
 pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
@@ -16,27 +18,102 @@ def verify_password(plain, hashed):
 def hash_password(pw):
 	return pwd_context.hash(pw)
 
+# bcrypt gets its own small pool so a burst of logins can't eat the threadpool
+# that sync endpoints run on.
+HASH_WORKERS = 2
+_hash_executor = ThreadPoolExecutor(max_workers=HASH_WORKERS, thread_name_prefix="bcrypt")
+# Verifies queued or running at once; beyond this a flood would only push
+# everyone's login further back, so extra attempts are turned away
+MAX_PENDING_VERIFIES = 8 * HASH_WORKERS
+_pending_verifies = 0
+# Verified against when the user doesn't exist, so timing doesn't reveal it
+DUMMY_HASH = "$2b$12$eMs.mCW12uuCt6Y1zlIdSuuMD.c6z7DJ5OacQAaxNN.eoXCJqMV7e"
+
+async def verify_password_async(plain, hashed):
+	"""Returns (ok, new_hash); new_hash is set when the stored hash needs upgrading."""
+	loop = asyncio.get_running_loop()
+	return await loop.run_in_executor(_hash_executor, pwd_context.verify_and_update, plain, hashed)
+
+class LoginThrottle:
+	"""
+	Token bucket per key: every login attempt reserves a token up front and
+	only a successful one gets it back; tokens refill at `refill_per_second`.
+	Only touched from the event loop, so no locking.
+	"""
+
+	def __init__(self, capacity: int, refill_per_second: float):
+		self.capacity = capacity
+		self.refill = refill_per_second
+		# An entry idle long enough to refill completely is the same as no entry
+		self._buckets = TTLCache(maxsize=10000, ttl=capacity / refill_per_second)
+
+	def _tokens(self, key: str, now: float) -> float:
+		entry = self._buckets.get(key)
+		if entry is MISSING:
+			return self.capacity
+		tokens, last = entry
+		return min(self.capacity, tokens + (now - last) * self.refill)
+
+	def reserve(self, key: str) -> float:
+		"""Take a token. Returns 0, or the seconds until one is available."""
+		now = time.monotonic()
+		tokens = self._tokens(key, now)
+		if tokens < 1:
+			return (1 - tokens) / self.refill
+		self._buckets.set(key, (tokens - 1, now))
+		return 0
+
+	def refund(self, key: str):
+		now = time.monotonic()
+		self._buckets.set(key, (min(self.capacity, self._tokens(key, now) + 1), now))
+
+FAILED_LOGIN_DELAY = 1  # seconds, awaited without holding a thread
+user_throttle = LoginThrottle(capacity=5, refill_per_second=1 / 30)
+ip_throttle = LoginThrottle(capacity=20, refill_per_second=1 / 6)
+
 def create_token(username: str):
 	exp = int(time.time()) + ACCESS_TOKEN_EXPIRE_SECONDS
 	return jwt.encode({"sub": username, "exp": exp}, SECRET_KEY, algorithm=ALGORITHM)
 
+# Decoded tokens, so a gallery page's worth of /media requests verifies the
+# JWT signature once. Entries never outlive the token's own exp.
+TOKEN_CACHE_TTL = 300  # seconds
+_token_cache = TTLCache(maxsize=4096, ttl=TOKEN_CACHE_TTL)
+
 def decode_token(token: str):
+	cached = _token_cache.get(token)
+	if cached is not MISSING:
+		username, exp = cached
+		return username if exp is None or exp > time.time() else None
 	try:
 		payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
-		return payload.get("sub")
 	except JWTError:
 		return None
+	username, exp = payload.get("sub"), payload.get("exp")
+	ttl = TOKEN_CACHE_TTL if exp is None else min(TOKEN_CACHE_TTL, exp - time.time())
+	if ttl > 0:
+		_token_cache.set(token, (username, exp), ttl)
+	return username
 
 from fastapi.security import OAuth2PasswordBearer
 
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="login")
 
+# Shared dependencies for every router; user lookups go through the
+# database user cache, so the common case never touches SQLite.
 def get_current_user(token: str = Depends(oauth2_scheme)):
 	username = decode_token(token)
 	if not username or not user_exists(username):
 		raise HTTPException(status_code=401, detail="Invalid token")
 	return username
 
+def require_admin(token: str = Depends(oauth2_scheme)):
+	username = decode_token(token)
+	user = get_user_flags(username) if username else None
+	if not user or not user["is_admin"]:
+		raise HTTPException(status_code=403, detail="Admin only")
+	return username
+
 
 @router.post("/register")
 def register(username: str = Form(...), password: str = Form(...)):
@@ -49,10 +126,42 @@ def register(username: str = Form(...), password: str = Form(...)):
 	return {"msg": "User created", "is_admin": is_admin}
 
 @router.post("/login")
-def login(form: OAuth2PasswordRequestForm = Depends()):
-	user = get_user(form.username)
-	if not user or not verify_password(form.password, user["hashed"]):
-		time.sleep(1)
+async def login(request: Request, form: OAuth2PasswordRequestForm = Depends()):
+	global _pending_verifies
+	if _pending_verifies >= MAX_PENDING_VERIFIES:
+		raise HTTPException(status_code=503, detail="Too many logins in progress", headers={"Retry-After": "1"})
+
+	# Reserve before the bcrypt await, so concurrent attempts can't all get
+	# past a bucket that only has a few tokens left
+	user_key = form.username.lower()
+	ip_key = request.client.host if request.client else "unknown"
+	wait = user_throttle.reserve(user_key)
+	if not wait:
+		wait = ip_throttle.reserve(ip_key)
+		if wait:
+			user_throttle.refund(user_key)
+	if wait:
+		raise HTTPException(
+			status_code=429,
+			detail="Too many failed attempts",
+			headers={"Retry-After": str(math.ceil(wait))},
+		)
+
+	_pending_verifies += 1
+	try:
+		user = await run_in_threadpool(get_user, form.username)
+		ok, new_hash = await verify_password_async(form.password, user["hashed"] if user else DUMMY_HASH)
+	finally:
+		_pending_verifies -= 1
+	if not user or not ok:
+		await asyncio.sleep(FAILED_LOGIN_DELAY)
 		raise HTTPException(status_code=401, detail="Bad credentials")
+
+	user_throttle.refund(user_key)
+	ip_throttle.refund(ip_key)
+
+	if new_hash:
+		# CryptContext settings changed since this hash was made
+		await run_in_threadpool(update_password, form.username, new_hash)
 	token = create_token(form.username)
 	return {"access_token": token, "token_type": "bearer"}
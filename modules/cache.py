@@ -0,0 +1,42 @@
+import threading, time
+from collections import OrderedDict
+
+MISSING = object()
+
+class TTLCache:
+	"""Small thread-safe LRU where every entry also expires after a TTL."""
+
+	def __init__(self, maxsize: int, ttl: float):
+		self.maxsize = maxsize
+		self.ttl = ttl
+		self._data = OrderedDict()
+		self._lock = threading.Lock()
+
+	def get(self, key, default=MISSING):
+		now = time.monotonic()
+		with self._lock:
+			entry = self._data.get(key)
+			if entry is None:
+				return default
+			value, expires = entry
+			if expires <= now:
+				del self._data[key]
+				return default
+			self._data.move_to_end(key)
+			return value
+
+	def set(self, key, value, ttl: float | None = None):
+		expires = time.monotonic() + (self.ttl if ttl is None else ttl)
+		with self._lock:
+			self._data[key] = (value, expires)
+			self._data.move_to_end(key)
+			while len(self._data) > self.maxsize:
+				self._data.popitem(last=False)
+
+	def pop(self, key):
+		with self._lock:
+			self._data.pop(key, None)
+
+	def clear(self):
+		with self._lock:
+			self._data.clear()
@@ -1,5 +1,8 @@
 import os
 import json
+import tempfile
+import threading
+import time
 
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 ROOT_DIR = os.path.abspath(os.path.join(BASE_DIR, ".."))
@@ -8,30 +11,95 @@ BASE_DATA_DIR = os.path.join(os.path.dirname(__file__), "..", "data")
 UPLOAD_DIR = os.path.join(BASE_DATA_DIR, "uploads")
 AVATAR_DIR = os.path.join(BASE_DATA_DIR, "avatars")  # if you use one
 ROOMS_DIR = os.path.join(BASE_DATA_DIR, "user_rooms")
+# Incoming uploads land here first; same volume as UPLOAD_DIR so moves are renames
+UPLOAD_STAGING_DIR = os.path.join(BASE_DATA_DIR, "staging")
 DB_PATH = os.path.join(BASE_DATA_DIR, "app.db")
 QUEUE_DB_PATH = os.path.join(BASE_DATA_DIR, "upload_queue.db")
 
 CONFIG_PATH = os.path.join(ROOT_DIR, "config.json")
+
+# Signed media URLs (/m/...) can be handed to a reverse proxy instead of being
+# streamed by Python: "x-accel" (nginx X-Accel-Redirect) or "x-sendfile".
+MEDIA_OFFLOAD = os.getenv("MEDIA_OFFLOAD", "").lower()
+MEDIA_ACCEL_PREFIX = os.getenv("MEDIA_ACCEL_PREFIX", "/_protected/uploads/")
+SIGNED_URL_TTL = 6 * 3600  # seconds
+# The legacy unauthenticated /uploads mount; set to "false" once clients use signed URLs
+SERVE_PUBLIC_UPLOADS = os.getenv("SERVE_PUBLIC_UPLOADS", "true").lower() == "true"
+# Re-uploads of identical bytes are linked to the existing file instead of
+# being stored and processed again: "user" (same uploader only), "global"
+# (anyone's copy, hard-linked under a new name) or "off".
+DEDUP_SCOPE = os.getenv("DEDUP_SCOPE", "user").lower()
+# Also encode an HLS ladder for every video (see modules/hls.py); CPU heavy
+HLS_ENABLED = os.getenv("HLS_ENABLED", "false").lower() == "true"
 ALGORITHM = "HS256"
 ACCESS_TOKEN_EXPIRE_SECONDS = 36000
 
 os.makedirs(UPLOAD_DIR, exist_ok=True)
 os.makedirs(AVATAR_DIR, exist_ok=True)
 os.makedirs(ROOMS_DIR, exist_ok=True)
+os.makedirs(UPLOAD_STAGING_DIR, exist_ok=True)
+
+# Parsed config.json is cached per process. Callers only stat the file once
+# CONFIG_CHECK_INTERVAL has passed, and only re-parse it when its mtime or
+# size changed, so every worker picks up another worker's save within a second.
+CONFIG_CHECK_INTERVAL = 1.0  # seconds
+DEFAULT_CONFIG = {"signup_locked": False}
+
+_config_lock = threading.Lock()
+_config_cache = None  # (config, (mtime_ns, size), checked_at)
+
+def _write_config_file(config):
+	"""Write via a temp file + rename so readers never see a half-written file."""
+	fd, tmp_path = tempfile.mkstemp(dir=ROOT_DIR, prefix=".config.", suffix=".tmp")
+	try:
+		with os.fdopen(fd, "w") as f:
+			json.dump(config, f)
+			f.flush()
+			os.fsync(f.fileno())
+		os.replace(tmp_path, CONFIG_PATH)
+	except BaseException:
+		try:
+			os.unlink(tmp_path)
+		except OSError:
+			pass
+		raise
+
+def _load_config(force=False):
+	global _config_cache
+	now = time.monotonic()
+	with _config_lock:
+		if _config_cache and not force and now - _config_cache[2] < CONFIG_CHECK_INTERVAL:
+			return _config_cache[0]
+		try:
+			st = os.stat(CONFIG_PATH)
+		except FileNotFoundError:
+			_write_config_file({**DEFAULT_CONFIG, "secret_key": os.urandom(32).hex()})
+			st = os.stat(CONFIG_PATH)
+		version = (st.st_mtime_ns, st.st_size)
+		if _config_cache and _config_cache[1] == version:
+			_config_cache = (_config_cache[0], version, now)
+		else:
+			with open(CONFIG_PATH) as f:
+				_config_cache = ({**DEFAULT_CONFIG, **json.load(f)}, version, now)
+		return _config_cache[0]
 
 def get_config():
-	if not os.path.exists(CONFIG_PATH):
-		default = {
-			"signup_locked": False,
-			"secret_key": os.urandom(32).hex()
-		}
-		with open(CONFIG_PATH, "w") as f:
-			json.dump(default, f)
-	return json.load(open(CONFIG_PATH))
+	"""A copy of the current config; safe for callers to modify."""
+	return dict(_load_config())
 
 def save_config(config):
-	with open(CONFIG_PATH, "w") as f:
-		json.dump(config, f)
+	global _config_cache
+	with _config_lock:
+		_write_config_file(config)
+		st = os.stat(CONFIG_PATH)
+		_config_cache = (dict(config), (st.st_mtime_ns, st.st_size), time.monotonic())
+
+def update_config(**changes):
+	"""Read-modify-write against the file on disk rather than a cached copy."""
+	config = dict(_load_config(force=True))
+	config.update(changes)
+	save_config(config)
+	return config
 
 config = get_config()
 SECRET_KEY = config["secret_key"]
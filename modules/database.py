@@ -1,103 +1,120 @@
+import argparse
+import os
 import sqlite3
+import sys
+import tempfile
+import threading
 import time
+from contextlib import contextmanager
 from uuid import uuid4
 from modules.config import DB_PATH, QUEUE_DB_PATH
-
-def init_db():
-	conn = sqlite3.connect(DB_PATH)
-	c = conn.cursor()
-
-	# Users table
-	c.execute("""
-		CREATE TABLE IF NOT EXISTS users (
-			username TEXT PRIMARY KEY,
-			password TEXT NOT NULL,
-			is_admin INTEGER NOT NULL,
-			avatar TEXT
-		)
-	""")
-
-	# Videos table
-	c.execute("""
-		CREATE TABLE IF NOT EXISTS videos (
-			id TEXT PRIMARY KEY,
-			username TEXT NOT NULL,
-			filename TEXT NOT NULL,
-			caption TEXT,
-			timestamp INTEGER,
-			date_taken INTEGER
-		)
-	""")
-
-	# 🔥 NEW: Albums table
-	c.execute("""
-		CREATE TABLE IF NOT EXISTS albums (
-			id TEXT PRIMARY KEY,
-			name TEXT NOT NULL,
-			description TEXT,
-			cover_filename TEXT,
-			creator_username TEXT NOT NULL
-		)
-	""")
-
-	# 🔥 NEW: Album Items linking table
-	c.execute("""
-		CREATE TABLE IF NOT EXISTS album_items (
-			album_id TEXT,
-			filename TEXT,
-			PRIMARY KEY (album_id, filename),
-			FOREIGN KEY (album_id) REFERENCES albums(id),
-			FOREIGN KEY (filename) REFERENCES videos(filename)
-		)
-	""")
-
-	conn.commit()
-	conn.close()
-
-def init_upload_queue_db():
-	conn = sqlite3.connect(QUEUE_DB_PATH)
-	c = conn.cursor()
-	c.execute("""
-	CREATE TABLE IF NOT EXISTS upload_queue (
-		id INTEGER PRIMARY KEY AUTOINCREMENT,
-		username TEXT NOT NULL,
-		original_path TEXT NOT NULL,
-		final_name TEXT NOT NULL,
-		caption TEXT,
-		is_video INTEGER NOT NULL,
-		created_at INTEGER,
-		status TEXT DEFAULT 'pending',
-		retry_count INTEGER DEFAULT 0,
-		album_id TEXT
+from modules.cache import TTLCache, MISSING
+
+# -------------------- Connection pool --------------------
+# One long-lived connection per (thread, database file). Opening a sqlite3
+# connection costs a file open plus schema parse, and a fresh connection also
+# starts with an empty statement cache, so the helpers below reuse them.
+STATEMENT_CACHE_SIZE = 256
+BUSY_TIMEOUT_MS = 5000
+
+CONNECTION_PRAGMAS = (
+	"PRAGMA journal_mode=WAL",  # readers never wait on the transcode worker's writes
+	"PRAGMA synchronous=NORMAL",  # safe under WAL, avoids an fsync per commit
+	"PRAGMA cache_size=-16000",  # ~16 MB page cache per connection
+	"PRAGMA mmap_size=268435456",  # 256 MB memory-mapped reads
+	"PRAGMA temp_store=MEMORY",
+)
+
+_local = threading.local()
+
+def _open_connection(path: str) -> sqlite3.Connection:
+	conn = sqlite3.connect(
+		path,
+		timeout=BUSY_TIMEOUT_MS / 1000,
+		cached_statements=STATEMENT_CACHE_SIZE,
 	)
-	""")
-
-	conn.commit()
-	conn.close()
-
-def column_exists(conn, table: str, column: str) -> bool:
-	c = conn.cursor()
-	c.execute(f"PRAGMA table_info({table})")
-	return any(row[1] == column for row in c.fetchall())
-
-def table_exists(conn, table: str) -> bool:
-	c = conn.cursor()
-	c.execute("SELECT name FROM sqlite_master WHERE type='table' AND name=?", (table,))
-	return c.fetchone() is not None
-
-def upgrade_main_db():
-	conn = sqlite3.connect(DB_PATH)
+	for pragma in CONNECTION_PRAGMAS:
+		conn.execute(pragma)
+	return conn
+
+def get_connection(path: str = DB_PATH) -> sqlite3.Connection:
+	"""Return the calling thread's pooled connection to ``path``."""
+	pool = getattr(_local, "pool", None)
+	# Connections must never cross a fork, so a child process starts a fresh pool
+	if pool is None or getattr(_local, "pid", None) != os.getpid():
+		pool = _local.pool = {}
+		_local.depth = {}
+		_local.pid = os.getpid()
+	conn = pool.get(path)
+	if conn is None:
+		conn = pool[path] = _open_connection(path)
+	return conn
+
+@contextmanager
+def db_conn(path: str = DB_PATH):
+	"""
+	Borrow the pooled connection; commit on success, roll back on error.
+	Nested blocks on the same thread share the outermost block's
+	transaction: only the outermost one commits or rolls back.
+	"""
+	conn = get_connection(path)
+	depth = _local.depth.get(path, 0)
+	_local.depth[path] = depth + 1
+	try:
+		yield conn
+	except BaseException:
+		if not depth:
+			conn.rollback()
+		raise
+	else:
+		if not depth:
+			conn.commit()
+	finally:
+		_local.depth[path] = depth
+
+def queue_conn():
+	return db_conn(QUEUE_DB_PATH)
+
+def init_db(path: str = DB_PATH):
+	with db_conn(path) as conn:
+		c = conn.cursor()
+
+		# Users table
+		c.execute("""
+			CREATE TABLE IF NOT EXISTS users (
+				username TEXT PRIMARY KEY,
+				password TEXT NOT NULL,
+				is_admin INTEGER NOT NULL,
+				avatar TEXT
+			)
+		""")
 
-	# Check and add missing column
-	if not column_exists(conn, "videos", "date_taken"):
-		print("[DB Upgrade] Adding date_taken column to videos...")
-		conn.execute("ALTER TABLE videos ADD COLUMN date_taken INTEGER")
+		# Videos table
+		c.execute("""
+			CREATE TABLE IF NOT EXISTS videos (
+				id TEXT PRIMARY KEY,
+				username TEXT NOT NULL,
+				filename TEXT NOT NULL,
+				caption TEXT,
+				timestamp INTEGER,
+				date_taken INTEGER,
+				duration REAL,
+				width INTEGER,
+				height INTEGER,
+				codec TEXT,
+				audio_codec TEXT,
+				rotation INTEGER,
+				file_size INTEGER,
+				thumb_widths TEXT,
+				conversion TEXT,
+				hls_renditions TEXT,
+				sha256 TEXT
+			)
+		""")
 
-	# Albums
-	if not table_exists(conn, "albums"):
-		print("[DB Upgrade] Creating albums table...")
-		conn.execute("""
-			CREATE TABLE albums (
+		# 🔥 NEW: Albums table
+		c.execute("""
+			CREATE TABLE IF NOT EXISTS albums (
 				id TEXT PRIMARY KEY,
 				name TEXT NOT NULL,
 				description TEXT,
@@ -106,10 +123,9 @@ def upgrade_main_db():
 			)
 		""")
 
-	if not table_exists(conn, "album_items"):
-		print("[DB Upgrade] Creating album_items table...")
-		conn.execute("""
-			CREATE TABLE album_items (
+		# 🔥 NEW: Album Items linking table
+		c.execute("""
+			CREATE TABLE IF NOT EXISTS album_items (
 				album_id TEXT,
 				filename TEXT,
 				PRIMARY KEY (album_id, filename),
@@ -118,80 +134,384 @@ def upgrade_main_db():
 			)
 		""")
 
-	conn.commit()
-	conn.close()
-
-def upgrade_queue_db():
-	conn = sqlite3.connect(QUEUE_DB_PATH)
-
-	if not table_exists(conn, "upload_queue"):
-		print("[DB Upgrade] Creating upload_queue table...")
-		conn.execute("""
-			CREATE TABLE upload_queue (
+		# Checkpointed background jobs (see modules/jobs.py)
+		c.execute("""
+			CREATE TABLE IF NOT EXISTS jobs (
 				id INTEGER PRIMARY KEY AUTOINCREMENT,
+				kind TEXT NOT NULL,
+				status TEXT NOT NULL DEFAULT 'pending',
+				checkpoint INTEGER NOT NULL DEFAULT 0,
+				processed INTEGER NOT NULL DEFAULT 0,
+				failed INTEGER NOT NULL DEFAULT 0,
+				total INTEGER,
+				created_at INTEGER,
+				started_at INTEGER,
+				updated_at INTEGER,
+				finished_at INTEGER,
+				error TEXT,
+				cancel_requested INTEGER NOT NULL DEFAULT 0,
+				started_processed INTEGER NOT NULL DEFAULT 0
+			)
+		""")
+		c.execute("CREATE INDEX IF NOT EXISTS idx_jobs_kind_status ON jobs(kind, status)")
+
+		# Resumable uploads in progress (see modules/resumable.py)
+		c.execute("""
+			CREATE TABLE IF NOT EXISTS upload_sessions (
+				id TEXT PRIMARY KEY,
 				username TEXT NOT NULL,
-				original_path TEXT NOT NULL,
-				final_name TEXT NOT NULL,
+				filename TEXT NOT NULL,
+				content_type TEXT NOT NULL,
+				size INTEGER,
+				received INTEGER NOT NULL DEFAULT 0,
 				caption TEXT,
-				is_video INTEGER NOT NULL,
+				album_id TEXT,
 				created_at INTEGER,
-				status TEXT DEFAULT 'pending',
-				retry_count INTEGER DEFAULT 0,
-				album_id TEXT
+				updated_at INTEGER
 			)
 		""")
-	else:
-		if not column_exists(conn, "upload_queue", "status"):
-			print("[DB Upgrade] Adding status column to upload_queue...")
-			conn.execute("ALTER TABLE upload_queue ADD COLUMN status TEXT DEFAULT 'pending'")
 
-		if not column_exists(conn, "upload_queue", "retry_count"):
-			print("[DB Upgrade] Adding retry_count column to upload_queue...")
-			conn.execute("ALTER TABLE upload_queue ADD COLUMN retry_count INTEGER DEFAULT 0")
+def init_upload_queue_db(path: str = QUEUE_DB_PATH):
+	with db_conn(path) as conn:
+		c = conn.cursor()
+		c.execute("""
+		CREATE TABLE IF NOT EXISTS upload_queue (
+			id INTEGER PRIMARY KEY AUTOINCREMENT,
+			username TEXT NOT NULL,
+			original_path TEXT NOT NULL,
+			final_name TEXT NOT NULL,
+			caption TEXT,
+			is_video INTEGER NOT NULL,
+			created_at INTEGER,
+			status TEXT DEFAULT 'pending',
+			retry_count INTEGER DEFAULT 0,
+			album_id TEXT,
+			job_type TEXT DEFAULT 'convert',
+			sha256 TEXT,
+			priority INTEGER DEFAULT 1,
+			worker_id TEXT,
+			lease_expires_at REAL
+		)
+		""")
+		# Round-robin state for claim_next: the user served longest ago goes next
+		c.execute("""
+		CREATE TABLE IF NOT EXISTS queue_users (
+			username TEXT PRIMARY KEY,
+			last_claimed_at REAL NOT NULL DEFAULT 0
+		)
+		""")
+
+def column_exists(conn, table: str, column: str) -> bool:
+	c = conn.cursor()
+	c.execute(f"PRAGMA table_info({table})")
+	return any(row[1] == column for row in c.fetchall())
 
-		if not column_exists(conn, "upload_queue", "album_id"):
-			print("[DB Upgrade] Adding album_id column to upload_queue...")
-			conn.execute("ALTER TABLE upload_queue ADD COLUMN album_id TEXT")
+def table_exists(conn, table: str) -> bool:
+	c = conn.cursor()
+	c.execute("SELECT name FROM sqlite_master WHERE type='table' AND name=?", (table,))
+	return c.fetchone() is not None
 
-	conn.commit()
-	conn.close()
+# Media metadata filled in once by the probe step (see uploads.probe_media)
+MEDIA_METADATA_COLUMNS = {
+	"duration": "REAL",
+	"width": "INTEGER",
+	"height": "INTEGER",
+	"codec": "TEXT",
+	# Videos: first audio stream's codec, or "none" when there is no audio
+	"audio_codec": "TEXT",
+	"rotation": "INTEGER",
+	"file_size": "INTEGER",
+	# Comma-separated widths of the stored thumbnail pyramid, e.g. "160,320,640"
+	"thumb_widths": "TEXT",
+	# How convert_to_mp4 produced the file: remux, audio or transcode (NULL if not converted)
+	"conversion": "TEXT",
+	# Comma-separated heights of the HLS ladder in hls_<base>/, e.g. "720,480,360"
+	"hls_renditions": "TEXT",
+}
+
+# Indexes the hot query paths rely on, created (idempotently) by upgrade_main_db
+MAIN_DB_INDEXES = {
+	# Keyset pagination for /feed: ORDER BY timestamp DESC, id DESC
+	"idx_videos_timestamp_id": "videos(timestamp, id)",
+	# Month-windowed /gallery and /gallery/user ordered by date taken
+	"idx_videos_taken": "videos(COALESCE(date_taken, timestamp))",
+	"idx_videos_user_taken": "videos(username, COALESCE(date_taken, timestamp))",
+	# delete_media / edit_dates / edit_date / album joins look media up by filename
+	"idx_videos_filename": "videos(filename)",
+	# album_items is joined and cleaned up by filename
+	"idx_album_items_filename": "album_items(filename)",
+	# resolve_username_caseless and case-insensitive user_exists/get_user
+	"idx_users_username_lower": "users(LOWER(username))",
+	# Duplicate detection at upload, per user or across everyone
+	"idx_videos_sha256": "videos(sha256, username)",
+}
+
+# Indexes behind claim_next's fair scheduling and the queue status endpoints
+QUEUE_DB_INDEXES = {
+	# Pending/processing lookups by age (reaping, FIFO listings)
+	"idx_upload_queue_status_created": "upload_queue(status, created_at)",
+	# Highest pending priority class: MIN(priority) WHERE status = 'pending'
+	"idx_upload_queue_status_priority": "upload_queue(status, priority)",
+	# A user's oldest pending job in a class, and per-user status lists
+	"idx_upload_queue_user_status": "upload_queue(username, status, priority, created_at)",
+	# Round-robin walk over users, least recently served first
+	"idx_queue_users_last_claimed": "queue_users(last_claimed_at)",
+	# reap_expired_leases: processing rows whose lease ran out
+	"idx_upload_queue_status_lease": "upload_queue(status, lease_expires_at)",
+}
+
+# Statements on hot endpoint paths register themselves where they are
+# defined (`X_SQL = hot_query("name", "...")`), so audit_query_plans() runs
+# EXPLAIN QUERY PLAN on exactly what the endpoints execute and reports any
+# that scan or sort, so a schema change that silently drops an index shows
+# up in /admin/db/query_plans. Registries fill as modules are imported.
+HOT_QUERIES = {}
+QUEUE_HOT_QUERIES = {}
+
+def hot_query(name: str, sql: str, registry: dict = HOT_QUERIES, limit_bounded: bool = False) -> str:
+	"""
+	Register `sql` for the audit and return it unchanged. limit_bounded marks
+	a statement whose index-order SCAN is meant to stop at its LIMIT.
+	"""
+	registry[name] = (sql, limit_bounded)
+	return sql
+
+def ensure_indexes(conn, indexes: dict):
+	for name, target in indexes.items():
+		if not conn.execute("SELECT 1 FROM sqlite_master WHERE type='index' AND name=?", (name,)).fetchone():
+			print(f"[DB Upgrade] Creating index {name}...")
+			conn.execute(f"CREATE INDEX IF NOT EXISTS {name} ON {target}")
+
+def plan_step_ok(step: str, limit_bounded: bool) -> bool:
+	if "TEMP B-TREE" in step:
+		return False
+	if step.startswith("SCAN") and step != "SCAN CONSTANT ROW":
+		# Even "SCAN ... USING INDEX" reads the whole index unless a LIMIT stops it
+		return limit_bounded and "USING" in step
+	return True
+
+def audit_query_plans(queries: dict = HOT_QUERIES, path: str = DB_PATH) -> dict:
+	"""
+	EXPLAIN QUERY PLAN every registered hot query. Returns
+	{name: {"plan": [...], "ok": bool}} where ok is False if any step is a
+	temp b-tree sort or a SCAN (index-order scans only pass when the query
+	was registered as limit_bounded).
+	"""
+	report = {}
+	with db_conn(path) as conn:
+		for name, (sql, limit_bounded) in queries.items():
+			params = (None,) * sql.count("?")
+			plan = [row[3] for row in conn.execute(f"EXPLAIN QUERY PLAN {sql}", params)]
+			report[name] = {"plan": plan, "ok": all(plan_step_ok(step, limit_bounded) for step in plan)}
+	return report
+
+def audit_fresh_schema() -> dict:
+	"""
+	audit_query_plans() for both databases, built from scratch in a temp
+	dir, so the result depends only on the schema code. Queue statements
+	are reported as "queue.<name>".
+	"""
+	with tempfile.TemporaryDirectory() as tmp:
+		main_path = os.path.join(tmp, "app.db")
+		queue_path = os.path.join(tmp, "upload_queue.db")
+		init_db(main_path)
+		upgrade_main_db(main_path)
+		init_upload_queue_db(queue_path)
+		upgrade_queue_db(queue_path)
+		report = audit_query_plans(HOT_QUERIES, main_path)
+		report.update({f"queue.{name}": entry for name, entry in audit_query_plans(QUEUE_HOT_QUERIES, queue_path).items()})
+		for path in (main_path, queue_path):
+			get_connection(path).close()
+			del _local.pool[path]
+	return report
+
+def upgrade_main_db(path: str = DB_PATH):
+	with db_conn(path) as conn:
+		# Check and add missing column
+		if not column_exists(conn, "videos", "date_taken"):
+			print("[DB Upgrade] Adding date_taken column to videos...")
+			conn.execute("ALTER TABLE videos ADD COLUMN date_taken INTEGER")
+
+		for column, col_type in MEDIA_METADATA_COLUMNS.items():
+			if not column_exists(conn, "videos", column):
+				print(f"[DB Upgrade] Adding {column} column to videos...")
+				conn.execute(f"ALTER TABLE videos ADD COLUMN {column} {col_type}")
+
+		# SHA-256 of the uploaded bytes, used to skip duplicate uploads
+		if not column_exists(conn, "videos", "sha256"):
+			print("[DB Upgrade] Adding sha256 column to videos...")
+			conn.execute("ALTER TABLE videos ADD COLUMN sha256 TEXT")
+
+		# Albums
+		if not table_exists(conn, "albums"):
+			print("[DB Upgrade] Creating albums table...")
+			conn.execute("""
+				CREATE TABLE albums (
+					id TEXT PRIMARY KEY,
+					name TEXT NOT NULL,
+					description TEXT,
+					cover_filename TEXT,
+					creator_username TEXT NOT NULL
+				)
+			""")
+
+		if not table_exists(conn, "album_items"):
+			print("[DB Upgrade] Creating album_items table...")
+			conn.execute("""
+				CREATE TABLE album_items (
+					album_id TEXT,
+					filename TEXT,
+					PRIMARY KEY (album_id, filename),
+					FOREIGN KEY (album_id) REFERENCES albums(id),
+					FOREIGN KEY (filename) REFERENCES videos(filename)
+				)
+			""")
+
+		# Job cancellation and per-run rate (modules/jobs.py)
+		for column in ("cancel_requested", "started_processed"):
+			if table_exists(conn, "jobs") and not column_exists(conn, "jobs", column):
+				print(f"[DB Upgrade] Adding {column} column to jobs...")
+				conn.execute(f"ALTER TABLE jobs ADD COLUMN {column} INTEGER NOT NULL DEFAULT 0")
+
+		ensure_indexes(conn, MAIN_DB_INDEXES)
+
+def upgrade_queue_db(path: str = QUEUE_DB_PATH):
+	with db_conn(path) as conn:
+		if not table_exists(conn, "upload_queue"):
+			print("[DB Upgrade] Creating upload_queue table...")
+			conn.execute("""
+				CREATE TABLE upload_queue (
+					id INTEGER PRIMARY KEY AUTOINCREMENT,
+					username TEXT NOT NULL,
+					original_path TEXT NOT NULL,
+					final_name TEXT NOT NULL,
+					caption TEXT,
+					is_video INTEGER NOT NULL,
+					created_at INTEGER,
+					status TEXT DEFAULT 'pending',
+					retry_count INTEGER DEFAULT 0,
+					album_id TEXT,
+					job_type TEXT DEFAULT 'convert',
+					sha256 TEXT,
+					priority INTEGER DEFAULT 1,
+					worker_id TEXT,
+					lease_expires_at REAL
+				)
+			""")
+		else:
+			if not column_exists(conn, "upload_queue", "status"):
+				print("[DB Upgrade] Adding status column to upload_queue...")
+				conn.execute("ALTER TABLE upload_queue ADD COLUMN status TEXT DEFAULT 'pending'")
+
+			if not column_exists(conn, "upload_queue", "retry_count"):
+				print("[DB Upgrade] Adding retry_count column to upload_queue...")
+				conn.execute("ALTER TABLE upload_queue ADD COLUMN retry_count INTEGER DEFAULT 0")
+
+			if not column_exists(conn, "upload_queue", "album_id"):
+				print("[DB Upgrade] Adding album_id column to upload_queue...")
+				conn.execute("ALTER TABLE upload_queue ADD COLUMN album_id TEXT")
+
+			if not column_exists(conn, "upload_queue", "job_type"):
+				print("[DB Upgrade] Adding job_type column to upload_queue...")
+				conn.execute("ALTER TABLE upload_queue ADD COLUMN job_type TEXT DEFAULT 'convert'")
+
+			if not column_exists(conn, "upload_queue", "sha256"):
+				print("[DB Upgrade] Adding sha256 column to upload_queue...")
+				conn.execute("ALTER TABLE upload_queue ADD COLUMN sha256 TEXT")
+
+			if not column_exists(conn, "upload_queue", "priority"):
+				print("[DB Upgrade] Adding priority column to upload_queue...")
+				conn.execute("ALTER TABLE upload_queue ADD COLUMN priority INTEGER DEFAULT 1")
+
+			# Leases: which worker holds a 'processing' row and until when
+			if not column_exists(conn, "upload_queue", "worker_id"):
+				print("[DB Upgrade] Adding worker_id column to upload_queue...")
+				conn.execute("ALTER TABLE upload_queue ADD COLUMN worker_id TEXT")
+
+			if not column_exists(conn, "upload_queue", "lease_expires_at"):
+				print("[DB Upgrade] Adding lease_expires_at column to upload_queue...")
+				conn.execute("ALTER TABLE upload_queue ADD COLUMN lease_expires_at REAL")
+
+			# Per-row copy of queue_users.last_claimed_at, no longer kept
+			conn.execute("DROP INDEX IF EXISTS idx_upload_queue_fair")
+			if column_exists(conn, "upload_queue", "user_served_at"):
+				print("[DB Upgrade] Dropping user_served_at column from upload_queue...")
+				conn.execute("ALTER TABLE upload_queue DROP COLUMN user_served_at")
+
+		if not table_exists(conn, "queue_users"):
+			print("[DB Upgrade] Creating queue_users table...")
+			conn.execute("""
+				CREATE TABLE queue_users (
+					username TEXT PRIMARY KEY,
+					last_claimed_at REAL NOT NULL DEFAULT 0
+				)
+			""")
+		# Users with jobs queued before fair scheduling existed
+		conn.execute("INSERT OR IGNORE INTO queue_users (username) SELECT DISTINCT username FROM upload_queue")
+
+		ensure_indexes(conn, QUEUE_DB_INDEXES)
 
 
 def add_date_taken_column():
-	conn = sqlite3.connect(DB_PATH)
-	c = conn.cursor()
-	try:
-		c.execute("ALTER TABLE videos ADD COLUMN date_taken INTEGER")
-	except sqlite3.OperationalError as e:
-		if "duplicate column" not in str(e).lower():
-			raise
-	conn.commit()
-	conn.close()
+	with db_conn() as conn:
+		try:
+			conn.execute("ALTER TABLE videos ADD COLUMN date_taken INTEGER")
+		except sqlite3.OperationalError as e:
+			if "duplicate column" not in str(e).lower():
+				raise
+
+RESOLVE_USERNAME_SQL = hot_query("resolve_username", "SELECT username FROM users WHERE LOWER(username) = LOWER(?)")
+USER_FLAGS_SQL = hot_query("user_flags", "SELECT is_admin FROM users WHERE username=?")
+USER_EXISTS_CASELESS_SQL = hot_query("user_exists_caseless", "SELECT 1 FROM users WHERE LOWER(username)=LOWER(?)")
+GET_USER_SQL = hot_query("get_user", "SELECT password, is_admin, avatar FROM users WHERE username=?")
+GET_USER_CASELESS_SQL = hot_query(
+	"get_user_caseless", "SELECT username, password, is_admin, avatar FROM users WHERE LOWER(username)=LOWER(?)"
+)
 
 def resolve_username_caseless(name: str) -> str | None:
-	conn = sqlite3.connect(DB_PATH)
-	c = conn.cursor()
-	c.execute("SELECT username FROM users WHERE LOWER(username) = LOWER(?)", (name,))
-	row = c.fetchone()
-	conn.close()
+	with db_conn() as conn:
+		c = conn.cursor()
+		c.execute(RESOLVE_USERNAME_SQL, (name,))
+		row = c.fetchone()
 	return row[0] if row else None
 
+# Per-process cache of {"username", "is_admin"} keyed by exact username, so the
+# auth dependency doesn't hit SQLite on every request. add_user/delete_user
+# invalidate it locally; other uvicorn workers converge within USER_CACHE_TTL.
+USER_CACHE_TTL = 30  # seconds
+_user_cache = TTLCache(maxsize=1024, ttl=USER_CACHE_TTL)
+
+def get_user_flags(username: str) -> dict | None:
+	cached = _user_cache.get(username)
+	if cached is not MISSING:
+		return cached
+	with db_conn() as conn:
+		row = conn.execute(USER_FLAGS_SQL, (username,)).fetchone()
+	flags = {"username": username, "is_admin": bool(row[0])} if row else None
+	_user_cache.set(username, flags)
+	return flags
+
+def invalidate_user_cache(username: str | None = None):
+	if username is None:
+		_user_cache.clear()
+	else:
+		_user_cache.pop(username)
+
 def user_exists(username: str, case_insensitive=False) -> bool:
-	conn = sqlite3.connect(DB_PATH)
-	c = conn.cursor()
-	query = "SELECT 1 FROM users WHERE LOWER(username)=LOWER(?)" if case_insensitive else "SELECT 1 FROM users WHERE username=?"
-	c.execute(query, (username,))
-	exists = c.fetchone() is not None
-	conn.close()
+	if not case_insensitive:
+		return get_user_flags(username) is not None
+	with db_conn() as conn:
+		c = conn.cursor()
+		c.execute(USER_EXISTS_CASELESS_SQL, (username,))
+		exists = c.fetchone() is not None
 	return exists
 
 def get_user(username: str, case_insensitive=False):
-	conn = sqlite3.connect(DB_PATH)
-	c = conn.cursor()
-	query = "SELECT username, password, is_admin, avatar FROM users WHERE LOWER(username)=LOWER(?)" if case_insensitive else "SELECT password, is_admin, avatar FROM users WHERE username=?"
-	c.execute(query, (username,))
-	row = c.fetchone()
-	conn.close()
+	query = GET_USER_CASELESS_SQL if case_insensitive else GET_USER_SQL
+	with db_conn() as conn:
+		c = conn.cursor()
+		c.execute(query, (username,))
+		row = c.fetchone()
 	if row:
 		return {
 			"username": row[0] if case_insensitive else username,
@@ -202,70 +522,134 @@ def get_user(username: str, case_insensitive=False):
 	return None
 
 def add_user(username, password, is_admin):
-	conn = sqlite3.connect(DB_PATH)
-	c = conn.cursor()
-	c.execute("INSERT INTO users (username, password, is_admin) VALUES (?, ?, ?)", (username, password, int(is_admin)))
-	conn.commit()
-	conn.close()
+	with db_conn() as conn:
+		conn.execute("INSERT INTO users (username, password, is_admin) VALUES (?, ?, ?)", (username, password, int(is_admin)))
+	invalidate_user_cache(username)
+
+def update_password(username, password):
+	with db_conn() as conn:
+		conn.execute("UPDATE users SET password=? WHERE username=?", (password, username))
 
 def update_avatar(username, filename):
-	conn = sqlite3.connect(DB_PATH)
-	c = conn.cursor()
-	c.execute("UPDATE users SET avatar=? WHERE username=?", (filename, username))
-	conn.commit()
-	conn.close()
+	with db_conn() as conn:
+		conn.execute("UPDATE users SET avatar=? WHERE username=?", (filename, username))
 
 def list_users(include_admin=True):
-	conn = sqlite3.connect(DB_PATH)
-	c = conn.cursor()
 	query = "SELECT username, is_admin, avatar FROM users" if include_admin else "SELECT username, avatar FROM users"
-	c.execute(query)
-	rows = c.fetchall()
-	conn.close()
+	with db_conn() as conn:
+		rows = conn.execute(query).fetchall()
 	return [
 		{"username": r[0], "is_admin": bool(r[1]) if include_admin else None, "avatar": r[-1]}
 		for r in rows
 	]
 
+DELETE_USER_VIDEOS_SQL = hot_query("delete_user_videos", "DELETE FROM videos WHERE username=?")
+
 def delete_user(username):
-	conn = sqlite3.connect(DB_PATH)
-	c = conn.cursor()
-	c.execute("DELETE FROM users WHERE username=?", (username,))
-	c.execute("DELETE FROM videos WHERE username=?", (username,))
-	conn.commit()
-	conn.close()
+	with db_conn() as conn:
+		c = conn.cursor()
+		c.execute("DELETE FROM users WHERE username=?", (username,))
+		c.execute(DELETE_USER_VIDEOS_SQL, (username,))
+	invalidate_user_cache(username)
 
 def user_count():
-	conn = sqlite3.connect(DB_PATH)
-	c = conn.cursor()
-	c.execute("SELECT COUNT(*) FROM users")
-	count = c.fetchone()[0]
-	conn.close()
+	with db_conn() as conn:
+		count = conn.execute("SELECT COUNT(*) FROM users").fetchone()[0]
 	return count
 
-def track_upload(username, filename, caption, date_taken=None):
-	conn = sqlite3.connect(DB_PATH)
-	c = conn.cursor()
-	c.execute("""
-		INSERT INTO videos (id, username, filename, caption, timestamp, date_taken)
-		VALUES (?, ?, ?, ?, ?, ?)
-	""", (
-		str(uuid4()),
-		username,
-		filename,
-		caption,
-		int(time.time()),
-		int(date_taken) if date_taken else None
-	))
-	conn.commit()
-	conn.close()
+def track_upload(username, filename, caption, date_taken=None, sha256=None):
+	with db_conn() as conn:
+		conn.execute("""
+			INSERT INTO videos (id, username, filename, caption, timestamp, date_taken, sha256)
+			VALUES (?, ?, ?, ?, ?, ?, ?)
+		""", (
+			str(uuid4()),
+			username,
+			filename,
+			caption,
+			int(time.time()),
+			int(date_taken) if date_taken else None,
+			sha256
+		))
+
+HASH_MATCH_COLUMNS = [
+	"filename", "username", "caption", "date_taken", "duration", "width", "height", "codec", "audio_codec", "rotation", "file_size", "thumb_widths"
+]
+FIND_BY_HASH_ANY_SQL = hot_query(
+	"find_by_hash_any", f"SELECT {', '.join(HASH_MATCH_COLUMNS)} FROM videos WHERE sha256 = ? LIMIT 1"
+)
+FIND_BY_HASH_SQL = hot_query(
+	"find_by_hash", f"SELECT {', '.join(HASH_MATCH_COLUMNS)} FROM videos WHERE sha256 = ? AND username = ? LIMIT 1"
+)
+
+def find_by_hash(sha256, username=None):
+	"""An existing upload with these bytes (optionally only this user's), or None."""
+	with db_conn() as conn:
+		if username is None:
+			row = conn.execute(FIND_BY_HASH_ANY_SQL, (sha256,)).fetchone()
+		else:
+			row = conn.execute(FIND_BY_HASH_SQL, (sha256, username)).fetchone()
+	if not row:
+		return None
+	return dict(zip(HASH_MATCH_COLUMNS, row))
+
+MEDIA_METADATA_UPDATE = hot_query("update_media_metadata", """
+	UPDATE videos SET
+		date_taken = COALESCE(?, date_taken),
+		thumb_widths = COALESCE(?, thumb_widths),
+		conversion = COALESCE(?, conversion),
+		duration = ?, width = ?, height = ?, codec = ?, audio_codec = ?, rotation = ?, file_size = ?
+	WHERE filename = ?
+""")
+
+def media_metadata_params(filename, meta: dict) -> tuple:
+	"""Parameters for MEDIA_METADATA_UPDATE; lets batch jobs use executemany."""
+	thumb_widths = meta.get("thumb_widths")
+	return (
+		int(meta["date_taken"]) if meta.get("date_taken") else None,
+		",".join(str(w) for w in thumb_widths) if thumb_widths else None,
+		meta.get("conversion"),
+		meta.get("duration"),
+		meta.get("width"),
+		meta.get("height"),
+		meta.get("codec"),
+		meta.get("audio_codec"),
+		meta.get("rotation"),
+		meta.get("file_size"),
+		filename
+	)
+
+def update_media_metadata(filename, meta: dict):
+	"""
+	Store a probe_media() result. A missing date or thumbnail list never
+	overwrites an existing one.
+	"""
+	with db_conn() as conn:
+		conn.execute(MEDIA_METADATA_UPDATE, media_metadata_params(filename, meta))
+
+def get_media_metadata(filename):
+	"""Stored probe results for an upload (display width/height), or None."""
+	with db_conn() as conn:
+		row = conn.execute(
+			"SELECT duration, width, height, codec, audio_codec, rotation FROM videos WHERE filename = ?",
+			(filename,)
+		).fetchone()
+	if not row:
+		return None
+	return dict(zip(["duration", "width", "height", "codec", "audio_codec", "rotation"], row))
+
+def set_hls_renditions(filename, heights):
+	with db_conn() as conn:
+		conn.execute(
+			"UPDATE videos SET hls_renditions = ? WHERE filename = ?",
+			(",".join(str(h) for h in heights) if heights else None, filename)
+		)
+
+LIST_USER_UPLOADS_SQL = hot_query("list_user_uploads", "SELECT filename, caption, timestamp, date_taken FROM videos WHERE username=?")
 
 def list_user_uploads(username):
-	conn = sqlite3.connect(DB_PATH)
-	c = conn.cursor()
-	c.execute("SELECT filename, caption, timestamp, date_taken FROM videos WHERE username=?", (username,))
-	rows = c.fetchall()
-	conn.close()
+	with db_conn() as conn:
+		rows = conn.execute(LIST_USER_UPLOADS_SQL, (username,)).fetchall()
 	return [
 		{
 			"filename": r[0],
@@ -275,3 +659,29 @@ def list_user_uploads(username):
 		}
 		for r in rows
 	]
+
+def main(argv=None) -> int:
+	parser = argparse.ArgumentParser(prog="python -m modules.database")
+	parser.add_argument(
+		"--audit", action="store_true",
+		help="check every hot query's plan on a fresh schema; exits 1 if any scans or sorts"
+	)
+	args = parser.parse_args(argv)
+	if not args.audit:
+		parser.error("nothing to do (try --audit)")
+
+	# Statements register themselves as their modules are imported
+	import modules.albums, modules.edit, modules.queue  # noqa: F401
+	report = audit_fresh_schema()
+	failed = [name for name, entry in report.items() if not entry["ok"]]
+	for name in failed:
+		print(f"[DB Audit] ❌ {name}:")
+		for step in report[name]["plan"]:
+			print(f"    {step}")
+	print(f"[DB Audit] {'❌' if failed else '✅'} {len(report) - len(failed)}/{len(report)} hot queries use their indexes")
+	return 1 if failed else 0
+
+if __name__ == "__main__":
+	# Run the package module: the hot query registries live there, not in __main__
+	from modules.database import main
+	sys.exit(main())
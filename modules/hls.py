@@ -0,0 +1,123 @@
+import json, os, shutil, subprocess
+from modules.config import UPLOAD_DIR
+
+# Optional adaptive-bitrate output, written by the "hls" queue job after the
+# MP4 is stored (the MP4 stays the fallback for clients without HLS):
+#   hls_<base>/master.m3u8, hls_<base>/<height>p.m3u8, hls_<base>/<height>p_NNN.ts
+# (height, video bitrate, audio bitrate); rungs taller than the source are skipped
+HLS_LADDER = [
+	(1080, 5000, 128),
+	(720, 2800, 128),
+	(480, 1400, 96),
+	(360, 800, 64),
+]
+HLS_SEGMENT_SECONDS = 4
+MASTER_PLAYLIST = "master.m3u8"
+HLS_MEDIA_TYPES = {
+	".m3u8": "application/vnd.apple.mpegurl",
+	".ts": "video/mp2t",
+}
+# videos.audio_codec for a video without an audio stream (NULL = not probed)
+NO_AUDIO = "none"
+
+def hls_dir_name(filename: str) -> str:
+	return f"hls_{os.path.splitext(filename)[0]}"
+
+def hls_dir(filename: str) -> str:
+	return os.path.join(UPLOAD_DIR, hls_dir_name(filename))
+
+def remove_hls(filename: str):
+	shutil.rmtree(hls_dir(filename), ignore_errors=True)
+
+def stream_layout(meta: dict | None) -> tuple[int | None, bool, bool] | None:
+	"""probe_streams() from stored videos metadata; None if it predates audio_codec."""
+	if not meta or not meta.get("width") or not meta.get("height") or not meta.get("audio_codec"):
+		return None
+	width, height = meta["width"], meta["height"]  # already display dimensions
+	return min(width, height), width < height, meta["audio_codec"] != NO_AUDIO
+
+def probe_streams(path: str) -> tuple[int | None, bool, bool]:
+	"""(short side, portrait as displayed, has audio) of the first video stream."""
+	result = subprocess.run(
+		["ffprobe", "-v", "quiet", "-print_format", "json", "-show_streams", path],
+		capture_output=True, text=True
+	)
+	streams = json.loads(result.stdout or "{}").get("streams", [])
+	video = next((s for s in streams if s.get("codec_type") == "video"), {})
+	has_audio = any(s.get("codec_type") == "audio" for s in streams)
+	width, height = video.get("width"), video.get("height")
+	if not width or not height:
+		return None, False, has_audio
+	rotation = 0
+	for side_data in video.get("side_data_list", []):
+		if "rotation" in side_data:
+			rotation = abs(int(side_data["rotation"])) % 180
+	# ffmpeg applies the rotation before our filters run
+	portrait = (width < height) != (rotation == 90)
+	return min(width, height), portrait, has_audio
+
+def ladder_for(short_side: int | None) -> list:
+	rungs = [rung for rung in HLS_LADDER if short_side and rung[0] <= short_side]
+	if rungs:
+		return rungs
+	# Small sources still get one rendition at their own size
+	_, video_kbps, audio_kbps = HLS_LADDER[-1]
+	height = min(short_side or HLS_LADDER[-1][0], HLS_LADDER[-1][0]) // 2 * 2
+	return [(height, video_kbps, audio_kbps)]
+
+def make_hls(input_path: str, filename: str, meta: dict | None = None) -> list:
+	"""
+	Encode every rung in one ffmpeg run (one decode, split and scaled per
+	rendition) with keyframes aligned to segment boundaries so players can
+	switch between renditions. `meta` is the stored videos metadata; the
+	file is only probed again for rows stored before audio_codec existed.
+	Returns the heights written, tallest first.
+	"""
+	short_side, portrait, has_audio = stream_layout(meta) or probe_streams(input_path)
+	rungs = ladder_for(short_side)
+	out_dir = hls_dir(filename)
+	tmp_dir = f"{out_dir}.tmp"
+	shutil.rmtree(tmp_dir, ignore_errors=True)
+	os.makedirs(tmp_dir)
+
+	n = len(rungs)
+	split = f"[0:v]split={n}" + "".join(f"[v{i}]" for i in range(n))
+	# Rungs are short-side sizes, so portrait videos get the same ladder as landscape
+	scales = [
+		f"[v{i}]scale={h}:-2[v{i}out]" if portrait else f"[v{i}]scale=-2:{h}[v{i}out]"
+		for i, (h, _, _) in enumerate(rungs)
+	]
+	args = ["ffmpeg", "-y", "-i", input_path, "-filter_complex", ";".join([split] + scales)]
+	stream_map = []
+	for i, (height, video_kbps, audio_kbps) in enumerate(rungs):
+		args += [
+			"-map", f"[v{i}out]",
+			f"-c:v:{i}", "libx264", f"-b:v:{i}", f"{video_kbps}k",
+			f"-maxrate:v:{i}", f"{int(video_kbps * 1.07)}k", f"-bufsize:v:{i}", f"{video_kbps * 2}k",
+		]
+		if has_audio:
+			args += ["-map", "0:a:0", f"-c:a:{i}", "aac", f"-b:a:{i}", f"{audio_kbps}k"]
+			stream_map.append(f"v:{i},a:{i},name:{height}p")
+		else:
+			stream_map.append(f"v:{i},name:{height}p")
+	args += [
+		"-preset", "veryfast", "-pix_fmt", "yuv420p",
+		"-force_key_frames", f"expr:gte(t,n_forced*{HLS_SEGMENT_SECONDS})", "-sc_threshold", "0",
+		"-f", "hls",
+		"-hls_time", str(HLS_SEGMENT_SECONDS),
+		"-hls_playlist_type", "vod",
+		"-hls_segment_filename", os.path.join(tmp_dir, "%v_%03d.ts"),
+		"-master_pl_name", MASTER_PLAYLIST,
+		"-var_stream_map", " ".join(stream_map),
+		os.path.join(tmp_dir, "%v.m3u8"),
+	]
+
+	try:
+		subprocess.run(args, check=True, capture_output=True)
+	except Exception:
+		shutil.rmtree(tmp_dir, ignore_errors=True)
+		raise
+	# Swap in complete output only, so a player never sees a partial ladder
+	remove_hls(filename)
+	os.replace(tmp_dir, out_dir)
+	return [height for height, _, _ in rungs]
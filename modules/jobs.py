@@ -0,0 +1,292 @@
+import multiprocessing, os, threading, time, traceback
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, wait
+from modules.database import db_conn, MEDIA_METADATA_UPDATE, media_metadata_params
+from modules.uploads import normalize_upload, backfill_preview, backfill_metadata, backfill_hash
+
+# Long-running maintenance work runs here instead of at startup or inside a
+# request. A job walks its rows in rowid order, a batch at a time; after each
+# batch the results and the last rowid (the checkpoint) are committed in one
+# transaction, so a restart resumes where the previous run stopped.
+# Admins request, watch and cancel jobs under /admin/jobs; the web process
+# only inserts a 'pending' row, and the job runner in the queue worker
+# process (python -m modules.queue worker) picks it up.
+JOB_WORKERS = int(os.getenv("JOB_WORKERS", max(1, (os.cpu_count() or 2) // 2)))
+JOB_BATCH_SIZE = 32
+JOB_HEARTBEAT = 15  # seconds between updated_at touches while a batch runs
+# A 'running' job whose heartbeat is older than this lost its process
+JOB_STALE_AFTER = 120
+JOB_POLL_INTERVAL = 10  # seconds between job runner checks for requested jobs
+
+class JobKind:
+	"""
+	select(conn, checkpoint, limit) -> [(rowid, args), ...] after checkpoint
+	count(conn, checkpoint)         -> rows left to do
+	process(*args)                  -> result or None; runs on the worker pool
+	apply(conn, results)            -> store the non-None results of a batch
+	incremental: new jobs start from the last finished job's checkpoint
+	instead of 0 (for work that only ever needs doing once per row).
+	processes: run `process` in a process pool. For Pillow and other
+	in-process CPU work; jobs that mostly wait on ffmpeg or disk use threads.
+	"""
+
+	def __init__(self, select, count, process, apply, incremental=False, processes=False):
+		self.select = select
+		self.count = count
+		self.process = process
+		self.apply = apply
+		self.incremental = incremental
+		self.processes = processes
+
+def videos_job(where: str, columns: str):
+	"""select/count over the videos rows matching `where`, in rowid order."""
+	def select(conn, checkpoint, limit):
+		rows = conn.execute(
+			f"SELECT rowid, {columns} FROM videos WHERE rowid > ? AND ({where}) ORDER BY rowid LIMIT ?",
+			(checkpoint, limit)
+		).fetchall()
+		return [(row[0], tuple(row[1:])) for row in rows]
+
+	def count(conn, checkpoint):
+		return conn.execute(
+			f"SELECT COUNT(*) FROM videos WHERE rowid > ? AND ({where})", (checkpoint,)
+		).fetchone()[0]
+
+	return select, count
+
+# Workers return (value, filename) so apply() can hand them to executemany
+def _normalize_apply(conn, results):
+	conn.executemany("UPDATE videos SET filename = ?, conversion = ? WHERE id = ?", results)
+
+def preview_job_item(filename):
+	widths = backfill_preview(filename)
+	return (",".join(str(w) for w in widths), filename) if widths else None
+
+def _previews_apply(conn, results):
+	conn.executemany("UPDATE videos SET thumb_widths = ? WHERE filename = ?", results)
+
+def metadata_job_item(filename, date_taken):
+	meta = backfill_metadata(filename, date_taken)
+	return media_metadata_params(filename, meta) if meta else None
+
+def _dates_apply(conn, results):
+	conn.executemany(MEDIA_METADATA_UPDATE, results)
+
+def hash_job_item(filename):
+	sha256 = backfill_hash(filename)
+	return (sha256, filename) if sha256 else None
+
+def _hashes_apply(conn, results):
+	conn.executemany("UPDATE videos SET sha256 = ? WHERE filename = ?", results)
+
+JOB_KINDS = {
+	# Converts old non-mp4 uploads and fixes preview names; started at boot
+	"normalize": JobKind(*videos_job("1", "id, filename"), normalize_upload, _normalize_apply, incremental=True),
+	# Thumbnail pyramid for rows that don't have one (Pillow: CPU-bound)
+	"previews": JobKind(*videos_job("thumb_widths IS NULL", "filename"), preview_job_item, _previews_apply, processes=True),
+	# Date taken and probe metadata (EXIF parsing in-process, ffprobe for video)
+	"dates": JobKind(
+		*videos_job("date_taken IS NULL OR file_size IS NULL", "filename, date_taken"),
+		metadata_job_item, _dates_apply, processes=True
+	),
+	# SHA-256 for dedup; hashlib releases the GIL, so threads are enough.
+	# Converted rows stay NULL: uploads are matched on the original's hash and
+	# the original is gone, so hashing the MP4 would never match a re-upload.
+	# MP4s converted before `conversion` was recorded can't be told apart and
+	# are hashed as stored.
+	"hashes": JobKind(*videos_job("sha256 IS NULL AND conversion IS NULL", "filename"), hash_job_item, _hashes_apply),
+}
+
+JOB_COLUMNS = [
+	"id", "kind", "status", "checkpoint", "processed", "failed", "total",
+	"created_at", "started_at", "updated_at", "finished_at", "error",
+	"cancel_requested", "started_processed",
+]
+
+def job_dict(row) -> dict:
+	"""Job row plus progress, rate (items/s over the current run) and ETA in seconds."""
+	job = dict(zip(JOB_COLUMNS, row))
+	job["cancel_requested"] = bool(job["cancel_requested"])
+	job["progress"] = round(job["processed"] / job["total"], 4) if job["total"] else None
+	end = job["finished_at"] or int(time.time())
+	done_this_run = job["processed"] - job.pop("started_processed")
+	elapsed = end - job["started_at"] if job["started_at"] else 0
+	job["rate"] = round(done_this_run / elapsed, 2) if elapsed > 0 else None
+	job["eta"] = None
+	if job["status"] == "running" and job["rate"] and job["total"] is not None:
+		job["eta"] = round((job["total"] - job["processed"]) / job["rate"])
+	return job
+
+def get_job(job_id: int) -> dict | None:
+	with db_conn() as conn:
+		row = conn.execute(f"SELECT {', '.join(JOB_COLUMNS)} FROM jobs WHERE id = ?", (job_id,)).fetchone()
+	return job_dict(row) if row else None
+
+def list_jobs(limit: int = 50) -> list:
+	with db_conn() as conn:
+		rows = conn.execute(
+			f"SELECT {', '.join(JOB_COLUMNS)} FROM jobs ORDER BY id DESC LIMIT ?", (limit,)
+		).fetchall()
+	return [job_dict(row) for row in rows]
+
+def request_job(kind: str) -> int | None:
+	"""
+	Queue a job of `kind` for the job runner. Returns its id, or None when
+	one is already pending or running or, for incremental kinds, when there
+	is nothing new to do.
+	"""
+	now = int(time.time())
+	with db_conn() as conn:
+		# Take the write lock before looking, so two processes (or two uvicorn
+		# workers at boot) can't both see no active job and both insert one
+		conn.execute("BEGIN IMMEDIATE")
+		active = conn.execute(
+			"SELECT 1 FROM jobs WHERE kind = ? AND status IN ('pending', 'running') LIMIT 1", (kind,)
+		).fetchone()
+		if active:
+			return None
+
+		checkpoint = 0
+		if JOB_KINDS[kind].incremental:
+			# Cancelled runs committed their checkpoint with their results too
+			last = conn.execute(
+				"SELECT MAX(checkpoint) FROM jobs WHERE kind = ? AND status IN ('done', 'cancelled')", (kind,)
+			).fetchone()[0]
+			checkpoint = last or 0
+			if JOB_KINDS[kind].count(conn, checkpoint) == 0:
+				return None
+
+		cur = conn.execute("""
+			INSERT INTO jobs (kind, status, checkpoint, created_at, updated_at)
+			VALUES (?, 'pending', ?, ?, ?)
+		""", (kind, checkpoint, now, now))
+		return cur.lastrowid
+
+def claim_job(kind: str) -> int | None:
+	"""
+	Pick up the unfinished job of this kind: pending, or running with a stale
+	heartbeat. Returns None when there is none or another process has it.
+	"""
+	now = int(time.time())
+	with db_conn() as conn:
+		claimed = conn.execute("""
+			UPDATE jobs SET status = 'running', started_at = ?, started_processed = processed, updated_at = ?
+			WHERE id = (
+				SELECT id FROM jobs WHERE kind = ? AND status IN ('pending', 'running')
+				ORDER BY id DESC LIMIT 1
+			) AND (status = 'pending' OR updated_at < ?)
+			RETURNING id
+		""", (now, now, kind, now - JOB_STALE_AFTER)).fetchone()
+		return claimed[0] if claimed else None
+
+def _touch(job_id: int):
+	with db_conn() as conn:
+		conn.execute("UPDATE jobs SET updated_at = ? WHERE id = ?", (int(time.time()), job_id))
+
+def _finish(job_id: int, status: str, error: str | None = None):
+	now = int(time.time())
+	with db_conn() as conn:
+		conn.execute(
+			"UPDATE jobs SET status = ?, error = ?, updated_at = ?, finished_at = ? WHERE id = ?",
+			(status, error, now, now, job_id)
+		)
+
+def cancel_job(job_id: int) -> bool:
+	"""Ask a job to stop; it finishes its current batch first."""
+	with db_conn() as conn:
+		cur = conn.execute(
+			"UPDATE jobs SET cancel_requested = 1 WHERE id = ? AND status IN ('pending', 'running')",
+			(job_id,)
+		)
+		return cur.rowcount == 1
+
+def _cancel_requested(job_id: int) -> bool:
+	with db_conn() as conn:
+		return bool(conn.execute("SELECT cancel_requested FROM jobs WHERE id = ?", (job_id,)).fetchone()[0])
+
+def _make_pool(kind: JobKind, job_id: int):
+	if kind.processes:
+		# spawn, not fork: the web process has threads holding locks and sqlite handles
+		return ProcessPoolExecutor(max_workers=JOB_WORKERS, mp_context=multiprocessing.get_context("spawn"))
+	return ThreadPoolExecutor(max_workers=JOB_WORKERS, thread_name_prefix=f"job-{job_id}")
+
+def _process_one(process, args):
+	try:
+		return True, process(*args)
+	except Exception as e:
+		print(f"[Jobs] ❌ {args}: {e}")
+		return False, None
+
+def run_job(job_id: int):
+	job = get_job(job_id)
+	kind = JOB_KINDS[job["kind"]]
+	checkpoint = job["checkpoint"]
+	print(f"[Jobs] ▶️ {job['kind']} #{job_id} from checkpoint {checkpoint}")
+	try:
+		with db_conn() as conn:
+			remaining = kind.count(conn, checkpoint)
+			conn.execute("UPDATE jobs SET total = processed + ? WHERE id = ?", (remaining, job_id))
+
+		with _make_pool(kind, job_id) as pool:
+			while True:
+				if _cancel_requested(job_id):
+					_finish(job_id, "cancelled")
+					print(f"[Jobs] ⏹ {job['kind']} #{job_id} cancelled at checkpoint {checkpoint}")
+					return
+				with db_conn() as conn:
+					batch = kind.select(conn, checkpoint, JOB_BATCH_SIZE)
+				if not batch:
+					break
+
+				futures = [pool.submit(_process_one, kind.process, args) for _, args in batch]
+				pending = futures
+				while pending:
+					_, pending = wait(pending, timeout=JOB_HEARTBEAT)
+					if pending:
+						_touch(job_id)
+
+				outcomes = [f.result() for f in futures]
+				results = [result for ok, result in outcomes if ok and result is not None]
+				failed = sum(1 for ok, _ in outcomes if not ok)
+				checkpoint = batch[-1][0]
+				with db_conn() as conn:
+					if results:
+						kind.apply(conn, results)
+					conn.execute("""
+						UPDATE jobs SET checkpoint = ?, processed = processed + ?, failed = failed + ?, updated_at = ?
+						WHERE id = ?
+					""", (checkpoint, len(batch), failed, int(time.time()), job_id))
+
+		_finish(job_id, "done")
+		print(f"[Jobs] ✅ {job['kind']} #{job_id} finished")
+	except Exception as e:
+		traceback.print_exc()
+		_finish(job_id, "failed", str(e))
+
+def start_job(kind: str) -> int | None:
+	"""Claim and run a job of `kind` on a background thread. Returns its id."""
+	job_id = claim_job(kind)
+	if job_id is not None:
+		threading.Thread(target=run_job, args=(job_id,), name=f"job-{kind}", daemon=True).start()
+	return job_id
+
+def run_jobs_loop():
+	"""
+	Job runner, started with the queue workers. Requests a normalize pass,
+	then keeps starting requested jobs and taking over ones whose process
+	died (stale heartbeat). Claims are atomic, so any number of worker
+	processes can run this.
+	"""
+	request_job("normalize")
+	while True:
+		try:
+			with db_conn() as conn:
+				kinds = [row[0] for row in conn.execute(
+					"SELECT DISTINCT kind FROM jobs WHERE status IN ('pending', 'running')"
+				)]
+			for kind in kinds:
+				if kind in JOB_KINDS:
+					start_job(kind)
+		except Exception:
+			print("[Jobs] ❌ Job runner error")
+			traceback.print_exc()
+		time.sleep(JOB_POLL_INTERVAL)
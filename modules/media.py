@@ -0,0 +1,213 @@
+import base64, hashlib, hmac, mimetypes, os, stat, threading, time
+from collections import OrderedDict
+from email.utils import formatdate, parsedate_to_datetime
+from fastapi import HTTPException, Request
+from fastapi.responses import FileResponse, Response, StreamingResponse
+from modules.config import SECRET_KEY, SIGNED_URL_TTL, MEDIA_OFFLOAD, MEDIA_ACCEL_PREFIX
+
+# Uploads and previews are named by UUID and never rewritten, so clients may
+# cache them forever. Avatars are overwritten in place and must revalidate.
+IMMUTABLE_CACHE_CONTROL = "private, max-age=31536000, immutable"
+REVALIDATE_CACHE_CONTROL = "private, max-age=300, must-revalidate"
+
+STAT_CACHE_SIZE = 4096
+MUTABLE_STAT_TTL = 5  # seconds
+# "Immutable" names can still be rewritten (HLS re-encode) or deleted by
+# another process, so these entries expire too, just later
+IMMUTABLE_STAT_TTL = 60
+RANGE_CHUNK_SIZE = 256 * 1024
+
+_stat_cache = OrderedDict()
+_stat_lock = threading.Lock()
+
+def cached_stat(path: str, immutable: bool, fresh: bool = False) -> os.stat_result | None:
+	"""
+	os.stat with an LRU in front. Entries are re-statted after
+	IMMUTABLE_STAT_TTL or MUTABLE_STAT_TTL; fresh=True always re-stats
+	(and refreshes the entry).
+	"""
+	now = time.monotonic()
+	ttl = IMMUTABLE_STAT_TTL if immutable else MUTABLE_STAT_TTL
+	with _stat_lock:
+		entry = _stat_cache.get(path)
+		if entry and not fresh and now - entry[1] < ttl:
+			_stat_cache.move_to_end(path)
+			return entry[0]
+
+	try:
+		st = os.stat(path)
+	except (FileNotFoundError, NotADirectoryError):
+		st = None
+	if st is not None and not stat.S_ISREG(st.st_mode):
+		st = None
+
+	# Misses aren't cached: the file may be about to appear (queue output)
+	if st is None:
+		forget_stat(path)
+	else:
+		with _stat_lock:
+			_stat_cache[path] = (st, now)
+			_stat_cache.move_to_end(path)
+			while len(_stat_cache) > STAT_CACHE_SIZE:
+				_stat_cache.popitem(last=False)
+	return st
+
+def forget_stat(path: str):
+	with _stat_lock:
+		_stat_cache.pop(path, None)
+
+def make_etag(st: os.stat_result) -> str:
+	return f'"{st.st_size:x}-{st.st_mtime_ns:x}"'
+
+def not_modified(request: Request, etag: str, st: os.stat_result) -> bool:
+	if_none_match = request.headers.get("if-none-match")
+	if if_none_match is not None:
+		tags = [t.strip() for t in if_none_match.split(",")]
+		return "*" in tags or etag in tags or f"W/{etag}" in tags
+	if_modified_since = request.headers.get("if-modified-since")
+	if if_modified_since:
+		try:
+			return int(st.st_mtime) <= parsedate_to_datetime(if_modified_since).timestamp()
+		except (TypeError, ValueError):
+			return False
+	return False
+
+def parse_range(header: str, size: int) -> tuple[int, int] | None:
+	"""
+	Parse a single 'bytes=' range into inclusive (start, end). Returns None
+	for anything we answer with the full body (multi-range, other units).
+	Raises 416 when the range can't be satisfied.
+	"""
+	unit, _, spec = header.partition("=")
+	if unit.strip().lower() != "bytes" or "," in spec:
+		return None
+	start_s, _, end_s = spec.strip().partition("-")
+	try:
+		if start_s:
+			start = int(start_s)
+			end = int(end_s) if end_s else size - 1
+		else:
+			# Suffix range: last N bytes
+			start = max(0, size - int(end_s))
+			end = size - 1
+	except ValueError:
+		return None
+	end = min(end, size - 1)
+	if start > end or start >= size:
+		raise HTTPException(
+			status_code=416,
+			detail="Range not satisfiable",
+			headers={"Content-Range": f"bytes */{size}"},
+		)
+	return start, end
+
+def iter_file_range(path: str, start: int, end: int):
+	with open(path, "rb") as f:
+		f.seek(start)
+		remaining = end - start + 1
+		while remaining > 0:
+			chunk = f.read(min(RANGE_CHUNK_SIZE, remaining))
+			if not chunk:
+				break
+			remaining -= len(chunk)
+			yield chunk
+
+def serve_file(request: Request, path: str, immutable: bool, media_type: str | None = None) -> Response:
+	"""FileResponse with cache headers, conditional GET (304) and byte ranges (206)."""
+	st = cached_stat(path, immutable)
+	if st is None:
+		raise HTTPException(status_code=404, detail="Media not found")
+
+	etag = make_etag(st)
+	headers = {
+		"Cache-Control": IMMUTABLE_CACHE_CONTROL if immutable else REVALIDATE_CACHE_CONTROL,
+		"ETag": etag,
+		"Last-Modified": formatdate(st.st_mtime, usegmt=True),
+		"Accept-Ranges": "bytes",
+	}
+
+	if not_modified(request, etag, st):
+		return Response(status_code=304, headers=headers)
+
+	# The cached entry is enough for a 304, but a body's Content-Length must
+	# match the file as it is now
+	st = cached_stat(path, immutable, fresh=True)
+	if st is None:
+		raise HTTPException(status_code=404, detail="Media not found")
+	etag = make_etag(st)
+	headers["ETag"] = etag
+	headers["Last-Modified"] = formatdate(st.st_mtime, usegmt=True)
+
+	range_header = request.headers.get("range")
+	if_range = request.headers.get("if-range")
+	if range_header and (if_range is None or if_range == etag):
+		byte_range = parse_range(range_header, st.st_size)
+		if byte_range:
+			start, end = byte_range
+			headers["Content-Range"] = f"bytes {start}-{end}/{st.st_size}"
+			headers["Content-Length"] = str(end - start + 1)
+			return StreamingResponse(
+				iter_file_range(path, start, end),
+				status_code=206,
+				media_type=media_type or mimetypes.guess_type(path)[0] or "application/octet-stream",
+				headers=headers,
+			)
+
+	return FileResponse(path, media_type=media_type, stat_result=st, headers=headers)
+
+# -------------------- Signed URLs --------------------
+# A token is "<exp>.<sig>" with sig = HMAC-SHA256(key, "<base>:<exp>"), where
+# base is the upload's UUID, so one token covers the original and every
+# preview variant. Checking it is pure CPU: no JWT, no database.
+SIGNED_URL_BUCKET = 3600  # expiry rounded up so URLs stay cacheable for an hour
+_url_key = hmac.new(SECRET_KEY.encode(), b"petalframe-media-url", hashlib.sha256).digest()
+
+def media_base(filename: str) -> str:
+	"""preview_<uuid>_640.webp, preview_<uuid>.jpg and <uuid>.mp4 all map to <uuid>."""
+	name = os.path.splitext(filename)[0]
+	if name.startswith("preview_"):
+		name = name[len("preview_"):]
+		head, _, tail = name.rpartition("_")
+		if head and tail.isdigit():
+			name = head
+	return name
+
+def _signature(base: str, exp: int) -> str:
+	digest = hmac.new(_url_key, f"{base}:{exp}".encode(), hashlib.sha256).digest()
+	return base64.urlsafe_b64encode(digest[:18]).decode()
+
+def sign_media(filename: str) -> str:
+	exp = (int(time.time()) + SIGNED_URL_TTL) // SIGNED_URL_BUCKET * SIGNED_URL_BUCKET + SIGNED_URL_BUCKET
+	return f"{exp}.{_signature(media_base(filename), exp)}"
+
+def verify_media_token(filename: str, token: str) -> bool:
+	exp_s, _, sig = token.partition(".")
+	if not exp_s.isdigit() or int(exp_s) < time.time():
+		return False
+	return hmac.compare_digest(sig, _signature(media_base(filename), int(exp_s)))
+
+def media_links(filename: str, hls_renditions: str | None = None) -> dict:
+	"""
+	Signed URLs for an item; thumbnails reuse media_token as ?t=. HLS puts
+	the token in the path instead, so the relative segment URLs inside the
+	playlists carry it too. hls_url is None until the ladder exists.
+	"""
+	token = sign_media(filename)
+	base = os.path.splitext(filename)[0]
+	return {
+		"media_token": token,
+		"url": f"/m/{filename}?t={token}",
+		"preview_url": f"/m/preview_{base}.jpg?t={token}",
+		"hls_url": f"/m/hls/{token}/{base}/master.m3u8" if hls_renditions else None,
+	}
+
+def offload_response(path: str, filename: str) -> Response | None:
+	"""Let nginx/Apache send the bytes when MEDIA_OFFLOAD is configured."""
+	headers = {"Cache-Control": IMMUTABLE_CACHE_CONTROL}
+	if MEDIA_OFFLOAD == "x-accel":
+		headers["X-Accel-Redirect"] = f"{MEDIA_ACCEL_PREFIX}{filename}"
+	elif MEDIA_OFFLOAD == "x-sendfile":
+		headers["X-Sendfile"] = os.path.abspath(path)
+	else:
+		return None
+	return Response(headers=headers, media_type=mimetypes.guess_type(path)[0])
@@ -0,0 +1,85 @@
+import atexit, os, socket, threading
+from modules.config import BASE_DATA_DIR
+
+# Each process running queue workers binds a datagram socket in this
+# directory; enqueue_upload pokes every socket it finds. Works across
+# containers that share the data volume on one host (sockets are named by
+# hostname and pid, since every container's main process is pid 1).
+# Workers still poll as a fallback (e.g. workers on another host).
+NOTIFY_DIR = os.path.abspath(os.path.join(BASE_DATA_DIR, "queue_notify"))
+HAS_UNIX_SOCKETS = hasattr(socket, "AF_UNIX")
+
+# In-process wakeup: one token per notification, so a notify that lands
+# while every worker is busy is still seen by the next one to go idle.
+_wakeup = threading.Semaphore(0)
+_listener_started = False
+_listener_lock = threading.Lock()
+
+def _own_socket_path() -> str:
+	return os.path.join(NOTIFY_DIR, f"{socket.gethostname()}-{os.getpid()}.sock")
+
+def notify_workers():
+	"""Wake queue workers in this process and in any other local process."""
+	_wakeup.release()
+	if not HAS_UNIX_SOCKETS or not os.path.isdir(NOTIFY_DIR):
+		return
+
+	own = _own_socket_path()
+	sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+	sock.setblocking(False)
+	try:
+		for name in os.listdir(NOTIFY_DIR):
+			path = os.path.join(NOTIFY_DIR, name)
+			if path == own or not name.endswith(".sock"):
+				continue
+			try:
+				sock.sendto(b"1", path)
+			except ConnectionRefusedError:
+				# Nobody listening: the worker process is gone
+				_remove_socket(path)
+			except (BlockingIOError, FileNotFoundError):
+				# Buffer full means it is already awake; vanished means it exited
+				pass
+	finally:
+		sock.close()
+
+def wake_local(count: int = 1):
+	"""Wake up to `count` idle workers in this process only."""
+	for _ in range(count):
+		_wakeup.release()
+
+def wait_for_work(timeout: float) -> bool:
+	"""Block until notified or `timeout` seconds pass. True if notified."""
+	return _wakeup.acquire(timeout=timeout)
+
+def _listen(sock: socket.socket):
+	while True:
+		try:
+			sock.recv(64)
+		except OSError:
+			return
+		_wakeup.release()
+
+def _remove_socket(path: str):
+	try:
+		os.unlink(path)
+	except OSError:
+		pass
+
+def start_listener():
+	"""Accept wakeups from other processes (called once by the worker side)."""
+	global _listener_started
+	if not HAS_UNIX_SOCKETS:
+		return
+	with _listener_lock:
+		if _listener_started:
+			return
+		os.makedirs(NOTIFY_DIR, exist_ok=True)
+		path = _own_socket_path()
+		if os.path.exists(path):
+			os.unlink(path)
+		sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+		sock.bind(path)
+		atexit.register(_remove_socket, path)
+		threading.Thread(target=_listen, args=(sock,), name="queue-notify", daemon=True).start()
+		_listener_started = True
@@ -1,97 +1,290 @@
-import os, shutil, sqlite3, time, traceback
-from datetime import datetime
-from modules.uploads import convert_to_mp4, generate_preview, insert_into_album
-from modules.database import track_upload
-from modules.auth import decode_token
-from modules.config import UPLOAD_DIR, QUEUE_DB_PATH
+import argparse, os, shutil, signal, socket, sqlite3, threading, time, traceback
+from contextlib import contextmanager
+from modules.uploads import (
+	convert_to_mp4, generate_preview, insert_into_album, probe_media, process_ingest_job, process_hls_job,
+	enqueue_hls, JOB_INGEST, JOB_HLS
+)
+from modules.database import (
+	track_upload, update_media_metadata, queue_conn, db_conn, hot_query, QUEUE_HOT_QUERIES,
+	init_db, init_upload_queue_db, upgrade_main_db, upgrade_queue_db
+)
+from modules.notify import notify_workers, start_listener, wait_for_work, wake_local
+from modules.auth import get_current_user
+from modules.config import UPLOAD_DIR, UPLOAD_STAGING_DIR
+from modules.thumbnails import thumbnail_files
+from modules.hls import hls_dir
+from modules.jobs import run_jobs_loop
 
-POLL_INTERVAL = 5  # seconds
+# Workers are woken by enqueue_upload; polling only catches missed wakeups
+POLL_INTERVAL = 30  # seconds
+# ffmpeg does the heavy lifting in a subprocess, so plain threads scale fine
+QUEUE_WORKERS = int(os.getenv("QUEUE_WORKERS", max(1, (os.cpu_count() or 2) // 2)))
+MAX_RETRIES = 3
 
-def convert_and_track(username: str, tmp_path: str, final_name: str, caption: str, album_id: str = ""):
+# A claimed row is leased to one worker. The worker renews the lease every
+# HEARTBEAT_INTERVAL while it runs; if the process dies the lease runs out
+# and the reaper puts the row back to 'pending' for someone else.
+LEASE_SECONDS = 120
+HEARTBEAT_INTERVAL = 30
+REAP_INTERVAL = 60
+# Staged uploads no queue row points at (e.g. the web process died between
+# staging and enqueueing) are removed once they are this old
+ORPHAN_STAGING_AGE = 24 * 3600
+
+def current_worker_id() -> str:
+	return f"{socket.gethostname()}:{os.getpid()}:{threading.current_thread().name}"
+
+def convert_and_track(username: str, tmp_path: str, final_name: str, caption: str, album_id: str = "", sha256: str | None = None):
+	"""
+	Convert a staged upload and track the result. Errors propagate so the
+	queue retries or fails the row; the staged original stays until the row
+	is deleted (see finish_job). A retry after the upload was tracked only
+	redoes the steps that follow tracking.
+	"""
 	output_path = os.path.join(UPLOAD_DIR, final_name)
 	preview_name = f"preview_{final_name}"
 	preview_path = os.path.join(UPLOAD_DIR, preview_name)
+	if not is_tracked(final_name):
+		conversion = convert_to_mp4(tmp_path, output_path)
+		thumb_widths = generate_preview(output_path, preview_path, is_video=True)
+		meta = probe_media(output_path)
+		meta["thumb_widths"] = thumb_widths
+		meta["conversion"] = conversion
+		with db_conn():
+			# One transaction: the upload shows up with its metadata or not at all
+			# The hash is of the original upload, so a re-upload of the same source matches
+			track_upload(username, final_name, caption, sha256=sha256)
+			update_media_metadata(final_name, meta)
+	insert_into_album(album_id, final_name)
+	enqueue_hls(username, final_name, caption)
+
+def finish_job(job_id: int, owner: str, job_type: str, original_path: str):
+	"""Delete a finished row if `owner` still holds it, then a convert job's staged original."""
+	with queue_conn() as conn:
+		# A reaped and re-claimed row belongs to someone else now
+		done = conn.execute("DELETE FROM upload_queue WHERE id = ? AND worker_id = ?", (job_id, owner)).rowcount
+	# Ingest and HLS rows point at the stored media itself
+	if done and job_type not in (JOB_INGEST, JOB_HLS):
+		try:
+			os.remove(original_path)
+		except FileNotFoundError:
+			pass
+	return done
+
+# Fair order: lowest pending priority class, then the user in it who was
+# served longest ago (queue_users.last_claimed_at), then that user's oldest
+# job. One user's 500-video dump therefore only gets every Nth slot while
+# others are waiting. The walk over queue_users stops at the first user
+# with pending work, so it is bounded by the number of users, not the
+# backlog; the rest are index lookups (see QUEUE_DB_INDEXES).
+BEST_PRIORITY_SQL = "SELECT MIN(priority) FROM upload_queue WHERE status = 'pending'"
+CLAIM_NEXT_SQL = hot_query("claim_next", f"""
+			UPDATE upload_queue SET status = 'processing', worker_id = ?, lease_expires_at = ?
+			WHERE id = (
+				SELECT id FROM upload_queue
+				WHERE username = (
+					SELECT username FROM queue_users
+					WHERE EXISTS (
+						SELECT 1 FROM upload_queue
+						WHERE upload_queue.username = queue_users.username
+							AND status = 'pending' AND priority = ({BEST_PRIORITY_SQL})
+					)
+					ORDER BY last_claimed_at LIMIT 1
+				) AND status = 'pending' AND priority = ({BEST_PRIORITY_SQL})
+				ORDER BY created_at ASC
+				LIMIT 1
+			) AND status = 'pending'
+			RETURNING id, username, original_path, final_name, caption, is_video, retry_count, album_id, job_type, sha256
+		""", QUEUE_HOT_QUERIES, limit_bounded=True)
+
+def claim_next():
+	"""
+	Claim the next job fairly (see CLAIM_NEXT_SQL) and move its user to the
+	back of the line. The UPDATE ... RETURNING runs under SQLite's write
+	lock, so two workers can never claim the same row. The row comes back
+	leased to this worker.
+	"""
+	me = current_worker_id()
+	with queue_conn() as conn:
+		row = conn.execute(CLAIM_NEXT_SQL, (me, time.time() + LEASE_SECONDS)).fetchone()
+		if row:
+			conn.execute("UPDATE queue_users SET last_claimed_at = ? WHERE username = ?", (time.time(), row[1]))
+	return row
+
+@contextmanager
+def lease_heartbeat(job_id: int, owner: str):
+	"""Keep renewing the lease on `job_id` until the block exits."""
+	stop = threading.Event()
+
+	def renew():
+		while not stop.wait(HEARTBEAT_INTERVAL):
+			try:
+				with queue_conn() as conn:
+					renewed = conn.execute(
+						"UPDATE upload_queue SET lease_expires_at = ? WHERE id = ? AND worker_id = ?",
+						(time.time() + LEASE_SECONDS, job_id, owner)
+					).rowcount
+			except sqlite3.Error as e:
+				# e.g. locked past the busy timeout; the lease outlasts a few missed beats
+				print(f"[Queue] ⚠️ Lease renewal for job {job_id} failed, retrying: {e}")
+				continue
+			if not renewed:
+				print(f"[Queue] ⚠️ Lost lease on job {job_id}")
+				return
+
+	thread = threading.Thread(target=renew, name=f"lease-{job_id}", daemon=True)
+	thread.start()
 	try:
-		convert_to_mp4(tmp_path, output_path)
-		generate_preview(output_path, preview_path, is_video=True)
-		track_upload(username, final_name, caption)
-		insert_into_album(album_id, final_name)
-	except Exception as e:
-		print(f"[FFMPEG ERROR] {final_name}: {e}")
+		yield
 	finally:
-		os.unlink(tmp_path)
+		stop.set()
+		thread.join()
 
-def process_next():
-	conn = sqlite3.connect(QUEUE_DB_PATH)
-	c = conn.cursor()
-
-	c.execute("""
-		SELECT id, username, original_path, final_name, caption, is_video, retry_count, album_id
-		FROM upload_queue
-		WHERE status = 'pending'
-		ORDER BY created_at ASC
-		LIMIT 1
-	""")
-	row = c.fetchone()
+def retry_or_fail(conn, job_id: int, retry_count: int, owner: str):
+	"""Back to 'pending' with one more retry used, or 'failed' after MAX_RETRIES (if `owner` still holds it)."""
+	if retry_count >= MAX_RETRIES:
+		conn.execute(
+			"UPDATE upload_queue SET status = 'failed', worker_id = NULL, lease_expires_at = NULL WHERE id = ? AND worker_id = ?",
+			(job_id, owner)
+		)
+	else:
+		conn.execute(
+			"UPDATE upload_queue SET status = 'pending', retry_count = ?, worker_id = NULL, lease_expires_at = NULL WHERE id = ? AND worker_id = ?",
+			(retry_count + 1, job_id, owner)
+		)
 
+def process_next():
+	row = claim_next()
 	if not row:
-		conn.close()
-		time.sleep(1)
 		return False
 
-	id, username, path, final_name, caption, is_video, retry_count, album_id = row
-
-	c.execute("UPDATE upload_queue SET status = 'processing' WHERE id = ?", (id,))
-	conn.commit()
-	conn.close()
+	id, username, path, final_name, caption, is_video, retry_count, album_id, job_type, sha256 = row
+	me = current_worker_id()
 
 	try:
-		convert_and_track(username, path, final_name, caption, album_id)
-		conn = sqlite3.connect(QUEUE_DB_PATH)
-		c = conn.cursor()
-		c.execute("DELETE FROM upload_queue WHERE id = ?", (id,))
-		conn.commit()
-		conn.close()
+		with lease_heartbeat(id, me):
+			if job_type == JOB_INGEST:
+				process_ingest_job(username, final_name, bool(is_video), album_id, caption)
+			elif job_type == JOB_HLS:
+				process_hls_job(final_name)
+			else:
+				convert_and_track(username, path, final_name, caption, album_id, sha256)
+		finish_job(id, me, job_type, path)
 		print(f"[Queue] ✅ Processed {final_name}")
 	except Exception as e:
 		print(f"[Queue] ❌ Failed {final_name}: {e}")
-		conn = sqlite3.connect(QUEUE_DB_PATH)
-		c = conn.cursor()
-		if retry_count >= 3:
-			c.execute("UPDATE upload_queue SET status = 'failed' WHERE id = ?", (id,))
-		else:
-			c.execute("UPDATE upload_queue SET status = 'pending', retry_count = ? WHERE id = ?", (retry_count + 1, id))
-		conn.commit()
-		conn.close()
+		with queue_conn() as conn:
+			owned = conn.execute("SELECT 1 FROM upload_queue WHERE id = ? AND worker_id = ?", (id, me)).fetchone()
+		if owned:
+			clean_partial_output(job_type, final_name)
+		with queue_conn() as conn:
+			retry_or_fail(conn, id, retry_count, me)
 
 	return True
 
+# -------------------- Recovery --------------------
+def is_tracked(filename: str) -> bool:
+	with db_conn() as conn:
+		return conn.execute("SELECT 1 FROM videos WHERE filename = ?", (filename,)).fetchone() is not None
+
+def clean_partial_output(job_type: str, final_name: str):
+	"""Remove what a dead worker may have half-written for this job."""
+	if job_type == JOB_HLS:
+		shutil.rmtree(f"{hls_dir(final_name)}.tmp", ignore_errors=True)
+	elif job_type != JOB_INGEST and not is_tracked(final_name):
+		# convert: the MP4 and previews only count once the row is tracked
+		for name in [final_name, *thumbnail_files(final_name)]:
+			path = os.path.join(UPLOAD_DIR, name)
+			if os.path.exists(path):
+				os.remove(path)
+
+EXPIRED_LEASES_SQL = hot_query("expired_leases", """
+			SELECT id, final_name, job_type, retry_count, worker_id FROM upload_queue
+			WHERE status = 'processing' AND (lease_expires_at IS NULL OR lease_expires_at < ?)
+		""", QUEUE_HOT_QUERIES)
+
+def reap_expired_leases() -> int:
+	"""
+	Re-queue 'processing' rows whose lease expired (worker crashed or the
+	container restarted mid-ffmpeg) after cleaning their partial output.
+	Rows from before leases existed have no expiry and are reaped too.
+	The reaper takes the lease over first, so a worker that renews late
+	loses the row (its own updates are conditional on owning it) and the
+	cleanup can't race a new claim.
+	"""
+	now = time.time()
+	me = current_worker_id()
+	with queue_conn() as conn:
+		rows = conn.execute(EXPIRED_LEASES_SQL, (now,)).fetchall()
+
+	reaped = 0
+	for job_id, final_name, job_type, retry_count, owner in rows:
+		with queue_conn() as conn:
+			# The owner may have renewed since the SELECT
+			taken = conn.execute("""
+				UPDATE upload_queue SET worker_id = ?, lease_expires_at = ?
+				WHERE id = ? AND status = 'processing'
+				AND (lease_expires_at IS NULL OR lease_expires_at < ?)
+			""", (me, time.time() + LEASE_SECONDS, job_id, now)).rowcount
+		if not taken:
+			continue
+
+		# A convert that got as far as tracking keeps its output; the next claim
+		# resumes after tracking (see convert_and_track)
+		clean_partial_output(job_type, final_name)
+		with queue_conn() as conn:
+			retry_or_fail(conn, job_id, retry_count, me)
+		reaped += 1
+		print(f"[Queue] ♻️ Reaped job {job_id} ({final_name}) from {owner or 'unknown worker'}")
+	return reaped
+
+def sweep_orphaned_staging(max_age: int = ORPHAN_STAGING_AGE) -> int:
+	"""Delete staged uploads older than max_age that no queue row references."""
+	with queue_conn() as conn:
+		referenced = {row[0] for row in conn.execute("SELECT original_path FROM upload_queue")}
+	cutoff = time.time() - max_age
+	removed = 0
+	for name in os.listdir(UPLOAD_STAGING_DIR):
+		path = os.path.join(UPLOAD_STAGING_DIR, name)
+		# .part files belong to resumable upload sessions, which clean up themselves
+		if name.endswith(".part") or path in referenced:
+			continue
+		try:
+			if os.path.getmtime(path) < cutoff:
+				os.remove(path)
+				removed += 1
+		except FileNotFoundError:
+			pass
+	if removed:
+		print(f"[Queue] 🧹 Removed {removed} orphaned staged uploads")
+	return removed
+
+def reaper_loop():
+	while True:
+		try:
+			if reap_expired_leases():
+				notify_workers()
+			sweep_orphaned_staging()
+		except Exception:
+			print("[Queue] ❌ Reaper error")
+			traceback.print_exc()
+		time.sleep(REAP_INTERVAL)
+
 
 # FastAPI routes
 from fastapi import APIRouter, Depends, Form, HTTPException
-from fastapi.security import OAuth2PasswordBearer
 
-oauth2_scheme = OAuth2PasswordBearer(tokenUrl="login")
 router = APIRouter()
 
-def get_current_user(token: str = Depends(oauth2_scheme)):
-	username = decode_token(token)
-	if not username:
-		raise HTTPException(status_code=401, detail="Invalid token")
-	return username
-
 @router.get("/queue/status")
 def queue_status(username: str = Depends(get_current_user)):
-	conn = sqlite3.connect(QUEUE_DB_PATH)
-	c = conn.cursor()
-	c.execute("""
-		SELECT id, final_name, caption, status, retry_count, created_at
-		FROM upload_queue
-		WHERE username = ?
-		ORDER BY created_at ASC
-	""", (username,))
-	rows = c.fetchall()
-	conn.close()
+	with queue_conn() as conn:
+		rows = conn.execute("""
+			SELECT id, final_name, caption, status, retry_count, created_at, job_type, priority
+			FROM upload_queue
+			WHERE username = ?
+			ORDER BY created_at ASC
+		""", (username,)).fetchall()
 	return [
 		{
 			"id": r[0],
@@ -100,65 +293,62 @@ def queue_status(username: str = Depends(get_current_user)):
 			"status": r[3],
 			"retry_count": r[4],
 			"created_at": r[5],
+			"job_type": r[6],
+			"priority": r[7],
 		} for r in rows
 	]
 
 @router.post("/queue/cancel")
 def cancel_upload(id: int = Form(...), username: str = Depends(get_current_user)):
-	conn = sqlite3.connect(QUEUE_DB_PATH)
-	c = conn.cursor()
-	c.execute("SELECT username, status, original_path FROM upload_queue WHERE id = ?", (id,))
-	row = c.fetchone()
-	if not row or row[0] != username:
-		conn.close()
-		raise HTTPException(status_code=404, detail="Upload not found")
+	with queue_conn() as conn:
+		c = conn.cursor()
+		c.execute("SELECT username, status, original_path, job_type, lease_expires_at, final_name FROM upload_queue WHERE id = ?", (id,))
+		row = c.fetchone()
+		if not row or row[0] != username:
+			raise HTTPException(status_code=404, detail="Upload not found")
+		# A processing row whose lease ran out has no live worker behind it
+		if row[1] == "processing" and (row[4] or 0) > time.time():
+			raise HTTPException(status_code=400, detail="Cannot cancel in-progress upload")
+		if row[3] == JOB_INGEST:
+			# original_path is the stored media itself, not a temp file
+			raise HTTPException(status_code=400, detail="Upload already stored; delete it from the gallery instead")
+		c.execute("DELETE FROM upload_queue WHERE id = ?", (id,))
 	if row[1] == "processing":
-		conn.close()
-		raise HTTPException(status_code=400, detail="Cannot cancel in-progress upload")
-	c.execute("DELETE FROM upload_queue WHERE id = ?", (id,))
-	conn.commit()
-	conn.close()
-	if os.path.exists(row[2]):
+		clean_partial_output(row[3], row[5])
+	# HLS jobs point at the stored MP4; dropping the job just skips the ladder
+	if row[3] != JOB_HLS and os.path.exists(row[2]):
 		os.remove(row[2])
 	return {"status": "cancelled"}
 
 @router.post("/queue/retry")
 def retry_upload(id: int = Form(...), username: str = Depends(get_current_user)):
-	conn = sqlite3.connect(QUEUE_DB_PATH)
-	c = conn.cursor()
-	c.execute("SELECT username, status FROM upload_queue WHERE id = ?", (id,))
-	row = c.fetchone()
-	if not row or row[0] != username:
-		conn.close()
-		raise HTTPException(status_code=404, detail="Upload not found")
-	if row[1] != "failed":
-		conn.close()
-		raise HTTPException(status_code=400, detail="Only failed uploads can be retried")
-	c.execute("UPDATE upload_queue SET status = 'pending', retry_count = 0 WHERE id = ?", (id,))
-	conn.commit()
-	conn.close()
+	with queue_conn() as conn:
+		c = conn.cursor()
+		c.execute("SELECT username, status FROM upload_queue WHERE id = ?", (id,))
+		row = c.fetchone()
+		if not row or row[0] != username:
+			raise HTTPException(status_code=404, detail="Upload not found")
+		if row[1] != "failed":
+			raise HTTPException(status_code=400, detail="Only failed uploads can be retried")
+		c.execute("UPDATE upload_queue SET status = 'pending', retry_count = 0 WHERE id = ?", (id,))
 	return {"status": "retried"}
 
+QUEUE_PENDING_SQL = hot_query("queue_pending", "SELECT COUNT(*) FROM upload_queue WHERE status = 'pending'", QUEUE_HOT_QUERIES)
+
 @router.get("/queue/pending")
 def queue_pending():
-	conn = sqlite3.connect(QUEUE_DB_PATH)
-	c = conn.cursor()
-	c.execute("SELECT COUNT(*) FROM upload_queue WHERE status = 'pending'")
-	count = c.fetchone()[0]
-	conn.close()
+	with queue_conn() as conn:
+		count = conn.execute(QUEUE_PENDING_SQL).fetchone()[0]
 	return {"pending": count}
 
 @router.get("/queue/all")
 def queue_all():
-	conn = sqlite3.connect(QUEUE_DB_PATH)
-	c = conn.cursor()
-	c.execute("""
-		SELECT id, username, final_name, status, retry_count, created_at
-		FROM upload_queue
-		ORDER BY created_at ASC
-	""")
-	rows = c.fetchall()
-	conn.close()
+	with queue_conn() as conn:
+		rows = conn.execute("""
+			SELECT id, username, final_name, status, retry_count, created_at, job_type, priority
+			FROM upload_queue
+			ORDER BY created_at ASC
+		""").fetchall()
 	return [
 		{
 			"id": r[0],
@@ -167,11 +357,73 @@ def queue_all():
 			"status": r[3],
 			"retry_count": r[4],
 			"created_at": r[5],
+			"job_type": r[6],
+			"priority": r[7],
 		} for r in rows
 	]
 
-def run_loop():
-	print("[Queue] Started processing loop")
-	while True:
-		if not process_next():
-			time.sleep(POLL_INTERVAL)
+# Set to let workers finish their current job and exit (worker command only)
+_stop = threading.Event()
+
+def worker_loop(worker_id: int):
+	print(f"[Queue] Worker {worker_id} started")
+	while not _stop.is_set():
+		try:
+			if not process_next():
+				wait_for_work(POLL_INTERVAL)
+		except Exception:
+			print(f"[Queue] ❌ Worker {worker_id} error")
+			traceback.print_exc()
+			_stop.wait(POLL_INTERVAL)
+	print(f"[Queue] Worker {worker_id} stopped")
+
+def run_loop(workers: int = QUEUE_WORKERS):
+	print(f"[Queue] Started processing loop with {workers} worker(s)")
+	start_listener()
+	threading.Thread(target=reaper_loop, name="queue-reaper", daemon=True).start()
+	# Maintenance jobs (normalize, backfills) run alongside the upload queue
+	threading.Thread(target=run_jobs_loop, name="job-runner", daemon=True).start()
+	threads = [
+		threading.Thread(target=worker_loop, args=(i,), name=f"queue-worker-{i}", daemon=True)
+		for i in range(workers)
+	]
+	for t in threads:
+		t.start()
+	for t in threads:
+		t.join()
+
+def stop_workers(workers: int = QUEUE_WORKERS):
+	"""Stop claiming; running jobs finish (or are reaped if we get killed first)."""
+	if not _stop.is_set():
+		print("[Queue] ⏹ Stopping after current jobs")
+	_stop.set()
+	wake_local(workers)
+
+def main(argv=None):
+	parser = argparse.ArgumentParser(prog="python -m modules.queue")
+	commands = parser.add_subparsers(dest="command", required=True)
+	worker = commands.add_parser("worker", help="process upload queue jobs until stopped")
+	worker.add_argument(
+		"--concurrency", type=int, default=QUEUE_WORKERS,
+		help=f"jobs to run at once in this process (default: QUEUE_WORKERS, {QUEUE_WORKERS})"
+	)
+	args = parser.parse_args(argv)
+	if args.concurrency < 1:
+		parser.error("--concurrency must be at least 1")
+
+	# Same schema setup as the web process, which may not have started yet
+	init_db()
+	init_upload_queue_db()
+	upgrade_main_db()
+	upgrade_queue_db()
+
+	for sig in (signal.SIGTERM, signal.SIGINT):
+		signal.signal(sig, lambda *_: stop_workers(args.concurrency))
+	run_loop(args.concurrency)
+
+if __name__ == "__main__":
+	# Dedicated worker process, e.g. its own container on the shared data volume:
+	#   python -m modules.queue worker --concurrency 2
+	# Any number of these (and RUN_MAIN=true web processes) can run at once;
+	# claims are atomic and leased, so each job runs in exactly one place.
+	main()
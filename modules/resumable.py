@@ -0,0 +1,274 @@
+import fcntl, os, threading, time
+from uuid import uuid4
+from fastapi import APIRouter, Depends, Form, HTTPException, Query, Request, Response
+from starlette.concurrency import run_in_threadpool
+from starlette.requests import ClientDisconnect
+from modules.auth import get_current_user
+from modules.config import UPLOAD_STAGING_DIR
+from modules.database import db_conn
+from modules.uploads import accept_staged_upload, hash_file, UPLOAD_CHUNK_SIZE
+
+router = APIRouter()
+
+# Resumable uploads:
+#   POST   /upload/sessions                 -> {"id", "offset": 0}
+#   PUT    /upload/sessions/{id}?offset=N   raw bytes appended at N -> {"offset"}
+#   GET    /upload/sessions/{id}            -> {"offset", "size", ...} to resume
+#   POST   /upload/sessions/{id}/finalize   -> same entry /upload returns per file
+#   DELETE /upload/sessions/{id}
+# Bytes go to <id>.part in UPLOAD_STAGING_DIR and are kept even when the
+# client drops mid-chunk, so a retry continues from the last byte received.
+UPLOAD_SESSION_TTL = 24 * 3600  # idle sessions older than this are removed
+UPLOAD_SESSION_GC_INTERVAL = 3600
+
+def part_path(session_id: str) -> str:
+	return os.path.join(UPLOAD_STAGING_DIR, f"{session_id}.part")
+
+def session_dict(row) -> dict:
+	return {
+		"id": row[0],
+		"filename": row[1],
+		"content_type": row[2],
+		"size": row[3],
+		"offset": row[4],
+		"caption": row[5],
+		"album_id": row[6],
+	}
+
+def get_session(session_id: str, username: str) -> dict:
+	with db_conn() as conn:
+		row = conn.execute("""
+			SELECT id, filename, content_type, size, received, caption, album_id
+			FROM upload_sessions WHERE id = ? AND username = ?
+		""", (session_id, username)).fetchone()
+	if not row:
+		raise HTTPException(status_code=404, detail="Upload session not found")
+	return session_dict(row)
+
+def delete_session(session_id: str):
+	with db_conn() as conn:
+		conn.execute("DELETE FROM upload_sessions WHERE id = ?", (session_id,))
+	try:
+		os.remove(part_path(session_id))
+	except FileNotFoundError:
+		pass
+
+def offset_conflict(offset: int):
+	return HTTPException(
+		status_code=409,
+		detail="Offset does not match the bytes received",
+		headers={"Upload-Offset": str(offset)},
+	)
+
+def lock_part(session_id: str, create: bool = True):
+	"""
+	Open the part file holding an exclusive flock, or raise 409 if another
+	request (in any worker process) holds it. PUT, finalize and delete all
+	take it, so only one of them touches the bytes at a time; the lock goes
+	away when the file is closed or its process dies.
+	"""
+	flags = os.O_RDWR | (os.O_CREAT if create else 0)
+	f = os.fdopen(os.open(part_path(session_id), flags, 0o644), "r+b")
+	try:
+		fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+	except BlockingIOError:
+		f.close()
+		raise HTTPException(status_code=409, detail="Upload session is busy")
+	return f
+
+def seek_part(f, offset: int):
+	"""Position the part file at `offset`, dropping anything past it."""
+	f.truncate(offset)
+	f.seek(offset)
+
+def record_offset(session_id: str, old_offset: int, new_offset: int) -> bool:
+	with db_conn() as conn:
+		cur = conn.execute("""
+			UPDATE upload_sessions SET received = ?, updated_at = ?
+			WHERE id = ? AND received = ?
+		""", (new_offset, int(time.time()), session_id, old_offset))
+		return cur.rowcount == 1
+
+@router.post("/upload/sessions")
+def create_session(
+	filename: str = Form(...),
+	content_type: str = Form(...),
+	size: int | None = Form(None),
+	caption: str = Form(""),
+	album_id: str = Form(""),
+	username: str = Depends(get_current_user),
+):
+	if not (content_type.startswith("image/") or content_type.startswith("video/")):
+		raise HTTPException(status_code=400, detail="Only images and videos can be uploaded")
+	if size is not None and size < 0:
+		raise HTTPException(status_code=400, detail="Invalid size")
+
+	session_id = str(uuid4())
+	now = int(time.time())
+	with db_conn() as conn:
+		conn.execute("""
+			INSERT INTO upload_sessions
+				(id, username, filename, content_type, size, received, caption, album_id, created_at, updated_at)
+			VALUES (?, ?, ?, ?, ?, 0, ?, ?, ?, ?)
+		""", (session_id, username, filename, content_type, size, caption.strip(), album_id, now, now))
+	return {"id": session_id, "offset": 0, "size": size, "chunk_size": UPLOAD_CHUNK_SIZE}
+
+@router.get("/upload/sessions/{session_id}")
+def session_status(session_id: str, response: Response, username: str = Depends(get_current_user)):
+	session = get_session(session_id, username)
+	response.headers["Upload-Offset"] = str(session["offset"])
+	return session
+
+@router.put("/upload/sessions/{session_id}")
+async def upload_chunk(
+	session_id: str,
+	request: Request,
+	response: Response,
+	offset: int = Query(...),
+	username: str = Depends(get_current_user),
+):
+	session = await run_in_threadpool(get_session, session_id, username)
+	if offset != session["offset"]:
+		raise offset_conflict(session["offset"])
+
+	limit = session["size"]
+	content_length = request.headers.get("content-length")
+	if limit is not None and content_length and offset + int(content_length) > limit:
+		raise HTTPException(status_code=413, detail="Chunk runs past the declared size")
+
+	f = await run_in_threadpool(lock_part, session_id)
+	try:
+		# Look again under the lock: a finalize or an earlier PUT may have
+		# finished while we waited for the file
+		session = await run_in_threadpool(get_session, session_id, username)
+		if offset != session["offset"]:
+			raise offset_conflict(session["offset"])
+		await run_in_threadpool(seek_part, f, offset)
+
+		written = 0
+		buffer = bytearray()
+		too_large = False
+		try:
+			async for chunk in request.stream():
+				buffer += chunk
+				if limit is not None and offset + written + len(buffer) > limit:
+					too_large = True
+					break
+				if len(buffer) >= UPLOAD_CHUNK_SIZE:
+					await run_in_threadpool(f.write, bytes(buffer))
+					written += len(buffer)
+					buffer.clear()
+		except ClientDisconnect:
+			# Keep what arrived; the client resumes from the new offset
+			pass
+		if buffer and not too_large:
+			await run_in_threadpool(f.write, bytes(buffer))
+			written += len(buffer)
+		await run_in_threadpool(f.flush)
+
+		new_offset = offset + written
+		if not await run_in_threadpool(record_offset, session_id, offset, new_offset):
+			current = await run_in_threadpool(get_session, session_id, username)
+			raise offset_conflict(current["offset"])
+	finally:
+		await run_in_threadpool(f.close)
+
+	if too_large:
+		raise HTTPException(
+			status_code=413,
+			detail="Chunk runs past the declared size",
+			headers={"Upload-Offset": str(new_offset)},
+		)
+	response.headers["Upload-Offset"] = str(new_offset)
+	return {"offset": new_offset, "size": limit}
+
+def finalize(session_id: str, username: str) -> dict:
+	get_session(session_id, username)
+	try:
+		f = lock_part(session_id, create=False)
+	except FileNotFoundError:
+		# Never written to, or a concurrent finalize already moved it
+		get_session(session_id, username)
+		raise HTTPException(status_code=409, detail="No data received")
+
+	with f:
+		# Claim the session: exactly one finalize gets the row back, and a PUT
+		# that gets the lock after us finds no session to write to
+		with db_conn() as conn:
+			row = conn.execute("""
+				DELETE FROM upload_sessions
+				WHERE id = ? AND username = ? AND (size IS NULL OR received = size)
+				RETURNING id, filename, content_type, size, received, caption, album_id
+			""", (session_id, username)).fetchone()
+		if not row:
+			raise offset_conflict(get_session(session_id, username)["offset"])
+		session = session_dict(row)
+
+		path = part_path(session_id)
+		sha256 = hash_file(path)
+		ext = os.path.splitext(session["filename"])[-1].lower()
+		staged_path = os.path.join(UPLOAD_STAGING_DIR, f"{session_id}{ext}")
+		os.replace(path, staged_path)
+
+	stored = accept_staged_upload(
+		username, staged_path, session_id, ext, session["content_type"], session["caption"] or "", session["album_id"] or "", sha256
+	)
+	return {**stored, "size": session["offset"], "sha256": sha256}
+
+@router.post("/upload/sessions/{session_id}/finalize")
+def finalize_session(session_id: str, username: str = Depends(get_current_user)):
+	return finalize(session_id, username)
+
+@router.delete("/upload/sessions/{session_id}")
+def abort_session(session_id: str, username: str = Depends(get_current_user)):
+	get_session(session_id, username)
+	try:
+		f = lock_part(session_id, create=False)
+	except FileNotFoundError:
+		f = None
+	try:
+		delete_session(session_id)
+	finally:
+		if f:
+			f.close()
+	return {"deleted": session_id}
+
+# -------------------- Cleanup --------------------
+def gc_upload_sessions(max_age: int = UPLOAD_SESSION_TTL) -> int:
+	"""Drop sessions idle for `max_age` seconds and any .part file without a session."""
+	cutoff = int(time.time()) - max_age
+	with db_conn() as conn:
+		stale = [row[0] for row in conn.execute(
+			"SELECT id FROM upload_sessions WHERE updated_at < ?", (cutoff,)
+		)]
+		live = {row[0] for row in conn.execute("SELECT id FROM upload_sessions")}
+	for session_id in stale:
+		delete_session(session_id)
+
+	orphans = 0
+	for name in os.listdir(UPLOAD_STAGING_DIR):
+		session_id, ext = os.path.splitext(name)
+		if ext != ".part" or session_id in live:
+			continue
+		path = os.path.join(UPLOAD_STAGING_DIR, name)
+		try:
+			if os.path.getmtime(path) < cutoff:
+				os.remove(path)
+				orphans += 1
+		except FileNotFoundError:
+			pass
+
+	if stale or orphans:
+		print(f"[Uploads] 🧹 Removed {len(stale)} abandoned upload sessions, {orphans} orphaned parts")
+	return len(stale) + orphans
+
+def gc_loop():
+	while True:
+		try:
+			gc_upload_sessions()
+		except Exception as e:
+			print(f"[Uploads] ❌ Session cleanup failed: {e}")
+		time.sleep(UPLOAD_SESSION_GC_INTERVAL)
+
+def start_session_gc():
+	threading.Thread(target=gc_loop, name="upload-session-gc", daemon=True).start()
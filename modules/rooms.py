@@ -1,22 +1,14 @@
-from fastapi import APIRouter, Depends, Form, HTTPException
+from fastapi import APIRouter, Depends, Form
 from fastapi.responses import HTMLResponse
-from fastapi.security import OAuth2PasswordBearer
 import os
 from modules.utils import sanitize_html, format_html
-from modules.database import resolve_username_caseless, user_exists
-from modules.auth import decode_token
+from modules.database import resolve_username_caseless
+from modules.auth import get_current_user
 from modules.config import ROOMS_DIR
 
 TEMPLATES_DIR = os.path.join(os.path.dirname(__file__), "..", "templates")
 
 router = APIRouter()
-oauth2_scheme = OAuth2PasswordBearer(tokenUrl="login")
-
-def get_current_user(token: str = Depends(oauth2_scheme)):
-	username = decode_token(token)
-	if not username or not user_exists(username):
-		raise HTTPException(status_code=401, detail="Invalid token")
-	return username
 
 def get_room_path(username):
 	return os.path.join(ROOMS_DIR, f"{username}.html")
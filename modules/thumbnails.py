@@ -0,0 +1,127 @@
+import math, os, subprocess, sys, tempfile, time
+from PIL import Image, ImageOps
+
+PREVIEW_WIDTH = 320
+JPEG_QUALITY = 85
+WEBP_QUALITY = 80
+EXIF_ORIENTATION = 0x0112
+
+# Thumbnail pyramid written next to each upload at ingest:
+#   preview_<base>_<width>.webp and preview_<base>_<width>.jpg
+# plus the legacy preview_<base>.jpg (PREVIEW_WIDTH) for older clients.
+THUMBNAIL_WIDTHS = (160, 320, 640, 1280)
+THUMBNAIL_FORMATS = {
+	"webp": ("WEBP", {"quality": WEBP_QUALITY, "method": 4}),
+	"jpg": ("JPEG", {"quality": JPEG_QUALITY, "optimize": True, "progressive": True}),
+}
+
+def variant_name(base: str, width: int, ext: str) -> str:
+	return f"preview_{base}_{width}.{ext}"
+
+def thumbnail_variants(filename: str, widths: str | None) -> list:
+	"""Describe the stored variants for API responses (widths as stored on videos.thumb_widths)."""
+	if not widths:
+		return []
+	base = os.path.splitext(filename)[0]
+	return [
+		{"width": w, **{ext: variant_name(base, w, ext) for ext in THUMBNAIL_FORMATS}}
+		for w in (int(x) for x in widths.split(","))
+	]
+
+def thumbnail_files(filename: str) -> list:
+	"""Every preview file name an upload may own, for cleanup."""
+	base = os.path.splitext(filename)[0]
+	names = [f"preview_{base}.jpg"]
+	for w in THUMBNAIL_WIDTHS:
+		names += [variant_name(base, w, ext) for ext in THUMBNAIL_FORMATS]
+	return names
+
+def open_for_thumbnail(image: Image.Image, max_width: int) -> Image.Image:
+	"""Draft-decode, apply EXIF orientation and normalise the mode."""
+	# Orientations 5-8 swap the axes, so the displayed width is the stored height
+	rotated = image.getexif().get(EXIF_ORIENTATION, 1) in (5, 6, 7, 8)
+	display_width = image.height if rotated else image.width
+	if display_width > max_width:
+		scale = max_width / display_width
+		# JPEG only: libjpeg decodes straight at 1/2, 1/4 or 1/8 scale
+		image.draft("RGB", (math.ceil(image.width * scale), math.ceil(image.height * scale)))
+
+	image = ImageOps.exif_transpose(image)
+	if image.mode not in ("RGB", "L"):
+		image = image.convert("RGB")
+	return image
+
+def downscale(image: Image.Image, width: int) -> Image.Image:
+	if image.width <= width:
+		return image
+	# Cheap integer box-downscale first, then a quality resample
+	factor = image.width // (width * 2)
+	if factor > 1:
+		image = image.reduce(factor)
+	height = max(1, round(image.height * width / image.width))
+	return image.resize((width, height), Image.Resampling.LANCZOS)
+
+def make_thumbnail_pyramid(input_path: str, out_dir: str, base: str, widths=THUMBNAIL_WIDTHS, legacy: bool = True) -> list:
+	"""
+	Write every width in `widths` (WebP + JPEG) from a single decode, each
+	level resampled from the previous larger one. Widths above the source are
+	skipped; a source smaller than the smallest width gets that one variant
+	at native size. Also writes the legacy preview unless legacy=False.
+	Returns widths written.
+	"""
+	written = []
+	with Image.open(input_path) as source:
+		image = open_for_thumbnail(source, max(widths))
+		wanted = [w for w in sorted(widths, reverse=True) if w <= image.width] or [min(widths)]
+		legacy_done = not legacy
+		for width in wanted:
+			image = downscale(image, width)
+			for ext, (fmt, options) in THUMBNAIL_FORMATS.items():
+				image.save(os.path.join(out_dir, variant_name(base, width, ext)), fmt, **options)
+			if not legacy_done and width <= PREVIEW_WIDTH:
+				image.save(os.path.join(out_dir, f"preview_{base}.jpg"), "JPEG", quality=JPEG_QUALITY, optimize=True)
+				legacy_done = True
+			written.append(width)
+	return sorted(written)
+
+def make_image_thumbnail(input_path: str, output_path: str, width: int = PREVIEW_WIDTH):
+	"""
+	Scale a still image to `width` pixels wide in-process with Pillow.
+	JPEGs are decoded at a reduced DCT scale (draft mode), large images are
+	shrunk with reduce() before the final resample, and EXIF orientation
+	is applied so portrait phone photos come out upright. Never upscales.
+	"""
+	with Image.open(input_path) as source:
+		image = downscale(open_for_thumbnail(source, width), width)
+		image.save(output_path, "JPEG", quality=JPEG_QUALITY, optimize=True)
+
+def ffmpeg_image_thumbnail(input_path: str, output_path: str, width: int = PREVIEW_WIDTH):
+	subprocess.run([
+		"ffmpeg", "-y",
+		"-i", input_path,
+		"-vf", f"scale={width}:-1",
+		"-frames:v", "1",
+		"-update", "1",
+		output_path
+	], check=True, capture_output=True)
+
+def benchmark(paths: list, rounds: int = 3):
+	"""Time the Pillow and ffmpeg image paths over the same files."""
+	engines = {"pillow": make_image_thumbnail, "ffmpeg": ffmpeg_image_thumbnail}
+	with tempfile.TemporaryDirectory() as out_dir:
+		out_path = os.path.join(out_dir, "preview.jpg")
+		for name, engine in engines.items():
+			start = time.perf_counter()
+			for _ in range(rounds):
+				for path in paths:
+					engine(path, out_path)
+			elapsed = time.perf_counter() - start
+			per_image = elapsed * 1000 / (rounds * len(paths))
+			print(f"[Bench] {name}: {per_image:.1f} ms/image over {rounds * len(paths)} runs")
+
+if __name__ == "__main__":
+	# python -m modules.thumbnails photo1.jpg photo2.jpg ...
+	if len(sys.argv) < 2:
+		print("usage: python -m modules.thumbnails IMAGE [IMAGE ...]")
+		sys.exit(1)
+	benchmark(sys.argv[1:])
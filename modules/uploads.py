@@ -1,65 +1,156 @@
 # -------------------- Imports --------------------
 from typing import List
-from fastapi import UploadFile, File, Form, HTTPException, Depends, APIRouter, BackgroundTasks, Query
-from fastapi.security import OAuth2PasswordBearer
-import os, shutil, subprocess, tempfile, sqlite3, re
+from fastapi import Form, HTTPException, Depends, APIRouter, Query, Request
+from starlette.concurrency import run_in_threadpool
+from python_multipart.multipart import MultipartParser, parse_options_header
+import os, shutil, subprocess, re, base64, binascii, hashlib, json
 from uuid import uuid4
-from datetime import datetime
-from collections import defaultdict
+from datetime import datetime, timezone
+from itertools import groupby
 from PIL import Image
-from PIL.ExifTags import TAGS
 from modules.database import (
-    resolve_username_caseless, track_upload, list_user_uploads, user_exists, add_date_taken_column
+    resolve_username_caseless, track_upload, list_user_uploads,
+    update_media_metadata, db_conn, queue_conn, find_by_hash, set_hls_renditions, get_media_metadata, hot_query
+)
+from modules.notify import notify_workers
+from modules.config import UPLOAD_DIR, UPLOAD_STAGING_DIR, DEDUP_SCOPE, HLS_ENABLED
+from modules.hls import make_hls, remove_hls, HLS_MEDIA_TYPES, NO_AUDIO
+from modules.auth import get_current_user
+from modules.thumbnails import (
+    make_thumbnail_pyramid, ffmpeg_image_thumbnail, thumbnail_variants, thumbnail_files, THUMBNAIL_WIDTHS
 )
-from modules.config import UPLOAD_DIR, DB_PATH, QUEUE_DB_PATH
-from modules.auth import decode_token
 import os
 from datetime import datetime
-from fastapi.responses import FileResponse
-
+from modules.media import serve_file, forget_stat, media_links, verify_media_token, offload_response
 
 
-# -------------------- Auth --------------------
-oauth2_scheme = OAuth2PasswordBearer(tokenUrl="login")
-
-def get_current_user(token: str = Depends(oauth2_scheme)):
-    username = decode_token(token)
-    if not username or not user_exists(username):
-        raise HTTPException(status_code=401, detail="Invalid token")
-    return username
 
 # -------------------- Utilities --------------------
-def generate_preview(input_path: str, output_path: str, is_video: bool):
+def generate_preview(input_path: str, output_path: str, is_video: bool, keep_legacy: bool = False) -> list:
+    """
+    Write the legacy preview at output_path plus the thumbnail pyramid next
+    to it. Returns the pyramid widths written ([] if only the legacy preview
+    could be produced). keep_legacy leaves an existing legacy preview alone.
+    """
+    if not output_path.lower().endswith(".jpg"):
+        output_path = os.path.splitext(output_path)[0] + ".jpg"
+    write_legacy = not (keep_legacy and os.path.exists(output_path))
+    out_dir = os.path.dirname(output_path)
+    base = os.path.splitext(os.path.basename(output_path))[0].removeprefix("preview_")
+
     if is_video:
-        if not output_path.lower().endswith(".jpg"):
-            output_path = os.path.splitext(output_path)[0] + ".jpg"
+        # One ffmpeg frame grab at the largest size, then Pillow builds the pyramid
+        frame_path = os.path.join(out_dir, f".frame_{base}.jpg")
         subprocess.run([
             "ffmpeg", "-y",
             "-ss", "00:00:00.5",
             "-i", input_path,
             "-vframes", "1",
-            "-vf", "scale=320:-1",
-            output_path
-        ], check=True)
+            "-q:v", "2",
+            "-vf", f"scale='min({max(THUMBNAIL_WIDTHS)},iw)':-2",
+            frame_path
+        ], check=True, capture_output=True)
+        source = frame_path
     else:
-        subprocess.run([
-            "ffmpeg", "-y",
-            "-i", input_path,
-            "-vf", "scale=320:-1",
-            "-frames:v", "1",
-            "-update", "1",
-            output_path
-        ], check=True)
-
-
-def convert_to_mp4(input_path: str, output_path: str):
-    subprocess.run([
-        "ffmpeg", "-y", "-i", input_path,
-        "-c:v", "libx264", "-preset", "fast",
-        "-crf", "23",
-        "-c:a", "aac", "-b:a", "128k",
-        output_path
-    ], check=True)
+        frame_path = None
+        source = input_path
+
+    try:
+        # Stills are scaled in-process; ffmpeg only for what Pillow can't open
+        return make_thumbnail_pyramid(source, out_dir, base, legacy=write_legacy)
+    except Exception as e:
+        if not write_legacy:
+            print(f"[Preview] Pillow failed for {input_path}, keeping existing preview: {e}")
+            return []
+        print(f"[Preview] Pillow failed for {input_path}, using ffmpeg: {e}")
+        ffmpeg_image_thumbnail(source, output_path)
+        return []
+    finally:
+        if frame_path and os.path.exists(frame_path):
+            os.remove(frame_path)
+
+
+# convert_to_mp4 paths, recorded on videos.conversion
+CONVERT_REMUX = "remux"          # both streams copied into an MP4 container
+CONVERT_AUDIO = "audio"          # video copied, audio re-encoded to AAC
+CONVERT_TRANSCODE = "transcode"  # full libx264 + AAC encode
+
+# Phone uploads (.mov/.mkv) usually already hold MP4-compatible streams.
+# HEVC is copied with the hvc1 tag Apple players need; set REMUX_HEVC=false
+# if clients need H.264 everywhere.
+REMUX_VIDEO_CODECS = {"h264"} | ({"hevc"} if os.getenv("REMUX_HEVC", "true").lower() == "true" else set())
+REMUX_PIX_FMTS = {"yuv420p", "yuvj420p", "yuv420p10le"}
+REMUX_AUDIO_CODECS = {"aac", "mp3"}
+# HEIC/HEIF probe as HEVC, but the first video stream is one grid tile or a
+# single still; copying it would make a one-frame (or one-tile) MP4
+STILL_IMAGE_EXTS = {".heic", ".heif"}
+
+def is_still_image(probe: dict) -> bool:
+    videos = [s for s in probe.get("streams", []) if s.get("codec_type") == "video"]
+    if len(videos) > 1 and not probe.get("format", {}).get("duration"):
+        return True  # tiled image grid
+    # 0:v:0 is what gets copied
+    first = videos[0] if videos else {}
+    return bool(first.get("disposition", {}).get("attached_pic")) or first.get("nb_frames") == "1"
+
+def conversion_plan(probe: dict, ext: str = "") -> str:
+    """Cheapest conversion that still yields a browser-playable MP4."""
+    streams = probe.get("streams", [])
+    video = next((s for s in streams if s.get("codec_type") == "video"), None)
+    audio = next((s for s in streams if s.get("codec_type") == "audio"), None)
+    if not video or video.get("codec_name") not in REMUX_VIDEO_CODECS:
+        return CONVERT_TRANSCODE
+    if ext.lower() in STILL_IMAGE_EXTS or is_still_image(probe):
+        return CONVERT_TRANSCODE
+    # 10-bit H.264 (High 10) won't decode in browsers; 10-bit HEVC is fine
+    pix_fmt = video.get("pix_fmt")
+    if pix_fmt not in REMUX_PIX_FMTS or (video["codec_name"] == "h264" and pix_fmt == "yuv420p10le"):
+        return CONVERT_TRANSCODE
+    if audio and audio.get("codec_name") not in REMUX_AUDIO_CODECS:
+        return CONVERT_AUDIO
+    return CONVERT_REMUX
+
+def ffmpeg_convert_args(plan: str, video_codec: str | None) -> list:
+    if plan == CONVERT_TRANSCODE:
+        video = ["-c:v", "libx264", "-preset", "fast", "-crf", "23", "-pix_fmt", "yuv420p"]
+    else:
+        video = ["-c:v", "copy"] + (["-tag:v", "hvc1"] if video_codec == "hevc" else [])
+    audio = ["-c:a", "copy"] if plan == CONVERT_REMUX else ["-c:a", "aac", "-b:a", "128k"]
+    # First video and audio stream only: .mov data/timecode tracks don't fit in MP4
+    return ["-map", "0:v:0?", "-map", "0:a:0?"] + video + audio + ["-movflags", "+faststart"]
+
+def convert_to_mp4(input_path: str, output_path: str) -> str:
+    """
+    Make a web-playable MP4, remuxing instead of re-encoding whenever the
+    input streams allow it. Returns the path taken (CONVERT_*).
+    """
+    try:
+        probe = run_ffprobe(input_path)
+    except Exception as e:
+        print(f"[FFPROBE ERROR] {input_path}: {e}")
+        probe = {}
+    plan = conversion_plan(probe, os.path.splitext(input_path)[1])
+    video_codec = next(
+        (s.get("codec_name") for s in probe.get("streams", []) if s.get("codec_type") == "video"), None
+    )
+
+    try:
+        subprocess.run(
+            ["ffmpeg", "-y", "-i", input_path] + ffmpeg_convert_args(plan, video_codec) + [output_path],
+            check=True, capture_output=True
+        )
+    except subprocess.CalledProcessError as e:
+        if plan == CONVERT_TRANSCODE:
+            raise
+        # Stream copy can still trip over odd timestamps or containers
+        print(f"[FFMPEG] ⚠️ {plan} failed for {input_path}, transcoding: {e.stderr.decode(errors='replace')[-200:]}")
+        plan = CONVERT_TRANSCODE
+        subprocess.run(
+            ["ffmpeg", "-y", "-i", input_path] + ffmpeg_convert_args(plan, video_codec) + [output_path],
+            check=True
+        )
+    print(f"[FFMPEG] 🎞 {os.path.basename(input_path)} → {os.path.basename(output_path)} ({plan})")
+    return plan
 
 def convert_and_track(username: str, tmp_path: str, final_name: str, caption: str):
     output_path = os.path.join(UPLOAD_DIR, final_name)
@@ -74,64 +165,123 @@ def convert_and_track(username: str, tmp_path: str, final_name: str, caption: st
     finally:
         os.unlink(tmp_path)
 
-def determine_date_taken(path: str) -> int | None:
+IMAGE_EXTS = [".jpg", ".jpeg", ".png", ".webp", ".heic"]
+VIDEO_EXTS = [".mp4", ".webm", ".mov", ".avi", ".mkv", ".3gp"]
+
+EXIF_ORIENTATION = 0x0112
+EXIF_IFD = 0x8769
+EXIF_DATETIME_ORIGINAL = 0x9003
+# EXIF orientation -> clockwise rotation needed for display
+ORIENTATION_ROTATION = {3: 180, 6: 90, 8: 270}
+
+def probe_media(path: str) -> dict:
+	"""
+	Extract everything stored about a file in a single pass: one Pillow open
+	for images, one ffprobe for videos. width/height are display dimensions
+	(already swapped for 90/270 rotation). Missing values are None.
+	"""
+	meta = {
+		"date_taken": None,
+		"duration": None,
+		"width": None,
+		"height": None,
+		"codec": None,
+		"rotation": 0,
+		"file_size": os.path.getsize(path),
+	}
 	ext = os.path.splitext(path)[-1].lower()
 
 	# 1. Try EXIF / ffprobe
-	if ext in [".jpg", ".jpeg", ".png", ".webp", ".heic"]:
-		taken = extract_date_taken_image(path)
-		if taken:
-			print(f"[Date] ⏱ EXIF: {path} → {taken}")
-			return taken
-	elif ext in [".mp4", ".webm", ".mov", ".avi", ".mkv", ".3gp"]:
-		taken = extract_date_taken_video(path)
-		if taken:
-			print(f"[Date] 🎞️ FFPROBE: {path} → {taken}")
-			return taken
+	if ext in IMAGE_EXTS:
+		meta.update(probe_image(path))
+		if meta["date_taken"]:
+			print(f"[Date] ⏱ EXIF: {path} → {meta['date_taken']}")
+	elif ext in VIDEO_EXTS:
+		meta.update(probe_video(path))
+		if meta["date_taken"]:
+			print(f"[Date] 🎞️ FFPROBE: {path} → {meta['date_taken']}")
 
 	# 2. Fallback to filename
-	taken = parse_date_from_filename(os.path.basename(path))
-	if taken:
-		print(f"[Date] 📄 Filename: {path} → {taken}")
-	else:
-		print(f"[Date] ❌ No valid timestamp found: {path}")
-
-	return taken
-
-def extract_date_taken_image(path: str) -> int | None:
+	if not meta["date_taken"]:
+		meta["date_taken"] = parse_date_from_filename(os.path.basename(path))
+		if meta["date_taken"]:
+			print(f"[Date] 📄 Filename: {path} → {meta['date_taken']}")
+		else:
+			print(f"[Date] ❌ No valid timestamp found: {path}")
+
+	if meta["rotation"] in (90, 270) and meta["width"] and meta["height"]:
+		meta["width"], meta["height"] = meta["height"], meta["width"]
+	return meta
+
+def probe_image(path: str) -> dict:
     try:
-        image = Image.open(path)
-        exif = image._getexif()
-        if not exif:
-            return None
-        for tag, value in exif.items():
-            tag_name = TAGS.get(tag)
-            if tag_name == "DateTimeOriginal":
-                return int(datetime.strptime(value, "%Y:%m:%d %H:%M:%S").timestamp())
+        with Image.open(path) as image:
+            width, height = image.size
+            info = {"width": width, "height": height, "codec": (image.format or "").lower() or None}
+            exif = image.getexif()
+            info["rotation"] = ORIENTATION_ROTATION.get(exif.get(EXIF_ORIENTATION, 1), 0)
+            taken = exif.get_ifd(EXIF_IFD).get(EXIF_DATETIME_ORIGINAL)
+            if taken:
+                info["date_taken"] = int(datetime.strptime(taken, "%Y:%m:%d %H:%M:%S").timestamp())
+            return info
     except Exception as e:
         print(f"[EXIF ERROR] {path}: {e}")
+    return {}
+
+def parse_creation_time(value: str) -> int | None:
+    for fmt in ("%Y-%m-%dT%H:%M:%S.%fZ", "%Y-%m-%dT%H:%M:%SZ"):
+        try:
+            return int(datetime.strptime(value, fmt).timestamp())
+        except ValueError:
+            continue
     return None
 
-def extract_date_taken_video(path: str) -> int | None:
+def run_ffprobe(path: str) -> dict:
+    result = subprocess.run(
+        [
+            "ffprobe",
+            "-v", "quiet",
+            "-print_format", "json",
+            "-show_format",
+            "-show_streams",
+            "-i", path,
+        ],
+        capture_output=True,
+        text=True
+    )
+    return json.loads(result.stdout or "{}")
+
+def probe_video(path: str) -> dict:
     try:
-        result = subprocess.run(
-            [
-                "ffprobe",
-                "-v", "quiet",
-                "-print_format", "json",
-                "-show_entries", "format_tags=creation_time",
-                "-i", path,
-            ],
-            capture_output=True,
-            text=True
-        )
-        import json
-        tags = json.loads(result.stdout).get("format", {}).get("tags", {})
-        if "creation_time" in tags:
-            return int(datetime.strptime(tags["creation_time"], "%Y-%m-%dT%H:%M:%S.%fZ").timestamp())
+        probe = run_ffprobe(path)
+        fmt = probe.get("format", {})
+        video = next((s for s in probe.get("streams", []) if s.get("codec_type") == "video"), {})
+        audio = next((s for s in probe.get("streams", []) if s.get("codec_type") == "audio"), {})
+
+        info = {
+            "width": video.get("width"),
+            "height": video.get("height"),
+            "codec": video.get("codec_name"),
+            "audio_codec": (audio.get("codec_name") or NO_AUDIO) if probe.get("streams") else None,
+        }
+        duration = fmt.get("duration") or video.get("duration")
+        if duration:
+            info["duration"] = float(duration)
+
+        rotation = video.get("tags", {}).get("rotate")
+        for side_data in video.get("side_data_list", []):
+            if "rotation" in side_data:
+                # Display matrix rotation is counter-clockwise
+                rotation = -int(side_data["rotation"])
+        info["rotation"] = int(rotation or 0) % 360
+
+        creation_time = fmt.get("tags", {}).get("creation_time") or video.get("tags", {}).get("creation_time")
+        if creation_time:
+            info["date_taken"] = parse_creation_time(creation_time)
+        return info
     except Exception as e:
         print(f"[FFPROBE ERROR] {path}: {e}")
-    return None
+    return {}
 
 
 def parse_date_from_filename(filename: str) -> int | None:
@@ -165,197 +315,411 @@ def insert_into_album(album_id: str, filename: str):
 	if not album_id:
 		return
 	try:
-		conn = sqlite3.connect(DB_PATH)
-		c = conn.cursor()
-		c.execute(
-			"INSERT OR IGNORE INTO album_items (album_id, filename) VALUES (?, ?)",
-			(album_id, filename)
-		)
-		conn.commit()
-		conn.close()
+		with db_conn() as conn:
+			conn.execute(
+				"INSERT OR IGNORE INTO album_items (album_id, filename) VALUES (?, ?)",
+				(album_id, filename)
+			)
 	except Exception as e:
 		print(f"[Album Add] Failed to add {filename} to album {album_id}: {e}")
 
-def backfill_normalize_uploads():
-	import os
-	import sqlite3
-	from modules.config import DB_PATH, UPLOAD_DIR
-
-	conn = sqlite3.connect(DB_PATH)
-	c = conn.cursor()
-
-	c.execute("SELECT id, filename FROM videos")
-	rows = c.fetchall()
-
-	for video_id, filename in rows:
-		original_path = os.path.join(UPLOAD_DIR, filename)
-		if not os.path.isfile(original_path):
-			print(f"[Normalize] ❌ File missing: {filename}")
-			continue
-
-		base, ext = os.path.splitext(filename)
-		ext = ext.lower()
-		updated = False
-
-		# Convert non-mp4 videos to mp4
-		if ext in [".mov", ".webm", ".avi", ".mkv", ".3gp"]:
-			new_filename = f"{base}.mp4"
-			new_path = os.path.join(UPLOAD_DIR, new_filename)
-			print(f"[Normalize] 🎞 Converting {filename} → {new_filename}")
-			try:
-				convert_to_mp4(original_path, new_path)
-				os.remove(original_path)
-				filename = new_filename
-				updated = True
-			except Exception as e:
-				print(f"[Normalize] ❌ Video conversion failed: {e}")
-				continue
-
-		# Fix preview extension to .jpg
-		preview_base = os.path.join(UPLOAD_DIR, f"preview_{os.path.splitext(filename)[0]}")
-		final_preview = f"{preview_base}.jpg"
-
-		for ext_try in [".png", ".jpeg", ".webp"]:
-			try_path = f"{preview_base}{ext_try}"
-			if os.path.exists(try_path):
-				print(f"[Normalize] 🖼 Renaming {try_path} → {final_preview}")
-				os.rename(try_path, final_preview)
-				break
-
-		if not os.path.exists(final_preview):
-			is_video = filename.lower().endswith(".mp4")
-			try:
-				generate_preview(os.path.join(UPLOAD_DIR, filename), final_preview, is_video=is_video)
-				print(f"[Normalize] 🔁 Regenerated preview for {filename}")
-			except Exception as e:
-				print(f"[Normalize] ❌ Preview failed: {e}")
-
-		if updated:
-			print(f"[Normalize] 📝 Updating DB: {video_id} → {filename}")
-			c.execute("UPDATE videos SET filename = ? WHERE id = ?", (filename, video_id))
-
-	conn.commit()
-	conn.close()
-	print("[Normalize] ✅ All done.")
-
-
-def backfill_missing_previews():
-	for filename in os.listdir(UPLOAD_DIR):
-		if not os.path.isfile(os.path.join(UPLOAD_DIR, filename)):
-			continue
-
-		# Skip files that are already previews
-		if filename.startswith("preview_"):
-			# Fix .png preview files → .jpg
-			if filename.endswith(".png"):
-				old_path = os.path.join(UPLOAD_DIR, filename)
-				new_name = os.path.splitext(filename)[0] + ".jpg"
-				new_path = os.path.join(UPLOAD_DIR, new_name)
-
-				if not os.path.exists(new_path):
-					os.rename(old_path, new_path)
-					print(f"[Backfill] 🔁 Renamed preview PNG → JPG: {filename} → {new_name}")
-				else:
-					os.remove(old_path)
-					print(f"[Backfill] 🗑️ Removed duplicate PNG preview: {filename}")
-			continue
-
-		# For original media files (not previews)
-		full_path = os.path.join(UPLOAD_DIR, filename)
-		ext = os.path.splitext(filename)[-1].lower()
-		is_video = ext in [".mp4", ".webm", ".mov", ".avi", ".mkv", ".3gp"]
-
-		base_name = os.path.splitext(filename)[0]
-		preview_name = f"preview_{base_name}.jpg"
-		preview_path = os.path.join(UPLOAD_DIR, preview_name)
-
-		if os.path.exists(preview_path):
-			continue  # preview already exists
-
+def normalize_upload(video_id: str, filename: str) -> tuple | None:
+	"""
+	Bring one stored upload up to the current layout: non-mp4 videos are
+	converted to mp4 and previews renamed or regenerated as .jpg. Returns
+	(new filename, conversion, video_id) when the row needs updating, else None.
+	Run by the "normalize" background job (see modules/jobs.py).
+	"""
+	original_path = os.path.join(UPLOAD_DIR, filename)
+	if not os.path.isfile(original_path):
+		print(f"[Normalize] ❌ File missing: {filename}")
+		return None
+
+	base, ext = os.path.splitext(filename)
+	ext = ext.lower()
+	conversion = None
+
+	# Convert non-mp4 videos to mp4
+	if ext in [".mov", ".webm", ".avi", ".mkv", ".3gp"]:
+		new_filename = f"{base}.mp4"
+		new_path = os.path.join(UPLOAD_DIR, new_filename)
+		print(f"[Normalize] 🎞 Converting {filename} → {new_filename}")
+		conversion = convert_to_mp4(original_path, new_path)
+		os.remove(original_path)
+		filename = new_filename
+
+	# Fix preview extension to .jpg
+	preview_base = os.path.join(UPLOAD_DIR, f"preview_{os.path.splitext(filename)[0]}")
+	final_preview = f"{preview_base}.jpg"
+
+	for ext_try in [".png", ".jpeg", ".webp"]:
+		try_path = f"{preview_base}{ext_try}"
+		if os.path.exists(try_path):
+			print(f"[Normalize] 🖼 Renaming {try_path} → {final_preview}")
+			os.rename(try_path, final_preview)
+			break
+
+	if not os.path.exists(final_preview):
+		is_video = filename.lower().endswith(".mp4")
 		try:
-			generate_preview(full_path, preview_path, is_video)
-			print(f"[Backfill] ✅ Generated preview for {filename}")
+			generate_preview(os.path.join(UPLOAD_DIR, filename), final_preview, is_video=is_video)
+			print(f"[Normalize] 🔁 Regenerated preview for {filename}")
 		except Exception as e:
-			print(f"[Backfill] ❌ Failed preview for {filename}: {e}")
+			print(f"[Normalize] ❌ Preview failed: {e}")
 
-# -------------------- Uploads --------------------
-router = APIRouter()
-
-def enqueue_upload(username: str, tmp_path: str, final_name: str, caption: str, is_video: bool, album_id: str = ""):
-	conn = sqlite3.connect(QUEUE_DB_PATH)
-	c = conn.cursor()
-	c.execute("""
-	INSERT INTO upload_queue (
-		username, original_path, final_name, caption, is_video, created_at, album_id
-	) VALUES (?, ?, ?, ?, ?, ?, ?)
-	""", (username, tmp_path, final_name, caption, int(is_video), int(datetime.now().timestamp()), album_id))
-	conn.commit()
-	conn.close()
+	if conversion:
+		print(f"[Normalize] 📝 Updating DB: {video_id} → {filename}")
+		return (filename, conversion, video_id)
+	return None
 
 
-@router.post("/upload")
-async def upload_media(
-    background_tasks: BackgroundTasks,
-    username: str = Depends(get_current_user),
-    caption: str = Form(""),
-    album_id: str = Form(""),
-    files: List[UploadFile] = File(...)
-):
-    uploaded = 0
-    for file in files:
-        content_type = file.content_type
-        ext = os.path.splitext(file.filename)[-1].lower()
+def backfill_preview(filename: str) -> list | None:
+	"""
+	Build the preview pyramid for one stored upload (previews_backfill job).
+	Old PNG previews are renamed to .jpg first. Returns the widths written.
+	"""
+	full_path = os.path.join(UPLOAD_DIR, filename)
+	if not os.path.isfile(full_path):
+		return None
+
+	base_name = os.path.splitext(filename)[0]
+	preview_path = os.path.join(UPLOAD_DIR, f"preview_{base_name}.jpg")
+	png_path = os.path.join(UPLOAD_DIR, f"preview_{base_name}.png")
+	if os.path.exists(png_path):
+		if not os.path.exists(preview_path):
+			os.rename(png_path, preview_path)
+			print(f"[Backfill] 🔁 Renamed preview PNG → JPG: preview_{base_name}.png")
+		else:
+			os.remove(png_path)
+			print(f"[Backfill] 🗑️ Removed duplicate PNG preview: preview_{base_name}.png")
+
+	is_video = os.path.splitext(filename)[-1].lower() in VIDEO_EXTS
+	# Clients cache preview_<base>.jpg as immutable; only add the pyramid next to it
+	widths = generate_preview(full_path, preview_path, is_video, keep_legacy=True)
+	print(f"[Backfill] ✅ Generated preview for {filename}")
+	return widths
 
-        if not (content_type.startswith("image/") or content_type.startswith("video/")):
-            continue
+# -------------------- Uploads --------------------
+router = APIRouter()
 
-        with tempfile.NamedTemporaryFile(delete=False, suffix=ext) as tmp:
-            shutil.copyfileobj(file.file, tmp)
-            tmp_path = tmp.name
+# upload_queue job types:
+#   convert - original_path is a staged file; transcode to mp4, preview, track, add to album
+#   ingest  - file already stored and tracked; preview, date taken, add to album
+#   hls     - stored video; encode the HLS ladder (only queued when HLS_ENABLED)
+JOB_CONVERT = "convert"
+JOB_INGEST = "ingest"
+JOB_HLS = "hls"
+
+# Priority classes; claim_next always serves the lowest pending class first,
+# round-robin across users within it.
+PRIORITY_INTERACTIVE = 0  # cheap jobs the uploader is waiting to see
+PRIORITY_NORMAL = 1       # large transcodes
+PRIORITY_BACKGROUND = 2   # HLS ladders and other extras nobody is waiting on
+SMALL_JOB_BYTES = 64 * 1024 * 1024
+
+def job_priority(job_type: str, path: str) -> int:
+	if job_type == JOB_HLS:
+		return PRIORITY_BACKGROUND
+	if job_type == JOB_INGEST:
+		return PRIORITY_INTERACTIVE
+	try:
+		small = os.path.getsize(path) < SMALL_JOB_BYTES
+	except OSError:
+		small = False
+	return PRIORITY_INTERACTIVE if small else PRIORITY_NORMAL
+
+def enqueue_upload(username: str, tmp_path: str, final_name: str, caption: str, is_video: bool, album_id: str = "", job_type: str = JOB_CONVERT, sha256: str | None = None, priority: int | None = None):
+	if priority is None:
+		priority = job_priority(job_type, tmp_path)
+	with queue_conn() as conn:
+		conn.execute("INSERT OR IGNORE INTO queue_users (username) VALUES (?)", (username,))
+		conn.execute("""
+		INSERT INTO upload_queue (
+			username, original_path, final_name, caption, is_video, created_at, album_id, job_type, sha256, priority
+		) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+		""", (username, tmp_path, final_name, caption, int(is_video), int(datetime.now().timestamp()), album_id, job_type, sha256, priority))
+	notify_workers()
+
+
+UPLOAD_CHUNK_SIZE = 1024 * 1024  # 1 MB
+
+MAX_FORM_FIELD_BYTES = 64 * 1024  # caption / album_id
+
+class UploadStream:
+    """
+    Incremental multipart/form-data parser for /upload. File parts are
+    hashed and written straight into UPLOAD_STAGING_DIR as the body arrives
+    (nothing is spooled to /tmp first); text fields are kept in memory.
+    write() does blocking disk I/O, so call it from the threadpool.
+    """
+
+    def __init__(self, boundary: bytes):
+        self.fields = {}
+        self.files = []  # {"file_id", "ext", "content_type", "staged_path", "size", "sha256"}
+        self.file_parts = 0
+        self._headers = {}
+        self._header_field = b""
+        self._header_value = b""
+        self._part = None
+        self._ended = False
+        self._parser = MultipartParser(boundary, {
+            "on_part_begin": self._on_part_begin,
+            "on_header_field": self._on_header_field,
+            "on_header_value": self._on_header_value,
+            "on_header_end": self._on_header_end,
+            "on_headers_finished": self._on_headers_finished,
+            "on_part_data": self._on_part_data,
+            "on_part_end": self._on_part_end,
+            "on_end": self._on_end,
+        })
 
+    def write(self, data: bytes):
+        self._parser.write(data)
+
+    def finish(self):
+        self._parser.finalize()
+        # python-multipart doesn't check this itself: a truncated body just stops
+        if self._part is not None or not self._ended:
+            raise ValueError("Upload body ended before the closing boundary")
+
+    def discard(self):
+        """Remove everything staged so far (failed or aborted request)."""
+        if self._part and self._part.get("out"):
+            self._part["out"].close()
+            self.files.append(self._part)
+        self._part = None
+        for staged in self.files:
+            try:
+                os.remove(staged["staged_path"])
+            except FileNotFoundError:
+                pass
+
+    def _on_part_begin(self):
+        self._headers = {}
+
+    def _on_header_field(self, data, start, end):
+        self._header_field += data[start:end]
+
+    def _on_header_value(self, data, start, end):
+        self._header_value += data[start:end]
+
+    def _on_header_end(self):
+        self._headers[self._header_field.lower()] = self._header_value
+        self._header_field = b""
+        self._header_value = b""
+
+    def _on_headers_finished(self):
+        _, params = parse_options_header(self._headers.get(b"content-disposition", b""))
+        name = params.get(b"name", b"").decode("utf-8", "replace")
+        if b"filename" not in params:
+            self._part = {"field": name, "data": bytearray()}
+            return
+
+        self.file_parts += 1
+        filename = params[b"filename"].decode("utf-8", "replace")
+        content_type = self._headers.get(b"content-type", b"").decode("latin-1").strip()
+        if name != "files" or not (content_type.startswith("image/") or content_type.startswith("video/")):
+            self._part = {"skip": True}
+            return
         file_id = str(uuid4())
-        is_convert = ext in [".mov", ".heic", ".heif", ".3gp", ".mkv"]
-        final_ext = ".mp4" if is_convert else ext
-        final_name = f"{file_id}{final_ext}"
-        final_path = os.path.join(UPLOAD_DIR, final_name)
-
-        # Always use .jpg for preview
-        preview_name = f"preview_{os.path.splitext(final_name)[0]}.jpg"
-        preview_path = os.path.join(UPLOAD_DIR, preview_name)
+        ext = os.path.splitext(filename)[-1].lower()
+        staged_path = os.path.join(UPLOAD_STAGING_DIR, f"{file_id}{ext}")
+        self._part = {
+            "file_id": file_id, "ext": ext, "content_type": content_type, "staged_path": staged_path,
+            "size": 0, "digest": hashlib.sha256(), "out": open(staged_path, "wb"),
+        }
 
-        if is_convert:
-            enqueue_upload(username, tmp_path, final_name, caption.strip(), is_video=True, album_id=album_id)
+    def _on_part_data(self, data, start, end):
+        part = self._part
+        chunk = data[start:end]
+        if "out" in part:
+            part["digest"].update(chunk)
+            part["out"].write(chunk)
+            part["size"] += len(chunk)
+        elif "field" in part:
+            if len(part["data"]) + len(chunk) > MAX_FORM_FIELD_BYTES:
+                raise ValueError(f"Form field {part['field']!r} is too large")
+            part["data"] += chunk
+
+    def _on_end(self):
+        self._ended = True
+
+    def _on_part_end(self):
+        part, self._part = self._part, None
+        if "out" in part:
+            part["out"].close()
+            del part["out"]
+            part["sha256"] = part.pop("digest").hexdigest()
+            self.files.append(part)
+        elif "field" in part:
+            self.fields[part["field"]] = part["data"].decode("utf-8", "replace")
+
+def store_upload(username: str, staged_path: str, final_name: str, caption: str, is_video: bool, album_id: str, sha256: str | None = None):
+    """Persist a ready-to-serve file now and leave the slow work to the queue."""
+    final_path = os.path.join(UPLOAD_DIR, final_name)
+    os.replace(staged_path, final_path)
+    track_upload(username, final_name, caption, sha256=sha256)
+    enqueue_upload(username, final_path, final_name, caption, is_video, album_id, job_type=JOB_INGEST)
+
+CONVERT_EXTS = [".mov", ".heic", ".heif", ".3gp", ".mkv"]
+
+def find_duplicate(username: str, sha256: str | None) -> dict | None:
+    if not sha256 or DEDUP_SCOPE == "off":
+        return None
+    own = find_by_hash(sha256, username)
+    if own or DEDUP_SCOPE != "global":
+        return own
+    return find_by_hash(sha256)
+
+def link_duplicate(username: str, existing: dict, file_id: str, caption: str, sha256: str) -> str:
+    """
+    Give `username` their own row for someone else's identical upload. The
+    file and its previews are hard-linked (copied if linking fails) under a
+    new name, so either copy can be deleted independently, and the stored
+    metadata is reused: no ffmpeg, no probe. If the source's ingest job
+    hasn't run yet there is nothing to reuse, so the copy gets its own.
+    """
+    source = existing["filename"]
+    source_base = os.path.splitext(source)[0]
+    final_name = f"{file_id}{os.path.splitext(source)[1]}"
+    pairs = [(source, final_name)] + [
+        (name, name.replace(source_base, file_id, 1)) for name in thumbnail_files(source)
+    ]
+    for src_name, dest_name in pairs:
+        src_path = os.path.join(UPLOAD_DIR, src_name)
+        if not os.path.exists(src_path):
+            continue
+        dest_path = os.path.join(UPLOAD_DIR, dest_name)
+        try:
+            os.link(src_path, dest_path)
+        except OSError:
+            shutil.copyfile(src_path, dest_path)
+
+    track_upload(username, final_name, caption, sha256=sha256)
+    if not existing["thumb_widths"]:
+        is_video = os.path.splitext(final_name)[1].lower() in VIDEO_EXTS
+        enqueue_upload(username, os.path.join(UPLOAD_DIR, final_name), final_name, caption, is_video, job_type=JOB_INGEST)
+        return final_name
+    meta = dict(existing)
+    meta["thumb_widths"] = [int(w) for w in existing["thumb_widths"].split(",")]
+    update_media_metadata(final_name, meta)
+    return final_name
+
+def accept_staged_upload(username: str, staged_path: str, file_id: str, ext: str, content_type: str, caption: str, album_id: str, sha256: str | None = None) -> dict:
+    """
+    Hand a fully received file in UPLOAD_STAGING_DIR to the queue, or, if
+    the same bytes were uploaded before (see DEDUP_SCOPE), drop it and point
+    at the existing copy. Returns {"filename", "duplicate", "caption"}, where
+    caption is what is stored: for the user's own duplicate that is the
+    existing row's caption, not the one sent with this upload.
+    """
+    existing = find_duplicate(username, sha256)
+    if existing:
+        os.remove(staged_path)
+        if existing["username"] == username:
+            final_name = existing["filename"]
+            caption = existing["caption"] or ""
+            print(f"[Upload] ♻️ {username} already has {final_name}, skipped")
         else:
-            is_video = content_type.startswith("video/")
-            shutil.move(tmp_path, final_path)
-
-            generate_preview(final_path, preview_path, is_video)
-            taken = determine_date_taken(final_path)
-            track_upload(username, final_name, caption.strip(), date_taken=taken)
-            insert_into_album(album_id, final_name)
-
+            final_name = link_duplicate(username, existing, file_id, caption, sha256)
+            print(f"[Upload] ♻️ Linked {existing['filename']} for {username} as {final_name}")
+        insert_into_album(album_id, final_name)
+        return {"filename": final_name, "duplicate": True, "caption": caption}
+
+    is_convert = ext in CONVERT_EXTS
+    final_name = f"{file_id}{'.mp4' if is_convert else ext}"
+    if is_convert:
+        enqueue_upload(username, staged_path, final_name, caption, True, album_id, sha256=sha256)
+    else:
+        store_upload(username, staged_path, final_name, caption, content_type.startswith("video/"), album_id, sha256)
+    return {"filename": final_name, "duplicate": False, "caption": caption}
+
+def enqueue_hls(username: str, final_name: str, caption: str):
+    """Queue the HLS ladder as its own job so the MP4 shows up without waiting for it."""
+    if HLS_ENABLED:
+        enqueue_upload(username, os.path.join(UPLOAD_DIR, final_name), final_name, caption, True, job_type=JOB_HLS)
+
+def process_hls_job(final_name: str):
+    final_path = os.path.join(UPLOAD_DIR, final_name)
+    heights = make_hls(final_path, final_name, get_media_metadata(final_name))
+    set_hls_renditions(final_name, heights)
+    print(f"[HLS] ✅ {final_name}: {', '.join(f'{h}p' for h in heights)}")
+
+def process_ingest_job(username: str, final_name: str, is_video: bool, album_id: str, caption: str = ""):
+    final_path = os.path.join(UPLOAD_DIR, final_name)
+    # Always use .jpg for preview
+    preview_name = f"preview_{os.path.splitext(final_name)[0]}.jpg"
+    preview_path = os.path.join(UPLOAD_DIR, preview_name)
 
+    meta = probe_media(final_path)
+    meta["thumb_widths"] = generate_preview(final_path, preview_path, is_video)
+    update_media_metadata(final_name, meta)
+    insert_into_album(album_id, final_name)
+    if is_video:
+        enqueue_hls(username, final_name, caption)
 
-        uploaded += 1
+@router.post("/upload")
+async def upload_media(request: Request, username: str = Depends(get_current_user)):
+    """
+    multipart/form-data with one or more `files` plus optional `caption` and
+    `album_id`. The body is parsed as it streams in, so each file is written
+    to staging and hashed once, while it arrives.
+    """
+    # Blocking disk and sqlite work runs in the threadpool; previews, dates and
+    # transcodes are queue jobs, so the response time doesn't grow with ffmpeg.
+    content_type, params = parse_options_header(request.headers.get("content-type", ""))
+    if content_type != b"multipart/form-data" or not params.get(b"boundary"):
+        raise HTTPException(status_code=400, detail="Expected multipart/form-data")
+
+    upload = UploadStream(params[b"boundary"])
+    buffer = bytearray()
+    try:
+        async for chunk in request.stream():
+            buffer += chunk
+            if len(buffer) >= UPLOAD_CHUNK_SIZE:
+                await run_in_threadpool(upload.write, bytes(buffer))
+                buffer.clear()
+        await run_in_threadpool(upload.write, bytes(buffer))
+        upload.finish()
+    except ValueError as e:
+        # Malformed body or oversized field (python-multipart errors are ValueErrors)
+        await run_in_threadpool(upload.discard)
+        raise HTTPException(status_code=400, detail=str(e))
+    except Exception:
+        # ClientDisconnect included: nothing half-received stays in staging
+        await run_in_threadpool(upload.discard)
+        raise
+    if not upload.file_parts:
+        raise HTTPException(status_code=400, detail="No files uploaded")
+
+    caption = upload.fields.get("caption", "").strip()
+    album_id = upload.fields.get("album_id", "")
+    received = []
+    for staged in upload.files:
+        stored = await run_in_threadpool(
+            accept_staged_upload, username, staged["staged_path"], staged["file_id"], staged["ext"],
+            staged["content_type"], caption, album_id, staged["sha256"]
+        )
+        received.append({**stored, "size": staged["size"], "sha256": staged["sha256"]})
 
-    return {"uploaded": uploaded}
+    return {"uploaded": len(received), "files": received}
 
 # -------------------- Edit --------------------
+EDIT_DATES_SQL = hot_query("edit_dates", "UPDATE videos SET date_taken = ? WHERE filename = ?")
+MEDIA_OWNER_SQL = hot_query("delete_media_owner", "SELECT username FROM videos WHERE filename = ?")
+DELETE_MEDIA_SQL = hot_query("delete_media", "DELETE FROM videos WHERE filename = ?")
+
 @router.post("/media/edit_dates")
 def edit_dates(
     filenames: List[str] = Form(...),
     timestamp: int = Form(...),
     username: str = Depends(get_current_user)
 ):
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
-    for filename in filenames:
-        c.execute(
-            "UPDATE videos SET date_taken = ? WHERE filename = ?",
-            (timestamp, filename)
+    with db_conn() as conn:
+        conn.executemany(
+            EDIT_DATES_SQL,
+            [(timestamp, filename) for filename in filenames]
         )
-    conn.commit()
-    conn.close()
 
     return {"status": "ok"}
 
@@ -364,185 +728,364 @@ def delete_media(
     filenames: List[str] = Form(...),
     username: str = Depends(get_current_user)
 ):
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
     deleted = 0
 
-    for filename in filenames:
-        # Confirm user owns the file
-        c.execute("SELECT username FROM videos WHERE filename = ?", (filename,))
-        row = c.fetchone()
-        if not row:
-            continue
-        if row[0] != username:
-            continue
-
-        # Delete DB entry
-        c.execute("DELETE FROM videos WHERE filename = ?", (filename,))
-        deleted += 1
-
-        # Remove files
-        for name in [filename, f"preview_{filename}"]:
-            path = os.path.join(UPLOAD_DIR, name)
-            if os.path.exists(path):
-                os.remove(path)
+    with db_conn() as conn:
+        c = conn.cursor()
+        for filename in filenames:
+            # Confirm user owns the file
+            c.execute(MEDIA_OWNER_SQL, (filename,))
+            row = c.fetchone()
+            if not row:
+                continue
+            if row[0] != username:
+                continue
+
+            # Delete DB entry
+            c.execute(DELETE_MEDIA_SQL, (filename,))
+            deleted += 1
+
+            # Remove files
+            for name in [filename, *thumbnail_files(filename)]:
+                path = os.path.join(UPLOAD_DIR, name)
+                forget_stat(path)
+                if os.path.exists(path):
+                    os.remove(path)
+            remove_hls(filename)
 
-    conn.commit()
-    conn.close()
     return {"deleted": deleted}
 
 # -------------------- Gallery --------------------
+# Must match the idx_videos_taken / idx_videos_user_taken expression indexes
+TAKEN_EXPR = "COALESCE(date_taken, timestamp)"
+DEFAULT_GALLERY_MONTHS = 3
+
+def month_start(ts: int, local: bool) -> int:
+    dt = datetime.fromtimestamp(ts) if local else datetime.fromtimestamp(ts, timezone.utc)
+    return int(dt.replace(day=1, hour=0, minute=0, second=0, microsecond=0).timestamp())
+
+def month_label(month_key: str) -> str:
+    return datetime.strptime(month_key, "%Y-%m").strftime("%B %Y")
+
+def gallery_seek_sql(conds: list) -> str:
+    """Newest date taken matching `conds` (one index seek)."""
+    where = " AND ".join(conds) or "1"
+    return f"""
+            SELECT {TAKEN_EXPR} FROM videos
+            WHERE {where}
+            ORDER BY {TAKEN_EXPR} DESC
+            LIMIT 1
+        """
+
+def gallery_rows_sql(columns: str, joins: str, conds: list, local: bool) -> str:
+    """Rows matching `conds` newest-first, with the month key in column 0."""
+    tz = ", 'localtime'" if local else ""
+    month_expr = f"strftime('%Y-%m', {TAKEN_EXPR}, 'unixepoch'{tz})"
+    where = f"WHERE {' AND '.join(conds)}" if conds else ""
+    return f"""
+            SELECT {month_expr}, {columns}
+            FROM videos
+            {joins}
+            {where}
+            ORDER BY {TAKEN_EXPR} DESC
+        """
+
+def gallery_window(conn, filters: list, params: list, months: int, before: int | None, start: int | None, local: bool):
+    """
+    Find the [lower, upper) range covering the next `months` non-empty months
+    before `before`, using one index seek per month instead of a table scan.
+    months=None takes the whole [start, before) range. Returns (conditions,
+    params, next_before).
+    """
+    conds, args = list(filters), list(params)
+    if before is not None:
+        conds.append(f"{TAKEN_EXPR} < ?")
+        args.append(before)
+    if start is not None:
+        conds.append(f"{TAKEN_EXPR} >= ?")
+        args.append(start)
+    if months is None:
+        return conds, args, None
+
+    def newest_before(bound):
+        extra, extra_args = ([f"{TAKEN_EXPR} < ?"], [bound]) if bound is not None else ([], [])
+        row = conn.execute(gallery_seek_sql(conds + extra), (*args, *extra_args)).fetchone()
+        return row[0] if row else None
+
+    lower = None
+    for _ in range(months):
+        taken = newest_before(lower)
+        if taken is None:
+            break
+        lower = month_start(taken, local)
+
+    if lower is None:
+        return None, None, None
+
+    next_before = lower if newest_before(lower) is not None else None
+    conds.append(f"{TAKEN_EXPR} >= ?")
+    args.append(lower)
+    return conds, args, next_before
+
+def group_by_month(rows, to_item):
+    """Rows arrive ordered newest-first with the SQL month key in column 0."""
+    groups = []
+    for key, month_rows in groupby(rows, key=lambda r: r[0]):
+        if key is None:
+            continue
+        groups.append({
+            "month": key,
+            "label": month_label(key),
+            "items": [to_item(r[1:]) for r in month_rows],
+        })
+    return groups
+
+def gallery_item(row):
+    return {
+        "username": row[0],
+        "filename": row[1],
+        "caption": row[2],
+        "timestamp": row[3],
+        "date_taken": row[4],
+        "avatar": row[5],
+        "width": row[6],
+        "height": row[7],
+        "duration": row[8],
+        "thumbnails": thumbnail_variants(row[1], row[9]),
+        **media_links(row[1], row[10]),
+    }
+
+def user_gallery_item(row):
+    return {
+        "filename": row[0],
+        "caption": row[1],
+        "timestamp": row[2],
+        "date_taken": row[3],
+        "width": row[4],
+        "height": row[5],
+        "duration": row[6],
+        "thumbnails": thumbnail_variants(row[0], row[7]),
+    }
+
+def query_gallery(columns: str, joins: str, filters: list, params: list, to_item, local: bool,
+                  months: int | None, before: int | None, start: int | None, end: int | None):
+    if end is not None:
+        before = end if before is None else min(before, end)
+    windowed = any(v is not None for v in (months, before, start))
+    # An explicit start/end range is bounded by end - start, not cut to the
+    # default window; `months` still caps it when given
+    if months is None and start is None and end is None:
+        months = DEFAULT_GALLERY_MONTHS
+
+    with db_conn() as conn:
+        next_before = None
+        if windowed:
+            filters, params, next_before = gallery_window(
+                conn, filters, params, months, before, start, local
+            )
+            if filters is None:
+                return {"groups": [], "next_before": None}
+
+        rows = conn.execute(gallery_rows_sql(columns, joins, filters, local), params).fetchall()
+
+    groups = group_by_month(rows, to_item)
+    if windowed:
+        return {"groups": groups, "next_before": next_before}
+    # Legacy shape: {"May 2024": [...], ...}
+    return {g["label"]: g["items"] for g in groups}
+
+GALLERY_COLUMNS = (
+    "videos.username, videos.filename, videos.caption, videos.timestamp, videos.date_taken, users.avatar, "
+    "videos.width, videos.height, videos.duration, videos.thumb_widths, videos.hls_renditions"
+)
+GALLERY_JOINS = "JOIN users ON videos.username = users.username"
+USER_GALLERY_COLUMNS = "filename, caption, timestamp, date_taken, width, height, duration, thumb_widths"
+
+# The statements a windowed page runs (the unwindowed legacy shape reads everything by design)
+TAKEN_BEFORE, TAKEN_FROM = f"{TAKEN_EXPR} < ?", f"{TAKEN_EXPR} >= ?"
+hot_query("gallery_newest", gallery_seek_sql([]), limit_bounded=True)
+hot_query("gallery_month_seek", gallery_seek_sql([TAKEN_BEFORE]))
+hot_query("gallery_window", gallery_rows_sql(GALLERY_COLUMNS, GALLERY_JOINS, [TAKEN_FROM], True))
+hot_query("gallery_window_before", gallery_rows_sql(GALLERY_COLUMNS, GALLERY_JOINS, [TAKEN_BEFORE, TAKEN_FROM], True))
+hot_query("user_gallery_month_seek", gallery_seek_sql(["username = ?", TAKEN_BEFORE]))
+hot_query("user_gallery_window", gallery_rows_sql(USER_GALLERY_COLUMNS, "", ["username = ?", TAKEN_BEFORE, TAKEN_FROM], False))
+
 @router.get("/gallery")
-def gallery_data(_: str = Depends(get_current_user)):
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
-    c.execute("""
-        SELECT videos.username, videos.filename, videos.caption, videos.timestamp, videos.date_taken, users.avatar
-        FROM videos
-        JOIN users ON videos.username = users.username
-    """)
-    rows = c.fetchall()
-    conn.close()
-
-    grouped = defaultdict(list)
-    for row in rows:
-        try:
-            taken = row[4] or row[3]
-            dt = datetime.fromtimestamp(taken)
-            month_label = dt.strftime("%B %Y")
-            grouped[month_label].append({
-                "username": row[0],
-                "filename": row[1],
-                "caption": row[2],
-                "timestamp": row[3],
-                "date_taken": row[4],
-                "avatar": row[5],
-            })
-        except Exception as e:
-            print("[Gallery Debug] Skipped invalid:", row, e)
-
-    # Sort inside each group
-    for month in grouped:
-        grouped[month].sort(key=lambda x: x["date_taken"] or x["timestamp"], reverse=True)
-
-    return grouped
+def gallery_data(
+    _: str = Depends(get_current_user),
+    months: int | None = Query(None, ge=1, le=24),
+    before: int | None = Query(None),
+    start: int | None = Query(None),
+    end: int | None = Query(None)
+):
+    """
+    Without parameters returns the whole library grouped by month label.
+    With months/before/start/end returns {"groups": [...], "next_before": ts}
+    covering at most `months` months (default 3, or all of an explicit
+    start/end range); pass next_before back to load older ones.
+    """
+    return query_gallery(
+        GALLERY_COLUMNS, GALLERY_JOINS, [], [], gallery_item, True, months, before, start, end
+    )
 
 @router.get("/gallery/user/{username}")
-def get_user_gallery(username: str):
+def get_user_gallery(
+    username: str,
+    months: int | None = Query(None, ge=1, le=24),
+    before: int | None = Query(None),
+    start: int | None = Query(None),
+    end: int | None = Query(None)
+):
     real_user = resolve_username_caseless(username)
     if not real_user:
         raise HTTPException(status_code=404, detail="User not found")
 
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
-    c.execute("""
-        SELECT filename, caption, timestamp, date_taken
-        FROM videos
-        WHERE username = ?
-    """, (real_user,))
-    uploads = c.fetchall()
-    conn.close()
-
-    grouped = defaultdict(list)
-    for filename, caption, timestamp, date_taken in uploads:
-        sort_time = date_taken or timestamp
-        month = datetime.utcfromtimestamp(sort_time).strftime("%B %Y")
-        grouped[month].append({
-            "filename": filename,
-            "caption": caption,
-            "timestamp": timestamp,
-            "date_taken": date_taken,
-        })
-
-    return grouped
+    return query_gallery(
+        USER_GALLERY_COLUMNS, "", ["username = ?"], [real_user], user_gallery_item, False, months, before, start, end
+    )
 
 # -------------------- Feed / My Uploads --------------------
 @router.get("/my_uploads")
 def my_uploads(username: str = Depends(get_current_user)):
     return list_user_uploads(username)
 
+def encode_feed_cursor(timestamp: int, video_id: str) -> str:
+    raw = f"{timestamp}:{video_id}".encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip("=")
+
+def decode_feed_cursor(cursor: str) -> tuple[int, str]:
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)).decode()
+        timestamp, video_id = raw.split(":", 1)
+        return int(timestamp), video_id
+    except (binascii.Error, UnicodeDecodeError, ValueError):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+FEED_COLUMNS = """
+    videos.username, videos.filename, videos.caption, videos.timestamp, users.avatar,
+    videos.width, videos.height, videos.duration, videos.thumb_widths, videos.hls_renditions
+"""
+
+FEED_OFFSET_SQL = hot_query("feed_offset", f"""
+                SELECT {FEED_COLUMNS}
+                FROM videos
+                JOIN users ON videos.username = users.username
+                ORDER BY videos.timestamp DESC, videos.id DESC
+                LIMIT ? OFFSET ?
+            """, limit_bounded=True)
+FEED_PAGE_SQL = """
+            SELECT {columns}, videos.id
+            FROM videos
+            JOIN users ON videos.username = users.username
+            {where}
+            ORDER BY videos.timestamp DESC, videos.id DESC
+            LIMIT ?
+        """
+FEED_FIRST_SQL = hot_query("feed_first", FEED_PAGE_SQL.format(columns=FEED_COLUMNS, where=""), limit_bounded=True)
+FEED_AFTER_SQL = hot_query("feed_cursor", FEED_PAGE_SQL.format(
+    columns=FEED_COLUMNS, where="WHERE (videos.timestamp, videos.id) < (?, ?)"
+))
+
+def feed_item(row):
+    return {
+        "username": row[0],
+        "filename": row[1],
+        "preview_filename": f"preview_{row[1]}",
+        "caption": row[2],
+        "timestamp": row[3],
+        "avatar": row[4],
+        "width": row[5],
+        "height": row[6],
+        "duration": row[7],
+        "thumbnails": thumbnail_variants(row[1], row[8]),
+        **media_links(row[1], row[9]),
+    }
+
 @router.get("/feed")
 def get_feed(
     username: str = Depends(get_current_user),
     limit: int = Query(20, ge=1, le=100),
-    offset: int = Query(0, ge=0)
+    offset: int = Query(0, ge=0),
+    cursor: str | None = Query(None)
 ):
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
-    c.execute("""
-        SELECT videos.username, videos.filename, videos.caption, videos.timestamp, users.avatar
-        FROM videos
-        JOIN users ON videos.username = users.username
-        ORDER BY videos.timestamp DESC
-        LIMIT ? OFFSET ?
-    """, (limit, offset))
-    rows = c.fetchall()
-    conn.close()
-
-    return [
-        {
-            "username": row[0],
-            "filename": row[1],
-            "preview_filename": f"preview_{row[1]}",
-            "caption": row[2],
-            "timestamp": row[3],
-            "avatar": row[4],
-        }
-        for row in rows
-    ]
-
-# -------------------- Date Backfill --------------------
-def backfill_date_taken():
-	from modules.database import add_date_taken_column
-	add_date_taken_column()
-
-	conn = sqlite3.connect(DB_PATH)
-	c = conn.cursor()
-	c.execute("SELECT id, filename FROM videos WHERE date_taken IS NULL")
-	rows = c.fetchall()
-
-	for video_id, filename in rows:
-		path = os.path.join(UPLOAD_DIR, filename)
-		if not os.path.exists(path):
-			continue
-
-		ext = os.path.splitext(filename)[-1].lower()
-		taken = None
-
-		# Try EXIF / ffprobe
-		if ext in [".jpg", ".jpeg", ".png", ".webp", ".heic"]:
-			taken = extract_date_taken_image(path)
-			if taken:
-				print(f"[Backfill] ⏱ EXIF: {filename} → {taken}")
-		elif ext in [".mp4", ".webm", ".mov", ".avi", ".mkv", ".3gp"]:
-			taken = extract_date_taken_video(path)
-			if taken:
-				print(f"[Backfill] 🎞️ FFPROBE: {filename} → {taken}")
-
-		# Fallback to filename pattern
-		if not taken:
-			taken = parse_date_from_filename(filename)
-			if taken:
-				print(f"[Backfill] 📄 Filename: {filename} → {taken}")
-			else:
-				print(f"[Backfill] ❌ No date found: {filename}")
-
-		# Save if valid
-		if taken:
-			c.execute("UPDATE videos SET date_taken=? WHERE id=?", (taken, video_id))
-
-	conn.commit()
-	conn.close()
+    # Legacy clients page with offset and get a bare list back
+    if cursor is None:
+        with db_conn() as conn:
+            rows = conn.execute(FEED_OFFSET_SQL, (limit, offset)).fetchall()
+        return [feed_item(row) for row in rows]
+
+    # Keyset pagination: pass cursor="" for the first page, then next_cursor.
+    # Seeks straight into idx_videos_timestamp_id, so every page costs the same.
+    if cursor:
+        after_ts, after_id = decode_feed_cursor(cursor)
+        sql, params = FEED_AFTER_SQL, (after_ts, after_id)
+    else:
+        sql, params = FEED_FIRST_SQL, ()
+
+    with db_conn() as conn:
+        rows = conn.execute(sql, (*params, limit + 1)).fetchall()
+
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    return {
+        "items": [feed_item(row) for row in rows],
+        "next_cursor": encode_feed_cursor(rows[-1][3], rows[-1][-1]) if has_more else None,
+    }
+
+# -------------------- Date / Metadata Backfill --------------------
+def backfill_metadata(filename: str, date_taken: int | None) -> dict | None:
+	"""Probe one row missing a date or stored metadata (dates_backfill job)."""
+	path = os.path.join(UPLOAD_DIR, filename)
+	if not os.path.exists(path):
+		return None
+
+	meta = probe_media(path)
+	# Never clobber a date the user set by hand
+	if date_taken:
+		meta["date_taken"] = date_taken
+	return meta
+
+def hash_file(path: str) -> str:
+	digest = hashlib.sha256()
+	with open(path, "rb") as f:
+		while chunk := f.read(UPLOAD_CHUNK_SIZE):
+			digest.update(chunk)
+	return digest.hexdigest()
+
+def backfill_hash(filename: str) -> str | None:
+	"""SHA-256 of an upload stored before dedup existed (hashes_backfill job)."""
+	path = os.path.join(UPLOAD_DIR, filename)
+	if not os.path.exists(path):
+		return None
+	return hash_file(path)
 
 
 @router.get("/media/{filename}")
-def serve_media(filename: str, username: str = Depends(get_current_user)):
+def serve_media(filename: str, request: Request, username: str = Depends(get_current_user)):
+	# Upload and preview names are UUID-based and never rewritten
+	return serve_file(request, os.path.join(UPLOAD_DIR, filename), immutable=True)
+
+@router.get("/m/{filename}")
+def serve_signed_media(filename: str, request: Request, t: str = Query(...)):
+	"""Media behind a signed URL from /feed, /gallery or /album: no token decode, no DB."""
+	if not verify_media_token(filename, t):
+		raise HTTPException(status_code=403, detail="Invalid or expired link")
 	file_path = os.path.join(UPLOAD_DIR, filename)
-	print(f"[ServeMedia] Checking: {file_path}")
-	
-	if not os.path.isfile(file_path):
-		print(f"[ServeMedia] ❌ Not found: {file_path}")
-		raise HTTPException(status_code=404, detail="Media not found")
+	return offload_response(file_path, filename) or serve_file(request, file_path, immutable=True)
 
-	print(f"[ServeMedia] ✅ Found: {file_path}")
-	return FileResponse(file_path)
+HLS_NAME_RE = re.compile(r"^[\w-]+(\.[\w-]+)?$")
+
+@router.get("/m/hls/{token}/{base}/{name}")
+def serve_signed_hls(token: str, base: str, name: str, request: Request):
+	"""HLS playlists and segments; the token is in the path so relative URLs keep it."""
+	ext = os.path.splitext(name)[1]
+	if not HLS_NAME_RE.match(base) or not HLS_NAME_RE.match(name) or ext not in HLS_MEDIA_TYPES:
+		raise HTTPException(status_code=404, detail="Media not found")
+	if not verify_media_token(base, token):
+		raise HTTPException(status_code=403, detail="Invalid or expired link")
+	relative = f"hls_{base}/{name}"
+	file_path = os.path.join(UPLOAD_DIR, relative)
+	# Segments never change; playlists are replaced if the ladder is re-encoded
+	return offload_response(file_path, relative) or serve_file(
+		request, file_path, immutable=ext == ".ts", media_type=HLS_MEDIA_TYPES[ext]
+	)
@@ -1,23 +1,15 @@
-from fastapi import APIRouter, Depends, UploadFile, File, Form, HTTPException
+from fastapi import APIRouter, Depends, UploadFile, File, Form, HTTPException, Request
 import os, shutil
-from fastapi.security import OAuth2PasswordBearer
-from fastapi.responses import FileResponse
-from modules.database import get_user, update_avatar, user_exists, list_users
+from modules.media import serve_file, forget_stat
+from modules.database import get_user, update_avatar, list_users
 from modules.config import AVATAR_DIR
-from modules.auth import decode_token
+from modules.auth import decode_token, get_current_user, oauth2_scheme
 from modules.database import get_user
 from modules.database import resolve_username_caseless 
 from modules.rooms import get_room_path  # Or define it if you haven't
 from bs4 import BeautifulSoup
 
 router = APIRouter()
-oauth2_scheme = OAuth2PasswordBearer(tokenUrl="login")
-
-def get_current_user(token: str = Depends(oauth2_scheme)):
-	username = decode_token(token)
-	if not username or not user_exists(username):
-		raise HTTPException(status_code=401, detail="Invalid token")
-	return username
 
 @router.get("/me")
 def get_me(token: str = Depends(oauth2_scheme)):
@@ -41,17 +33,19 @@ async def upload_avatar(username: str = Depends(get_current_user), file: UploadF
 	save_path = os.path.join(AVATAR_DIR, filename)
 	with open(save_path, "wb") as f:
 		shutil.copyfileobj(file.file, f)
+	forget_stat(save_path)
 	update_avatar(username, filename)
 	return {"avatar": filename}
 
 @router.get("/avatar/{filename}")
-def get_avatar(filename: str, token: str = Depends(oauth2_scheme)):
+def get_avatar(filename: str, request: Request, token: str = Depends(oauth2_scheme)):
+	# Avatars are overwritten in place on re-upload, so they revalidate via ETag
 	file_path = os.path.join(AVATAR_DIR, filename or "default-pfp.svg")
 	if os.path.exists(file_path):
-		return FileResponse(file_path)
+		return serve_file(request, file_path, immutable=False)
 	fallback = os.path.join("src", "assets", "default-pfp.svg")
 	if os.path.exists(fallback):
-		return FileResponse(fallback, media_type="image/svg+xml")
+		return serve_file(request, fallback, immutable=False, media_type="image/svg+xml")
 	raise HTTPException(status_code=404, detail="Avatar not found")
 
 @router.get("/users")